@@ -9,15 +9,19 @@ from urllib.parse import urlparse
 from datetime import datetime, date
 import requests
 
+from . import util
 from .cache import (
     CacheResult,
     compare_cache_details,
+    get_conditional_headers,
     DownloadTask,
+    DownloadNotModified,
     URLDownloadTask,
 )
 
 from .conform import (
     ConformResult,
+    ConformStore,
     DecompressionTask,
     ExcerptDataTask,
     ConvertToCsvTask,
@@ -53,17 +57,23 @@ class SourceConfig:
         elif self.layer == 'parcels':
             self.SCHEMA = PARCELS_SCHEMA
 
-def cache(source_config, destdir, extras):
+def cache(source_config, destdir, extras, fingerprint_hash=None, download_cache=None):
     ''' Python wrapper for openaddress-cache.
 
         Return a CacheResult object:
 
           cache: URL of cached data, possibly with file:// schema
-          fingerprint: md5 hash of data,
+          fingerprint: md5 or fingerprint_hash hash of data,
           version: data version as date?
           elapsed: elapsed time as timedelta object
+          etag: ETag response header of data
+          last_modified: Last-Modified response header of data
           output: subprocess output as string
 
+        Returns the previous cache without downloading if the server says
+        data is unchanged since the etag or last_modified from extras.
+        Reuses downloads from an optional shared DownloadCache.
+
         Creates and destroys a subdirectory in destdir.
     '''
     start = datetime.now()
@@ -77,8 +87,22 @@ def cache(source_config, destdir, extras):
 
     protocol_string = source_config.data_source.get('protocol')
 
-    task = DownloadTask.from_protocol_string(protocol_string, source_config)
-    downloaded_files = task.download(source_urls, workdir, source_config)
+    task = DownloadTask.from_protocol_string(protocol_string, source_config, fingerprint_hash, download_cache)
+    data = source_config.data_source
+
+    if isinstance(task, URLDownloadTask):
+        task.headers.update(get_conditional_headers(data, source_urls))
+
+    try:
+        downloaded_files = task.download(source_urls, workdir, source_config)
+    except DownloadNotModified:
+        _L.info('Source data unchanged since {}'.format(data['cache']))
+        rmtree(workdir)
+
+        return CacheResult(data['cache'], data['fingerprint'], data.get('version', None),
+                           datetime.now() - start, data.get('etag'), data.get('last_modified'))
+
+    etag, last_modified = task.validators.get(source_urls[0], (None, None))
 
     # FIXME: I wrote the download stuff to assume multiple files because
     # sometimes a Shapefile fileset is splayed across multiple files instead
@@ -86,22 +110,24 @@ def cache(source_config, destdir, extras):
     # we should zip them together before uploading to S3 instead of picking
     # the first one only.
     filepath_to_upload = abspath(downloaded_files[0])
+    fingerprint = task.fingerprints.get(downloaded_files[0])
 
     #
     # Find the cached data and hold on to it.
     #
     resultdir = join(destdir, 'cached')
     source_config.data_source['cache'], source_config.data_source['fingerprint'] \
-        = compare_cache_details(filepath_to_upload, resultdir, source_config.data_source)
+        = compare_cache_details(filepath_to_upload, resultdir, source_config.data_source, fingerprint)
 
     rmtree(workdir)
 
     return CacheResult(source_config.data_source.get('cache', None),
                        source_config.data_source.get('fingerprint', None),
                        source_config.data_source.get('version', None),
-                       datetime.now() - start)
+                       datetime.now() - start,
+                       etag, last_modified)
 
-def conform(source_config, destdir, extras):
+def conform(source_config, destdir, extras, workers=1, store_dir=None, compression=None, extract_to_file=False):
     ''' Python wrapper for openaddresses-conform.
 
         Return a ConformResult object:
@@ -112,13 +138,43 @@ def conform(source_config, destdir, extras):
           elapsed: elapsed time as timedelta object
           output: subprocess output as string
 
+        Conforms rows in a pool of worker processes if workers > 1.
+
+        Reuses a previous result from store_dir, a path or ConformStore, if
+        the cache fingerprint, conform object and code version all match,
+        and stores new results.
+
+        Writes out.csv compressed on the fly if compression is given,
+        as named in util.output_compressions, e.g. out.csv.gz for "gzip".
+
+        Source rows are streamed into out.csv, or with extract_to_file
+        written to an intermediate CSV first for debugging.
+
         Creates and destroys a subdirectory in destdir.
     '''
     start = datetime.now()
-    workdir = mkdtemp(prefix='conform-', dir=destdir)
 
     source_config.data_source.update(extras)
 
+    out_filename = 'out.csv' + (util.output_compressions[compression] if compression else '')
+
+    store, store_key = None, None
+    if store_dir and extras.get('fingerprint'):
+        store = store_dir if isinstance(store_dir, ConformStore) else ConformStore(store_dir)
+        store_key = store.key(source_config, extras['fingerprint'], __version__, compression)
+        stored = store.get(store_key)
+
+        if stored is not None:
+            stored_path, data_sample, geometry_type, addr_count = stored
+            _L.info("Reusing conformed data from %s with %d addresses", stored_path, addr_count)
+            util.link_or_copy(stored_path, join(destdir, out_filename))
+
+            return conform_result(source_config, data_sample, geometry_type,
+                                  addr_count, realpath(join(destdir, out_filename)),
+                                  datetime.now() - start)
+
+    workdir = mkdtemp(prefix='conform-', dir=destdir)
+
     #
     # The cached data will be a local path.
     #
@@ -136,7 +192,7 @@ def conform(source_config, destdir, extras):
 
     task2 = DecompressionTask.from_format_string(source_config.data_source.get('compression'))
     names = elaborate_filenames(source_config.data_source.get('conform', {}).get('file', None))
-    decompressed_paths = task2.decompress(downloaded_path, workdir, names)
+    decompressed_paths = task2.decompress(downloaded_path, workdir, names, source_config.data_source)
     _L.info("Decompressed to %d files", len(decompressed_paths))
 
     task3 = ExcerptDataTask()
@@ -151,23 +207,34 @@ def conform(source_config, destdir, extras):
 
     task4 = ConvertToCsvTask()
     try:
-        csv_path, addr_count = task4.convert(source_config, decompressed_paths, workdir)
+        csv_path, addr_count = task4.convert(source_config, decompressed_paths, workdir, workers, compression, extract_to_file)
         if addr_count > 0:
             _L.info("Converted to %s with %d addresses", csv_path, addr_count)
         else:
             _L.warning('Found no addresses in source data')
+            util.report_source_problem(util.SourceProblem.no_addresses_found)
             csv_path = None
     except Exception as e:
         _L.warning("Error doing conform; skipping", exc_info=True)
+        util.report_source_problem(util.SourceProblem.conform_source_failed)
         csv_path, addr_count = None, 0
 
     out_path = None
     if csv_path is not None and exists(csv_path):
-        move(csv_path, join(destdir, 'out.csv'))
-        out_path = realpath(join(destdir, 'out.csv'))
+        move(csv_path, join(destdir, out_filename))
+        out_path = realpath(join(destdir, out_filename))
 
     rmtree(workdir)
 
+    if store is not None and out_path is not None:
+        store.put(store_key, out_path, data_sample, geometry_type, addr_count)
+
+    return conform_result(source_config, data_sample, geometry_type,
+                          addr_count, out_path, datetime.now() - start)
+
+def conform_result(source_config, data_sample, geometry_type, addr_count, out_path, elapsed):
+    ''' Return a ConformResult object with license details from source_config.
+    '''
     sharealike_flag = conform_sharealike(source_config.data_source.get('license'))
     attr_flag, attr_name = conform_attribution(source_config.data_source.get('license'), source_config.data_source.get('attribution'))
 
@@ -178,7 +245,7 @@ def conform(source_config, destdir, extras):
                          geometry_type,
                          addr_count,
                          out_path,
-                         datetime.now() - start,
+                         elapsed,
                          sharealike_flag,
                          attr_flag,
                          attr_name)
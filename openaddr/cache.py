@@ -6,18 +6,22 @@ import errno
 import math
 import mimetypes
 import shutil
+import time
+import threading
 import re
 import csv
+import fcntl
 import simplejson as json
 
 from os import mkdir
-from hashlib import md5
+from hashlib import md5, blake2b
 from os.path import join, basename, exists, abspath, splitext
 from urllib.parse import urlparse
-from subprocess import check_output
-from tempfile import mkstemp
 from hashlib import sha1
 from shutil import move
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
 from shapely.geometry import shape
 from esridump import EsriDumper
 from esridump.errors import EsriDownloadError
@@ -29,6 +33,11 @@ _http_timeout = 180
 
 from .conform import GEOM_FIELDNAME
 from . import util
+from .util import link_or_copy, write_json_file, FileStore
+
+# Semaphores limiting concurrent requests to each host, see get_host_semaphore()
+_host_semaphores = dict()
+_host_semaphores_lock = threading.Lock()
 
 def mkdirsp(path):
     try:
@@ -48,56 +57,121 @@ def traverse(item):
     else:
         yield item
 
-def request(method, url, **kwargs):
+def request(method, url, session=None, **kwargs):
+    ''' Make an HTTP or FTP request, optionally with a shared requests.Session.
+
+        FTP responses are always streamed, in passive mode unless ftp_passive is false.
+    '''
+    ftp_passive = kwargs.pop('ftp_passive', True)
+
     if urlparse(url).scheme == 'ftp':
         if method != 'GET':
             raise NotImplementedError("Don't know how to {} with {}".format(method, url))
-        return util.request_ftp_file(url)
+        return util.request_ftp_file(url, kwargs.get('headers') or {}, ftp_passive)
+
+    session = session or requests
 
     try:
         _L.debug("Requesting %s with args %s", url, kwargs.get('params') or kwargs.get('data'))
-        return requests.request(method, url, timeout=_http_timeout, **kwargs)
+        return session.request(method, url, timeout=_http_timeout, **kwargs)
     except requests.exceptions.SSLError as e:
         _L.warning("Retrying %s without SSL verification", url)
-        return requests.request(method, url, timeout=_http_timeout, verify=False, **kwargs)
+        return session.request(method, url, timeout=_http_timeout, verify=False, **kwargs)
 
 class CacheResult:
     cache = None
     fingerprint = None
     version = None
     elapsed = None
+    etag = None
+    last_modified = None
 
-    def __init__(self, cache, fingerprint, version, elapsed):
+    def __init__(self, cache, fingerprint, version, elapsed, etag=None, last_modified=None):
         self.cache = cache
         self.fingerprint = fingerprint
         self.version = version
         self.elapsed = elapsed
+        self.etag = etag
+        self.last_modified = last_modified
 
     @staticmethod
     def empty():
         return CacheResult(None, None, None, None)
 
     def todict(self):
-        return dict(cache=self.cache, fingerprint=self.fingerprint, version=self.version)
+        return dict(cache=self.cache, fingerprint=self.fingerprint, version=self.version,
+                    etag=self.etag, last_modified=self.last_modified)
+
+
+# Source data is fingerprinted this many bytes at a time.
+FINGERPRINT_BLOCK = 1024 * 1024
+
+def new_fingerprint(hash_name='md5'):
+    ''' Return a new hash object for fingerprinting source data.
+
+        BLAKE2 is faster than MD5 on 64-bit machines, and is cut to
+        the same 128-bit length so fingerprints stay the same size.
+    '''
+    if hash_name == 'md5':
+        return md5()
+    elif hash_name == 'blake2b':
+        return blake2b(digest_size=16)
+    else:
+        raise ValueError('Unknown fingerprint hash "{}"'.format(hash_name))
+
+def update_fingerprint(fingerprint, file, size=None):
+    ''' Update a fingerprint with the next size bytes of a binary file, or all of it.
+    '''
+    while size is None or size > 0:
+        block = file.read(FINGERPRINT_BLOCK if size is None else min(size, FINGERPRINT_BLOCK))
+
+        if not block:
+            break
+
+        fingerprint.update(block)
+
+        if size is not None:
+            size -= len(block)
+
+    return fingerprint
+
+def file_fingerprint(filepath, hash_name='md5'):
+    ''' Return fingerprint hex digest of a whole file.
+    '''
+    with open(filepath, 'rb') as file:
+        return update_fingerprint(new_fingerprint(hash_name), file).hexdigest()
+
+class FingerprintWriter(object):
+    ''' Text writer to a binary file that fingerprints everything written to it.
 
+        The binary file's tell() is a true byte offset, unlike a text file's.
+    '''
+    def __init__(self, file, fingerprint, encoding='utf-8'):
+        self.file = file
+        self.fingerprint = fingerprint
+        self.encoding = encoding
 
-def compare_cache_details(filepath, resultdir, data):
+    def write(self, text):
+        data = text.encode(self.encoding)
+        self.fingerprint.update(data)
+        self.file.write(data)
+        return len(text)
+
+def compare_cache_details(filepath, resultdir, data, fingerprint=None):
     ''' Compare cache file with known source data, return cache and fingerprint.
 
         Checks if fresh data is already cached, returns a new file path if not.
+        Fingerprint is an MD5 hex digest of the file computed if not given.
     '''
     if not exists(filepath):
         raise Exception('cached file {} is missing'.format(filepath))
 
-    fingerprint = md5()
-
-    with open(filepath, 'rb') as file:
-        for line in file:
-            fingerprint.update(line)
+    if fingerprint is None:
+        fingerprint = file_fingerprint(filepath)
 
     # Determine if anything needs to be done at all.
     if urlparse(data.get('cache', '')).scheme == 'http' and 'fingerprint' in data:
-        if fingerprint.hexdigest() == data['fingerprint']:
+        if fingerprint == data['fingerprint']:
             return data['cache'], data['fingerprint']
 
     cache_name = basename(filepath)
@@ -108,19 +182,210 @@ def compare_cache_details(filepath, resultdir, data):
     move(filepath, join(resultdir, cache_name))
     data_cache = 'file://' + join(abspath(resultdir), cache_name)
 
-    return data_cache, fingerprint.hexdigest()
+    return data_cache, fingerprint
+
+def get_conditional_headers(data, source_urls):
+    ''' Return If-None-Match and If-Modified-Since headers for known source data.
+
+        Only a single source URL with a previous cache, fingerprint and
+        validators can be revalidated instead of downloaded.
+    '''
+    if len(source_urls) != 1 or 'fingerprint' not in data:
+        return dict()
+
+    if urlparse(data.get('cache') or '').scheme not in ('http', 'https'):
+        return dict()
+
+    headers = dict()
+
+    if data.get('etag'):
+        headers['If-None-Match'] = data['etag']
+
+    if data.get('last_modified'):
+        headers['If-Modified-Since'] = data['last_modified']
+
+    return headers
+
+def format_wkt_number(value):
+    ''' Format a coordinate for WKT like the GEOS WKTWriter in pinned Shapely.
+
+        GEOS writes trimmed numbers with 16 significant digits, so 0.1 + 0.2
+        is written as 0.3, and very large or small ones with exponents.
+        Raises TypeError for NaN, and ValueError for other unformattable values.
+    '''
+    if type(value) not in (int, float):
+        raise ValueError(value)
+
+    if math.isnan(value):
+        raise TypeError("Geometry has NaN coordinates")
+
+    if math.isinf(value):
+        raise ValueError(value)
+
+    try:
+        return format(float(value), '.16g')
+    except OverflowError:
+        raise ValueError(value)
+
+def format_wkt_points(coordinates):
+    ''' Format a list of 2D positions for WKT.
+    '''
+    if type(coordinates) is not list or not coordinates:
+        raise ValueError(coordinates)
+
+    for xy in coordinates:
+        if type(xy) is not list or len(xy) != 2:
+            raise ValueError(xy)
+
+    return ', '.join(format_wkt_number(x) + ' ' + format_wkt_number(y) for (x, y) in coordinates)
+
+def format_wkt_rings(coordinates):
+    ''' Format a list of lists of 2D positions for WKT.
+    '''
+    if type(coordinates) is not list or not coordinates:
+        raise ValueError(coordinates)
+
+    return ', '.join('({})'.format(format_wkt_points(ring)) for ring in coordinates)
+
+def geojson_geometry_wkt(geometry):
+    ''' Return WKT for a GeoJSON geometry, raise TypeError for NaN coordinates.
+
+        2D points, lines and polygons are formatted directly,
+        and anything else with Shapely.
+    '''
+    geom_type, coordinates = geometry.get('type'), geometry.get('coordinates')
+
+    try:
+        if geom_type == 'Point':
+            return 'POINT ({})'.format(format_wkt_points([coordinates]))
+        elif geom_type == 'MultiPoint':
+            return 'MULTIPOINT ({})'.format(format_wkt_points(coordinates))
+        elif geom_type == 'LineString':
+            return 'LINESTRING ({})'.format(format_wkt_points(coordinates))
+        elif geom_type == 'MultiLineString':
+            return 'MULTILINESTRING ({})'.format(format_wkt_rings(coordinates))
+        elif geom_type == 'Polygon':
+            return 'POLYGON ({})'.format(format_wkt_rings(coordinates))
+        elif geom_type == 'MultiPolygon' and type(coordinates) is list and coordinates:
+            return 'MULTIPOLYGON ({})'.format(', '.join('({})'.format(format_wkt_rings(polygon)) for polygon in coordinates))
+    except ValueError:
+        pass
+
+    if any((isinstance(g, float) and math.isnan(g)) for g in traverse(geometry)):
+        raise TypeError("Geometry has NaN coordinates")
+
+    return shape(geometry).wkt
+
+def get_host_semaphore(url, limit):
+    ''' Return a semaphore shared by all downloads from the host of a URL.
+    '''
+    host = urlparse(url).netloc
+
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(limit)
+
+        return _host_semaphores[host]
 
 class DownloadError(Exception):
     pass
 
+class DownloadNotModified(Exception):
+    ''' Source data is unchanged since it was last cached.
+    '''
+    pass
+
+
+class DownloadCache(FileStore):
+    ''' Shared on-disk cache of downloaded files, evicted least-recently-used first.
+
+        Entries are keyed on a URL and any request details, and remember
+        the response ETag and Last-Modified headers. Entries younger than
+        max_age seconds are used as-is, older ones only after revalidation.
+    '''
+    MAX_AGE = 3600
+    ENTRY_FILENAME = 'download.json'
+    TEMP_PREFIX = 'download-'
+    RESERVED_PREFIXES = ('partial-', 'lock-')
+
+    def __init__(self, dirname, max_size=None, max_age=None):
+        FileStore.__init__(self, dirname, max_size)
+        self.max_age = self.MAX_AGE if max_age is None else max_age
+
+    def key(self, url, **details):
+        ''' Return a key for a URL and request details like field names.
+        '''
+        return sha1(json.dumps([url, details], sort_keys=True).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        ''' Return a stored entry dictionary with a file path, or None.
+
+            Marks the entry as recently used.
+        '''
+        return self.get_entry(key)
+
+    def is_fresh(self, entry):
+        ''' Return true if an entry can be used without revalidation.
+        '''
+        return time.time() - entry['time'] < self.max_age
+
+    def refresh(self, key, entry):
+        ''' Mark an entry as revalidated just now.
+        '''
+        self.write_entry(key, dict(entry, time=time.time()))
+
+    def put(self, key, path, etag=None, last_modified=None, fingerprints={}):
+        ''' Store a downloaded file under a key, replacing any older download.
+        '''
+        self.put_entry(key, path, replace=True, time=time.time(), etag=etag,
+                       last_modified=last_modified, fingerprints=dict(fingerprints))
+
+    @contextmanager
+    def lock(self, key):
+        ''' Hold an exclusive lock on a key while it is downloaded.
+
+            Other processes sharing this cache wait for the lock, then
+            find the finished download already stored under the key.
+        '''
+        mkdirsp(self.dirname)
+
+        with open(os.path.join(self.dirname, 'lock-' + key), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def partial_path(self, key, file_path):
+        ''' Yield a lasting path to keep a partial download of file_path under a key.
+
+            Partial downloads kept here outlive the download's work directory,
+            so a later run can resume them. Yields file_path itself if another
+            process is already downloading the same key.
+        '''
+        partial_dir = os.path.join(self.dirname, 'partial-' + key)
+        mkdirsp(partial_dir)
+
+        with open(os.path.join(partial_dir, 'lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                _L.debug('Partial download {} is in use elsewhere'.format(key))
+                yield file_path
+            else:
+                # File names can vary between runs, the key is enough.
+                yield os.path.join(partial_dir, 'download' + splitext(file_path)[1])
 
 class DownloadTask(object):
 
-    def __init__(self, source_prefix, params={}, headers={}):
+    # Downloaded files are fingerprinted as they are written, see new_fingerprint()
+    FINGERPRINT_HASH = 'md5'
+
+    def __init__(self, source_prefix, params={}, headers={}, fingerprint_hash=None, download_cache=None):
         '''
 
             params: Additional query parameters, used by EsriRestDownloadTask.
             headers: Additional HTTP headers.
+            fingerprint_hash: Name of hash for fingerprints, "md5" or "blake2b".
+            download_cache: Optional DownloadCache shared with other tasks.
         '''
         self.source_prefix = source_prefix
         self.headers = {
@@ -129,29 +394,122 @@ class DownloadTask(object):
         self.headers.update(dict(**headers))
         self.query_params = dict(**params)
 
+        # ETag and Last-Modified response headers for each downloaded URL.
+        self.validators = dict()
+
+        # Fingerprint hex digests for each downloaded file path.
+        self.fingerprint_hash = fingerprint_hash or self.FINGERPRINT_HASH
+        self.fingerprints = dict()
+
+        self.download_cache = download_cache
+
 
     @classmethod
-    def from_protocol_string(clz, protocol_string, source_prefix=None):
+    def from_protocol_string(clz, protocol_string, source_prefix=None, fingerprint_hash=None, download_cache=None):
+        kwargs = dict(fingerprint_hash=fingerprint_hash, download_cache=download_cache)
+
         if protocol_string.lower() == 'http':
-            return URLDownloadTask(source_prefix)
+            return URLDownloadTask(source_prefix, **kwargs)
         elif protocol_string.lower() == 'file':
-            return URLDownloadTask(source_prefix)
+            return URLDownloadTask(source_prefix, **kwargs)
         elif protocol_string.lower() == 'ftp':
-            return URLDownloadTask(source_prefix)
+            return URLDownloadTask(source_prefix, **kwargs)
         elif protocol_string.lower() == 'esri':
-            return EsriRestDownloadTask(source_prefix)
+            return EsriRestDownloadTask(source_prefix, **kwargs)
         else:
             raise KeyError("I don't know how to extract for protocol {}".format(protocol_string))
 
+    def get_cached_download(self, source_url, **details):
+        ''' Return cache key and entry for a URL, or None for either.
+        '''
+        if self.download_cache is None:
+            return None, None
+
+        cache_key = self.download_cache.key(source_url, **details)
+        return cache_key, self.download_cache.get(cache_key)
+
+    def use_cached_download(self, source_url, entry, file_path):
+        ''' Put a file from the download cache in place, return its path.
+        '''
+        link_or_copy(entry['path'], file_path)
+        _L.info("Using cached download of %s for file %s", source_url, file_path)
+
+        self.validators[source_url] = entry['etag'], entry['last_modified']
+        self.fingerprints[file_path] = entry['fingerprints'].get(self.fingerprint_hash) \
+            or file_fingerprint(file_path, self.fingerprint_hash)
+
+        return file_path
+
+    def cache_download(self, cache_key, source_url, file_path):
+        ''' Store a newly-downloaded file in the download cache, if any.
+        '''
+        if self.download_cache is None or cache_key is None:
+            return
+
+        etag, last_modified = self.validators.get(source_url, (None, None))
+        fingerprints = {self.fingerprint_hash: self.fingerprints[file_path]}
+        self.download_cache.put(cache_key, file_path, etag, last_modified, fingerprints)
+
+    @contextmanager
+    def download_lock(self, source_url, **details):
+        ''' Hold the download cache lock for a URL and request details, if any.
+
+            Processes sharing a download cache download each URL only once.
+        '''
+        if self.download_cache is None:
+            yield
+            return
+
+        with self.download_cache.lock(self.download_cache.key(source_url, **details)):
+            yield
+
+    @contextmanager
+    def partial_download_path(self, cache_key, file_path):
+        ''' Yield a path to keep a partial download of file_path at.
+
+            Partial downloads are kept in the download cache if there is one,
+            otherwise next to file_path.
+        '''
+        if self.download_cache is None or cache_key is None:
+            yield file_path
+            return
+
+        with self.download_cache.partial_path(cache_key, file_path) as partial_path:
+            yield partial_path
+
     def download(self, source_urls, workdir, source_config):
         raise NotImplementedError()
 
-def guess_url_file_extension(url):
+def guess_url_file_extension(url, session=None):
     ''' Get a filename extension for a URL using various hints.
     '''
-    scheme, _, path, _, query, _ = urlparse(url)
-    mimetypes.add_type('application/x-zip-compressed', '.zip', False)
-    mimetypes.add_type('application/vnd.geo+json', '.json', False)
+    scheme, _, path, _, _, _ = urlparse(url)
+    path_ext = guess_url_path_extension(url)
+
+    if path_ext is not None:
+        return path_ext
+
+    #
+    # Get a dictionary of headers and a few bytes of content from the URL.
+    #
+    if scheme in ('http', 'https'):
+        response = request('GET', url, session=session, stream=True)
+        content_chunk = next(response.iter_content(MAGIC_BYTES), b'')
+        headers = response.headers
+        response.close()
+    elif scheme in ('file', ''):
+        headers = dict()
+        with open(path, 'rb') as file:
+            content_chunk = file.read(MAGIC_BYTES)
+    else:
+        raise ValueError('Unknown scheme "{}": {}'.format(scheme, url))
+
+    return guess_response_file_extension(url, headers, content_chunk)
+
+def guess_url_path_extension(url):
+    ''' Get a filename extension from a simple URL path, or None.
+    '''
+    _, _, path, _, query, _ = urlparse(url)
 
     _, likely_ext = os.path.splitext(path)
     bad_extensions = '', '.cgi', '.php', '.aspx', '.asp', '.do'
@@ -161,80 +519,155 @@ def guess_url_file_extension(url):
         # Trust simple URLs without meaningless filename extensions.
         #
         _L.debug(u'URL says "{}" for {}'.format(likely_ext, url))
-        path_ext = likely_ext
+        return likely_ext
+
+    return None
+
+def guess_response_file_extension(url, headers, content_chunk):
+    ''' Get a filename extension for a URL from response headers and first bytes.
+    '''
+    mimetypes.add_type('application/x-zip-compressed', '.zip', False)
+    mimetypes.add_type('application/vnd.geo+json', '.json', False)
+
+    path_ext = False
+
+    # Guess path extension from Content-Type header, unless it's a shrug.
+    content_type = headers.get('content-type', '').split(';')[0]
+
+    if content_type and content_type not in ('application/octet-stream', 'binary/octet-stream'):
+        _L.debug('Content-Type says "{}" for {}'.format(content_type, url))
+        path_ext = mimetypes.guess_extension(content_type, False)
 
-    else:
         #
-        # Get a dictionary of headers and a few bytes of content from the URL.
+        # Uh-oh, see if Content-Disposition disagrees with Content-Type.
+        # Socrata recently started using Content-Disposition instead
+        # of normal response headers so it's no longer easy to identify
+        # file type.
         #
-        if scheme in ('http', 'https'):
-            response = request('GET', url, stream=True)
-            content_chunk = next(response.iter_content(99))
-            headers = response.headers
-            response.close()
-        elif scheme in ('file', ''):
-            headers = dict()
-            with open(path) as file:
-                content_chunk = file.read(99)
-        else:
-            raise ValueError('Unknown scheme "{}": {}'.format(scheme, url))
-
-        path_ext = False
-
-        # Guess path extension from Content-Type header
-        if 'content-type' in headers:
-            content_type = headers['content-type'].split(';')[0]
-            _L.debug('Content-Type says "{}" for {}'.format(content_type, url))
-            path_ext = mimetypes.guess_extension(content_type, False)
-
-            #
-            # Uh-oh, see if Content-Disposition disagrees with Content-Type.
-            # Socrata recently started using Content-Disposition instead
-            # of normal response headers so it's no longer easy to identify
-            # file type.
-            #
-            if 'content-disposition' in headers:
-                pattern = r'attachment; filename=("?)(?P<filename>[^;]+)\1'
-                match = re.match(pattern, headers['content-disposition'], re.I)
-                if match:
-                    _, attachment_ext = splitext(match.group('filename'))
-                    if path_ext == attachment_ext:
-                        _L.debug('Content-Disposition agrees: "{}"'.format(match.group('filename')))
-                    else:
-                        _L.debug('Content-Disposition disagrees: "{}"'.format(match.group('filename')))
-                        path_ext = False
-
-        if not path_ext:
-            #
-            # Headers didn't clearly define a known extension.
-            # Instead, shell out to `file` to peek at the content.
-            #
-            mime_type = get_content_mimetype(content_chunk)
-            _L.debug('file says "{}" for {}'.format(mime_type, url))
-            path_ext = mimetypes.guess_extension(mime_type, False)
+        if 'content-disposition' in headers:
+            pattern = r'attachment; filename=("?)(?P<filename>[^;]+)\1'
+            match = re.match(pattern, headers['content-disposition'], re.I)
+            if match:
+                _, attachment_ext = splitext(match.group('filename'))
+                if path_ext == attachment_ext:
+                    _L.debug('Content-Disposition agrees: "{}"'.format(match.group('filename')))
+                else:
+                    _L.debug('Content-Disposition disagrees: "{}"'.format(match.group('filename')))
+                    path_ext = False
+
+    if not path_ext:
+        #
+        # Headers didn't clearly define a known extension.
+        # Instead, peek at the content.
+        #
+        mime_type = get_content_mimetype(content_chunk)
+        _L.debug('Content looks like "{}" for {}'.format(mime_type, url))
+        path_ext = mimetypes.guess_extension(mime_type, False)
+
+        if mime_type in ('text/html', 'application/pdf'):
+            _L.warning('Got {} instead of data from {}'.format(mime_type, url))
 
     return path_ext
 
+# Bytes of content needed by get_content_mimetype()
+MAGIC_BYTES = 1024
+
+# Leading bytes of binary file types, see also get_content_mimetype()
+binary_signatures = [
+    (b'PK\x03\x04', 'application/zip'),
+    (b'PK\x05\x06', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'BZh', 'application/x-bzip2'),
+    (b'\xfd7zXZ\x00', 'application/x-xz'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'\x00\x00\x27\x0a', 'application/x-esri-shape'),
+    (b'%PDF-', 'application/pdf'),
+    ]
+
+binary_characters = re.compile(b'[\x00-\x08\x0b\x0e-\x1a\x1c-\x1f\x7f]')
+
 def get_content_mimetype(chunk):
     ''' Get a mime-type for a short length of file content.
+
+        Recognizes archives and shapefiles by their leading bytes, and
+        sniffs text for HTML error pages, XML and GML, JSON, and CSV.
     '''
-    handle, file = mkstemp()
-    os.write(handle, chunk)
-    os.close(handle)
+    mimetypes.add_type('application/x-bzip2', '.bz2', False)
+    mimetypes.add_type('application/x-esri-shape', '.shp', False)
+    mimetypes.add_type('application/gml+xml', '.gml', False)
+
+    for (signature, mime_type) in binary_signatures:
+        if chunk.startswith(signature):
+            return mime_type
+
+    if chunk[257:262] == b'ustar':
+        return 'application/x-tar'
 
-    mime_type = check_output(('file', '--mime-type', '-b', file)).strip()
-    os.remove(file)
+    # Text has no control characters besides tabs and line breaks.
+    if binary_characters.search(chunk[:MAGIC_BYTES]):
+        return 'application/octet-stream'
 
-    return mime_type.decode('utf-8')
+    text = chunk[:MAGIC_BYTES].decode('utf-8-sig', errors='replace')
+    head = text.lstrip().lower()
+
+    if head.startswith('<'):
+        if head.startswith('<!doctype html') or '<html' in head:
+            return 'text/html'
+        elif 'gml' in head:
+            return 'application/gml+xml'
+        else:
+            return 'text/xml'
+
+    if head.startswith('{') or head.startswith('['):
+        return 'application/json'
+
+    first_line = head.split('\n', 1)[0]
+
+    if ',' in first_line or '\t' in first_line or ';' in first_line or '|' in first_line:
+        return 'text/csv'
+
+    return 'text/plain'
 
 class URLDownloadTask(DownloadTask):
-    CHUNK = 16 * 1024
+    CHUNK = 1024 * 1024
+    MAX_WORKERS = 4
 
-    def get_file_path(self, url, dir_path):
+    # Interrupted downloads are retried and resumed after BACKOFF seconds,
+    # doubling for each further attempt.
+    RETRIES = 3
+    BACKOFF = 2
+
+    # FTP data connections are opened by the server in passive mode.
+    FTP_PASSIVE = True
+
+    def __init__(self, source_prefix, params={}, headers={}, chunk_size=None, max_workers=None,
+                 fingerprint_hash=None, ftp_passive=None, download_cache=None):
+        '''
+
+            chunk_size: Bytes read from each response at a time.
+            max_workers: Most URLs downloaded at once.
+            ftp_passive: False to use active mode FTP.
+        '''
+        DownloadTask.__init__(self, source_prefix, params, headers, fingerprint_hash, download_cache)
+        self.chunk_size = chunk_size or self.CHUNK
+        self.max_workers = max_workers or self.MAX_WORKERS
+        self.ftp_passive = self.FTP_PASSIVE if ftp_passive is None else ftp_passive
+
+    def get_file_path(self, url, dir_path, session=None):
         ''' Return a local file path in a directory for a URL.
 
             May need to fill in a filename extension based on HTTP Content-Type.
         '''
+        file_base = self.get_file_base(url, dir_path)
+
+        path_ext = guess_url_file_extension(url, session)
+        _L.debug(u'Guessed {}{} for {}'.format(os.path.basename(file_base), path_ext, url))
+
+        return file_base + path_ext
+
+    def get_file_base(self, url, dir_path):
+        ''' Return a local file path in a directory for a URL, without extension.
+        '''
         scheme, host, path, _, _, _ = urlparse(url)
         path_base, _ = os.path.splitext(path)
 
@@ -246,53 +679,252 @@ class URLDownloadTask(DownloadTask):
             hash = sha1((host + path_base).encode('utf-8'))
             name_base = u'{}-{}'.format(self.source_prefix, hash.hexdigest()[:8])
 
-        path_ext = guess_url_file_extension(url)
-        _L.debug(u'Guessed {}{} for {}'.format(name_base, path_ext, url))
-
-        return os.path.join(dir_path, name_base + path_ext)
+        return os.path.join(dir_path, name_base)
 
     def download(self, source_urls, workdir, source_config):
-        output_files = []
+        ''' Download source URLs to workdir, return list of local file paths.
+
+            URLs are downloaded concurrently in up to max_workers threads,
+            sharing one requests.Session so connections to a host are reused.
+        '''
         download_path = os.path.join(workdir, 'http')
         mkdirsp(download_path)
 
-        for source_url in source_urls:
-            file_path = self.get_file_path(source_url, download_path)
+        # Fetch repeated URLs only once.
+        unique_urls = list(dict.fromkeys(source_urls))
+        max_workers = max(1, min(self.max_workers, len(unique_urls)))
 
-            # FIXME: For URLs with file:// scheme, simply copy the file
-            # to the expected location so that os.path.exists() returns True.
-            # Instead, implement a FileDownloadTask class?
-            scheme, _, path, _, _, _ = urlparse(source_url)
-            if scheme == 'file':
-                shutil.copy(path, file_path)
+        with requests.Session() as session, \
+             ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [util.submit_in_context(executor, self.download_url_once, url, download_path, session)
+                       for url in unique_urls]
+            file_paths = dict(zip(unique_urls, [future.result() for future in futures]))
 
-            if os.path.exists(file_path):
-                output_files.append(file_path)
-                _L.debug("File exists %s", file_path)
-                continue
+        return [file_paths[source_url] for source_url in source_urls]
+
+    def download_url_once(self, source_url, download_path, session=None):
+        ''' Download one source URL like download_url(), holding its download cache lock.
+        '''
+        with self.download_lock(source_url):
+            return self.download_url(source_url, download_path, session)
+
+    def download_url(self, source_url, download_path, session=None):
+        ''' Download one source URL to download_path, return local file path.
+
+            HTTP URLs without a telling filename extension are named
+            from the headers and first chunk of the download itself.
+        '''
+        scheme, _, path, _, _, _ = urlparse(source_url)
+        file_base = self.get_file_base(source_url, download_path)
+
+        if scheme in ('http', 'https') and guess_url_path_extension(source_url) is None:
+            file_path = None
+        else:
+            file_path = self.get_file_path(source_url, download_path, session)
+
+        # FIXME: For URLs with file:// scheme, simply copy the file
+        # to the expected location so that os.path.exists() returns True.
+        # Instead, implement a FileDownloadTask class?
+        if scheme == 'file':
+            shutil.copy(path, file_path)
+
+        if file_path is not None and os.path.exists(file_path):
+            _L.debug("File exists %s", file_path)
+            self.fingerprints[file_path] = file_fingerprint(file_path, self.fingerprint_hash)
+            return file_path
+
+        cache_key, entry = (None, None) if scheme == 'file' else self.get_cached_download(source_url)
+
+        if entry is not None:
+            cached_path = file_path or (file_base + splitext(entry['filename'])[1])
+
+            if self.download_cache.is_fresh(entry):
+                return self.use_cached_download(source_url, entry, cached_path)
+
+        # Revalidate a stale cached download, unless cache() is already
+        # revalidating previously-published source data.
+        revalidate = entry is not None and bool(entry['etag'] or entry['last_modified']) \
+            and not {'If-None-Match', 'If-Modified-Since'} & set(self.headers)
+
+        # Download to a partial file first, and resume it after failures.
+        part_path = (file_path or file_base) + '.part'
+        validator, error = None, None
+        fingerprint = new_fingerprint(self.fingerprint_hash)
+
+        for attempt in range(self.RETRIES + 1):
+            if attempt > 0:
+                delay = self.BACKOFF * 2 ** (attempt - 1)
+                _L.warning('Retrying %s in %s seconds after %s', source_url, delay, error)
+                time.sleep(delay)
+
+            headers = dict(self.headers)
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+            if offset and validator:
+                # Server sends the rest of the file only if it is unchanged.
+                headers.update({'Range': 'bytes={}-'.format(offset), 'If-Range': validator})
+            else:
+                offset = 0
+
+                if revalidate and entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if revalidate and entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
 
             try:
-                resp = request('GET', source_url, headers=self.headers, stream=True)
+                resp = request('GET', source_url, session=session, headers=headers,
+                               stream=True, ftp_passive=self.ftp_passive)
             except Exception as e:
-                raise DownloadError("Could not connect to URL", e)
+                error = DownloadError("Could not connect to URL", e)
+                continue
+
+            if resp.status_code == 304:
+                resp.close()
+
+                if revalidate:
+                    self.download_cache.refresh(cache_key, entry)
+                    return self.use_cached_download(source_url, entry, cached_path)
+
+                raise DownloadNotModified(source_url)
 
             if resp.status_code in range(400, 499):
                 raise DownloadError('{} response from {}'.format(resp.status_code, source_url))
 
-            size = 0
-            with open(file_path, 'wb') as fp:
-                for chunk in resp.iter_content(self.CHUNK):
-                    size += len(chunk)
-                    fp.write(chunk)
+            if resp.status_code in range(500, 599):
+                error = DownloadError('{} response from {}'.format(resp.status_code, source_url))
+                continue
+
+            if resp.status_code == 206 and not is_content_range_from(resp, offset):
+                resp.close()
+                validator = None
+                error = DownloadError('Unexpected Content-Range from {}'.format(source_url))
+                continue
 
-            output_files.append(file_path)
+            if resp.status_code != 206:
+                # Server sent the whole file.
+                offset = 0
+                fingerprint = new_fingerprint(self.fingerprint_hash)
 
-            _L.info("Downloaded %s bytes for file %s", size, file_path)
+            validator = get_range_validator(resp)
 
-        return output_files
+            try:
+                with open(part_path, 'ab' if offset else 'wb') as fp:
+                    for chunk in resp.iter_content(self.chunk_size):
+                        if file_path is None:
+                            file_path = file_base + guess_response_file_extension(source_url, resp.headers, chunk)
+                            _L.debug(u'Guessed {} for {}'.format(os.path.basename(file_path), source_url))
+
+                        fp.write(chunk)
+                        fingerprint.update(chunk)
+            except requests.exceptions.RequestException as e:
+                error = DownloadError('Interrupted download from {}'.format(source_url), e)
+                continue
+            finally:
+                resp.close()
+
+            break
+        else:
+            raise error
+
+        if file_path is None:
+            # Nothing was downloaded to peek at.
+            file_path = file_base + guess_response_file_extension(source_url, resp.headers, b'')
+
+        self.validators[source_url] = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+        self.fingerprints[file_path] = fingerprint.hexdigest()
+
+        move(part_path, file_path)
+        _L.info("Downloaded %s bytes for file %s", os.path.getsize(file_path), file_path)
 
+        self.cache_download(cache_key, source_url, file_path)
+
+        return file_path
+
+def get_range_validator(response):
+    ''' Return a validator for If-Range requests from a response, or None.
+
+        Weak ETags can't be used to resume a download, Last-Modified can.
+    '''
+    etag = response.headers.get('ETag')
+
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return response.headers.get('Last-Modified')
+
+def is_content_range_from(response, offset):
+    ''' Return true if a 206 response starts at the expected byte offset.
+    '''
+    content_range = response.headers.get('Content-Range', '')
+    return content_range.startswith('bytes {}-'.format(offset))
+
+
+class EsriFeatureWriter:
+    ''' Write ESRI features as CSV rows with a fixed column order.
+
+        Columns for feature property names are found once per name,
+        starting with the fields listed in layer metadata.
+    '''
+    def __init__(self, file, field_names, metadata, write_header=True):
+        self.field_names = field_names
+        self.geom_index = field_names.index(GEOM_FIELDNAME)
+        self.key_indexes = dict()
+
+        for field in metadata.get('fields') or []:
+            self.column_indexes(field['name'])
+
+        self.writer = csv.writer(file)
+
+        if write_header:
+            self.writer.writerow(field_names)
+
+    def column_indexes(self, key):
+        ''' Return a tuple of column indexes for a feature property name.
+        '''
+        if key not in self.key_indexes:
+            upper_key = key.upper()
+            self.key_indexes[key] = tuple(i for (i, name) in enumerate(self.field_names) if name == upper_key)
+
+        return self.key_indexes[key]
+
+    def writerow(self, feature):
+        ''' Write one feature, raise TypeError for missing or NaN geometry.
+        '''
+        geom = feature.get('geometry')
+
+        if not geom:
+            raise TypeError("No geometry parsed")
+
+        geom_wkt = geojson_geometry_wkt(geom)
+        row = [None] * len(self.field_names)
+
+        for (key, value) in (feature.get('properties') or {}).items():
+            for index in self.column_indexes(key):
+                row[index] = value
+
+        row[self.geom_index] = geom_wkt
+        self.writer.writerow(row)
 
 class EsriRestDownloadTask(DownloadTask):
+    # Large layers are downloaded in ranges of object IDs, each RANGE_PAGES
+    # pages long, in up to MAX_WORKERS threads. No more than MAX_HOST_REQUESTS
+    # ranges are requested from one host at once.
+    MAX_WORKERS = 4
+    MAX_HOST_REQUESTS = 2
+    RANGE_PAGES = 10
+
+    # Failed downloads resume from their last checkpoint after BACKOFF
+    # seconds, doubling for each further attempt.
+    RETRIES = 2
+    BACKOFF = 10
+
+    def __init__(self, source_prefix, params={}, headers={}, max_workers=None, fingerprint_hash=None, download_cache=None):
+        '''
+
+            max_workers: Most object ID ranges downloaded at once.
+        '''
+        DownloadTask.__init__(self, source_prefix, params, headers, fingerprint_hash, download_cache)
+        self.max_workers = max_workers or self.MAX_WORKERS
 
     def get_file_path(self, url, dir_path):
         ''' Return a local file path in a directory for a URL.
@@ -351,6 +983,104 @@ class EsriRestDownloadTask(DownloadTask):
         else:
             return None
 
+    def get_oid_min_max(self, source_url, oid_field_name):
+        ''' Return the smallest and largest object IDs in a layer.
+        '''
+        statistics = [
+            dict(statisticType='min', onStatisticField=oid_field_name, outStatisticFieldName='THE_MIN'),
+            dict(statisticType='max', onStatisticField=oid_field_name, outStatisticFieldName='THE_MAX'),
+            ]
+
+        params = dict(self.query_params, f='json', outFields='', outStatistics=json.dumps(statistics))
+        resp = request('GET', source_url + '/query', params=params, headers=self.headers)
+
+        try:
+            data = resp.json()
+            # Some servers name the attributes after their SQL statements.
+            values = [int(v) for v in data['features'][0]['attributes'].values()]
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise EsriDownloadError('Could not retrieve min/max object IDs', e)
+
+        return min(values), max(values)
+
+    def get_oid_ranges(self, source_url, metadata, row_count):
+        ''' Return a list of where clauses for ranges of object IDs, or None.
+
+            Layers that are small or can't report statistics return None,
+            and are downloaded serially.
+        '''
+        if self.max_workers < 2 or not row_count or not metadata.get('supportsStatistics'):
+            return None
+
+        oid_field_name = metadata.get('objectIdField')
+
+        for field in metadata.get('fields') or []:
+            if not oid_field_name and field.get('type') == 'esriFieldTypeOID':
+                oid_field_name = field['name']
+
+        page_size = min(1000, metadata.get('maxRecordCount') or 1000)
+        range_size = page_size * self.RANGE_PAGES
+
+        if not oid_field_name or row_count <= range_size:
+            return None
+
+        try:
+            oid_min, oid_max = self.get_oid_min_max(source_url, oid_field_name)
+        except EsriDownloadError:
+            _L.info("Source doesn't support min/max object IDs", exc_info=True)
+            return None
+
+        return [
+            '{0} > {1} AND {0} <= {2}'.format(oid_field_name, low, min(low + range_size, oid_max))
+            for low in range(oid_min - 1, oid_max, range_size)
+            ]
+
+    def download_oid_range(self, source_url, where):
+        ''' Return a list of features in one range of object IDs.
+        '''
+        with get_host_semaphore(source_url, self.MAX_HOST_REQUESTS):
+            _L.debug('Downloading features where {}'.format(where))
+            downloader = EsriDumper(source_url, parent_logger=_L, timeout=300,
+                                    extra_query_args={'where': where})
+            return list(downloader)
+
+    def iter_oid_ranges(self, source_url, oid_ranges):
+        ''' Generate lists of features from ranges of object IDs downloaded concurrently.
+
+            Lists are generated in the order of oid_ranges.
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+
+            try:
+                for where in oid_ranges:
+                    pending.append(util.submit_in_context(executor, self.download_oid_range, source_url, where))
+
+                    # Hold on to a limited number of finished ranges.
+                    if len(pending) >= self.max_workers * 2:
+                        yield pending.popleft().result()
+
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def write_features(writer, features):
+        ''' Write features with an EsriFeatureWriter, return number written.
+        '''
+        size = 0
+
+        for feature in features:
+            try:
+                writer.writerow(feature)
+                size += 1
+            except TypeError:
+                _L.debug("Skipping a geometry", exc_info=True)
+
+        return size
+
     def download(self, source_urls, workdir, source_config):
         output_files = []
         download_path = os.path.join(workdir, 'esri')
@@ -359,62 +1089,143 @@ class EsriRestDownloadTask(DownloadTask):
         query_fields = EsriRestDownloadTask.field_names_to_request(source_config)
 
         for source_url in source_urls:
-            size = 0
             file_path = self.get_file_path(source_url, download_path)
 
             if os.path.exists(file_path):
                 output_files.append(file_path)
                 _L.debug("File exists %s", file_path)
+                self.fingerprints[file_path] = file_fingerprint(file_path, self.fingerprint_hash)
                 continue
 
-            downloader = EsriDumper(source_url, parent_logger=_L, timeout=300)
+            with self.download_lock(source_url, fields=query_fields):
+                output_files.append(self.download_layer_once(source_url, file_path, query_fields))
 
-            metadata = downloader.get_metadata()
+        return output_files
 
-            if query_fields is None:
-                field_names = [f['name'] for f in metadata['fields']]
-            else:
-                field_names = query_fields[:]
+    def download_layer_once(self, source_url, file_path, query_fields):
+        ''' Download one ESRI layer, or reuse a fresh cached download, return its path.
+        '''
+        # ESRI services have no validators, so only fresh downloads are reused.
+        cache_key, entry = self.get_cached_download(source_url, fields=query_fields)
+
+        if entry is not None and self.download_cache.is_fresh(entry):
+            return self.use_cached_download(source_url, entry, file_path)
+
+        with self.partial_download_path(cache_key, file_path) as partial_path:
+            for attempt in range(self.RETRIES + 1):
+                try:
+                    self.download_layer(source_url, file_path, query_fields, partial_path)
+                except EsriDownloadError:
+                    # Only retry downloads with completed object ID ranges to resume from.
+                    if attempt == self.RETRIES or not os.path.exists(partial_path + '.checkpoint'):
+                        raise
+
+                    delay = self.BACKOFF * 2 ** attempt
+                    _L.warning('Resuming ESRI download of %s in %s seconds', source_url, delay, exc_info=True)
+                    time.sleep(delay)
+                else:
+                    break
+
+        self.cache_download(cache_key, source_url, file_path)
+        return file_path
 
-            if GEOM_FIELDNAME not in field_names:
-                field_names.append(GEOM_FIELDNAME)
+    def download_layer(self, source_url, file_path, query_fields, partial_path=None):
+        ''' Download one ESRI layer to a CSV file.
+
+            Writes to a partial file at partial_path, by default file_path,
+            checkpointing each completed range of object IDs. A later call
+            with the same partial path resumes after the last checkpoint.
+        '''
+        partial_path = partial_path or file_path
+        part_path, checkpoint_path = partial_path + '.part', partial_path + '.checkpoint'
+
+        downloader = EsriDumper(source_url, parent_logger=_L, timeout=300)
+
+        metadata = downloader.get_metadata()
+
+        if query_fields is None:
+            field_names = [f['name'] for f in metadata['fields']]
+        else:
+            field_names = query_fields[:]
 
-            field_names = list(map(lambda x: x.upper(), field_names))
+        if GEOM_FIELDNAME not in field_names:
+            field_names.append(GEOM_FIELDNAME)
+
+        field_names = list(map(lambda x: x.upper(), field_names))
+
+        checkpoint = None
+        if os.path.exists(part_path):
+            checkpoint = read_esri_checkpoint(checkpoint_path, source_url, field_names)
+
+        if checkpoint is not None:
+            oid_ranges, completed, offset, size = checkpoint
+            _L.info("Resuming after {} of {} object ID ranges".format(completed, len(oid_ranges)))
+        else:
+            completed, offset, size = 0, 0, 0
 
             # Get the count of rows in the layer
+            row_count = None
             try:
                 row_count = downloader.get_feature_count()
                 _L.info("Source has {} rows".format(row_count))
             except EsriDownloadError:
                 _L.info("Source doesn't support count")
 
-            with open(file_path, 'w', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=field_names)
-                writer.writeheader()
+            oid_ranges = self.get_oid_ranges(source_url, metadata, row_count)
 
-                for feature in downloader:
-                    try:
-                        geom = feature.get('geometry') or {}
-                        row = feature.get('properties') or {}
+        fingerprint = new_fingerprint(self.fingerprint_hash)
 
-                        if not geom:
-                            raise TypeError("No geometry parsed")
-                        if any((isinstance(g, float) and math.isnan(g)) for g in traverse(geom)):
-                            raise TypeError("Geometry has NaN coordinates")
+        if offset:
+            with open(part_path, 'rb') as f:
+                update_fingerprint(fingerprint, f, offset)
 
-                        shp = shape(feature['geometry'])
-                        row[GEOM_FIELDNAME] = shp.wkt
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            # Drop any rows written after the last checkpoint.
+            f.seek(offset)
+            f.truncate()
 
-                        r = dict()
-                        for k,v in row.items():
-                            r[k.upper()] =  v
-                        row = r
+            writer = EsriFeatureWriter(FingerprintWriter(f, fingerprint), field_names,
+                                       metadata, write_header=not offset)
 
-                        writer.writerow({fn: row.get(fn) for fn in field_names})
-                        size += 1
-                    except TypeError:
-                        _L.debug("Skipping a geometry", exc_info=True)
+            if oid_ranges is None:
+                size = self.write_features(writer, downloader)
+            else:
+                _L.info("Downloading {} object ID ranges in {} threads".format(len(oid_ranges) - completed, self.max_workers))
+                ranges_features = self.iter_oid_ranges(source_url, oid_ranges[completed:])
 
-            _L.info("Downloaded %s ESRI features for file %s", size, file_path)
-            output_files.append(file_path)
-        return output_files
+                for (completed, features) in enumerate(ranges_features, start=completed + 1):
+                    size += self.write_features(writer, features)
+                    f.flush()
+                    write_esri_checkpoint(checkpoint_path, source_url, field_names,
+                                          oid_ranges, completed, f.tell(), size)
+
+        self.fingerprints[file_path] = fingerprint.hexdigest()
+        move(part_path, file_path)
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        _L.info("Downloaded %s ESRI features for file %s", size, file_path)
+
+def read_esri_checkpoint(checkpoint_path, source_url, field_names):
+    ''' Return (object ID ranges, completed ranges, file offset, size) or None.
+
+        Checkpoints for another URL or different fields are ignored.
+    '''
+    try:
+        with open(checkpoint_path) as file:
+            checkpoint = json.load(file)
+    except (IOError, ValueError):
+        return None
+
+    if checkpoint.get('source_url') != source_url or checkpoint.get('field_names') != field_names:
+        return None
+
+    return checkpoint['oid_ranges'], checkpoint['completed'], checkpoint['offset'], checkpoint['size']
+
+def write_esri_checkpoint(checkpoint_path, source_url, field_names, oid_ranges, completed, offset, size):
+    ''' Record completed object ID ranges and partial file offset of a download.
+    '''
+    write_json_file(checkpoint_path, dict(source_url=source_url, field_names=field_names,
+                                          oid_ranges=oid_ranges, completed=completed,
+                                          offset=offset, size=size))
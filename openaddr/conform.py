@@ -11,14 +11,25 @@ import json
 import copy
 import csv
 import re
+import shutil
 import osgeo
+import io
+import math
+import tarfile
 
 from zipfile import ZipFile
+from functools import partial
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from locale import getpreferredencoding
+from subprocess import check_call, CalledProcessError, DEVNULL
 from os.path import splitext
-from hashlib import sha1
+from hashlib import sha1, md5
 from uuid import uuid4
 
+from . import util
+from .util import stream_openers, source_splitext, open_source_file
 from .sample import sample_geojson, stream_geojson
 
 from osgeo import ogr, osr, gdal
@@ -51,6 +62,12 @@ RESERVED_SCHEMA = ADDRESSES_SCHEMA + BUILDINGS_SCHEMA + PARCELS_SCHEMA + [
 
 UNZIPPED_DIRNAME = 'unzipped'
 
+# Number of extracted rows handed to each conform worker process at a time.
+CONFORM_CHUNK_SIZE = 10000
+
+# Number of CSV source rows buffered for each batch of point reprojections.
+REPROJECT_BATCH_SIZE = 1000
+
 geometry_types = {
     ogr.wkbPoint: 'Point',
     ogr.wkbPoint25D: 'Point 2.5D',
@@ -131,6 +148,16 @@ postfixed_street_with_units_pattern = re.compile("^(?:\s*(?:\d+(?:[ -]\d/\d)?|\d
 # - '# 3' from 'Main Street # 3'
 postfixed_unit_pattern = re.compile("\s((?:(?:UNIT|APARTMENT|APT\.?|SUITE|STE\.?|BUILDING|BLDG\.?|LOT)\s+|#).+)$", re.IGNORECASE)
 
+# extracts:
+# - '-122.3' and '39.1' from 'POINT (-122.3 39.1)'
+# - '-122.3' and '39.1' from 'POINT(-122.3 39.1)'
+# - nothing from 'POINT (nan nan)' or 'POLYGON ((...))'
+point_wkt_pattern = re.compile(r'^POINT ?\((-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) (-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\)$')
+
+# extracts:
+# - '1' and '2' from '$1-$2'
+format_var_pattern = re.compile('\$([0-9]+)')
+
 def mkdirsp(path):
     try:
         os.makedirs(path)
@@ -141,6 +168,29 @@ def mkdirsp(path):
             raise
 
 
+def format_point_wkt(x, y):
+    ''' Format a 2D point as WKT without creating an OGR geometry.
+    '''
+    # Adding zero turns negative zero into plain zero, as OGR does.
+    return 'POINT ({:.15g} {:.15g})'.format(x + 0., y + 0.)
+
+def geojson_point_xy(geometry):
+    ''' Return x and y for a plain 2D GeoJSON point geometry, or None.
+    '''
+    if geometry.get('type') != 'Point':
+        return None
+
+    coordinates = geometry.get('coordinates')
+
+    if type(coordinates) is not list or len(coordinates) != 2:
+        return None
+
+    for value in coordinates:
+        if type(value) not in (int, float) or not math.isfinite(value):
+            return None
+
+    return coordinates
+
 class ConformResult:
     processed = None
     sample = None
@@ -176,9 +226,69 @@ class ConformResult:
         return dict(processed=self.processed, sample=self.sample)
 
 
+class ConformStore(util.FileStore):
+    ''' Content-addressed store of previous conform results on disk.
+
+        Results are keyed on the cached source fingerprint, a hash of the
+        conform object and the code version. A changed source, conform or
+        release will conform afresh. Least-recently-used results are
+        evicted once the store grows past max_size bytes.
+    '''
+    ENTRY_FILENAME = 'conform.json'
+    TEMP_PREFIX = 'store-'
+
+    def key(self, source_config, fingerprint, version, compression=None):
+        ''' Return a key for a source fingerprint, code version and output compression.
+        '''
+        data_source = source_config.data_source
+        conform_hash = md5(json.dumps(dict(
+            layer=source_config.layer,
+            protocol=data_source.get('protocol'),
+            compression=data_source.get('compression'),
+            conform=data_source.get('conform'),
+            ), sort_keys=True).encode('utf8')).hexdigest()
+
+        return md5(json.dumps([fingerprint, conform_hash, version, compression]).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        ''' Return stored (path, sample, geometry type, address count), or None.
+
+            Marks the result as recently used.
+        '''
+        result = self.get_entry(key)
+
+        if result is None:
+            return None
+
+        return result['path'], result['sample'], result['geometry_type'], result['address_count']
+
+    def put(self, key, path, sample, geometry_type, address_count):
+        ''' Store a conform result under a key, then evict old results.
+
+            An existing result for the same key is kept.
+        '''
+        self.put_entry(key, path, sample=sample, geometry_type=geometry_type,
+                       address_count=address_count)
+
 class DecompressionError(Exception):
     pass
 
+def list_expanded_paths(expand_path):
+    ''' Return list of paths to files and .gdb directories in expand_path.
+    '''
+    output_files = []
+
+    for (dirpath, dirnames, filenames) in os.walk(expand_path):
+        for dirname in dirnames:
+            if os.path.splitext(dirname)[-1].lower() == '.gdb':
+                output_files.append(os.path.join(dirpath, dirname))
+                _L.debug("Expanded directory {}".format(output_files[-1]))
+        for filename in filenames:
+            output_files.append(os.path.join(dirpath, filename))
+            _L.debug("Expanded file {}".format(output_files[-1]))
+
+    return output_files
+
 class DecompressionTask(object):
     @classmethod
     def from_format_string(clz, format_string):
@@ -186,27 +296,159 @@ class DecompressionTask(object):
             return GuessDecompressTask()
         elif format_string.lower() == 'zip':
             return ZipDecompressTask()
+        elif format_string.lower() in ('gzip', 'gz'):
+            return StreamDecompressTask('.gz')
+        elif format_string.lower() in ('bzip2', 'bz2'):
+            return StreamDecompressTask('.bz2')
+        elif format_string.lower() == 'xz':
+            return StreamDecompressTask('.xz')
+        elif format_string.lower() in ('zstd', 'zst') and '.zst' in stream_openers:
+            return StreamDecompressTask('.zst')
+        elif format_string.lower() in ('tar', 'tar.gz', 'tgz', 'tar.bz2', 'tbz2', 'tar.xz', 'txz'):
+            return TarDecompressTask()
+        elif format_string.lower() == '7z':
+            return SevenZipDecompressTask()
         else:
             raise KeyError("I don't know how to decompress for format {}".format(format_string))
 
-    def decompress(self, source_paths):
+    def decompress(self, source_paths, workdir, filenames, data_source=None):
         raise NotImplementedError()
 
 
 class GuessDecompressTask(DecompressionTask):
     ''' Decompression task that tries to guess compression from file names.
     '''
-    def decompress(self, source_paths, workdir, filenames):
-        types = {type for (type, _) in map(mimetypes.guess_type, source_paths)}
+    def decompress(self, source_paths, workdir, filenames, data_source=None):
+        guesses = set(map(mimetypes.guess_type, source_paths))
+        types = {type for (type, _) in guesses}
+        encodings = {encoding for (_, encoding) in guesses}
 
         if types == {'application/zip'}:
             substitute_task = ZipDecompressTask()
             _L.info('Guessing zip compression based on file names')
-            return substitute_task.decompress(source_paths, workdir, filenames)
+            return substitute_task.decompress(source_paths, workdir, filenames, data_source)
+
+        if types == {'application/x-tar'}:
+            substitute_task = TarDecompressTask()
+            _L.info('Guessing tar compression based on file names')
+            return substitute_task.decompress(source_paths, workdir, filenames, data_source)
+
+        if types == {'application/x-7z-compressed'}:
+            substitute_task = SevenZipDecompressTask()
+            _L.info('Guessing 7z compression based on file names')
+            return substitute_task.decompress(source_paths, workdir, filenames, data_source)
+
+        if {splitext(path)[1].lower() for path in source_paths} == {'.zst'} and '.zst' in stream_openers:
+            substitute_task = StreamDecompressTask('.zst')
+            _L.info('Guessing zstd compression based on file names')
+            return substitute_task.decompress(source_paths, workdir, filenames, data_source)
+
+        if len(encodings) == 1 and encodings <= {'gzip', 'bzip2', 'xz'}:
+            _, ext = splitext(source_paths[0])
+            substitute_task = StreamDecompressTask(ext.lower())
+            _L.info('Guessing {} compression based on file names'.format(encodings.pop()))
+            return substitute_task.decompress(source_paths, workdir, filenames, data_source)
 
         _L.warning('Could not guess a single compression from file names')
         return source_paths
 
+class StreamDecompressTask(DecompressionTask):
+    ''' Decompression task for single files compressed with gzip, bzip2, xz, or zstd.
+
+        zstd needs the optional zstandard package, see util.stream_openers.
+
+        CSV and GeoJSON are read by Python straight from the compressed
+        stream, so they are linked into workdir and left compressed.
+    '''
+    format_exts = {'csv': '.csv', 'geojson': '.geojson'}
+
+    def __init__(self, ext):
+        self.ext = ext
+
+    def decompress(self, source_paths, workdir, filenames, data_source=None):
+        output_files = []
+        expand_path = os.path.join(workdir, UNZIPPED_DIRNAME)
+        mkdirsp(expand_path)
+
+        data_source = data_source or dict()
+        format_string = data_source.get('conform', {}).get('format')
+        is_streamed = format_string in self.format_exts and data_source.get('protocol') != 'ESRI'
+
+        for source_path in source_paths:
+            base, ext = splitext(os.path.basename(source_path))
+
+            if ext.lower() != self.ext:
+                _L.debug("Skipped uncompressed file {}".format(source_path))
+                output_files.append(source_path)
+                continue
+
+            # Downloaded files like "source-123abc.gz" lose their inner extension.
+            if not splitext(base)[1] and format_string in self.format_exts:
+                base += self.format_exts[format_string]
+
+            if is_streamed:
+                output_files.append(os.path.join(expand_path, base + ext))
+                util.link_or_copy(source_path, output_files[-1])
+            else:
+                output_files.append(os.path.join(expand_path, base))
+                with stream_openers[self.ext](source_path, 'rb') as input, \
+                     open(output_files[-1], 'wb') as output:
+                    shutil.copyfileobj(input, output, 1024**2)
+
+            _L.debug("Expanded file {}".format(output_files[-1]))
+
+        return output_files
+
+class TarDecompressTask(DecompressionTask):
+    def decompress(self, source_paths, workdir, filenames, data_source=None):
+        ''' Extract tar files into workdir, return list of extracted paths.
+
+            Tar files are read once as a stream, with gzip, bzip2, or xz
+            compression detected automatically.
+        '''
+        expand_path = os.path.join(workdir, UNZIPPED_DIRNAME)
+        mkdirsp(expand_path)
+
+        for source_path in source_paths:
+            with tarfile.open(source_path, 'r|*') as tar:
+                for member in tar:
+                    if not (member.isfile() or member.isdir()):
+                        _L.debug("Skipped special file {}".format(member.name))
+                        continue
+
+                    if os.path.isabs(member.name) or '..' in member.name.split('/'):
+                        _L.warning("Skipped unsafe file {}".format(member.name))
+                        continue
+
+                    if len(filenames) and not is_in(member.name, filenames):
+                        # Download only the named file, if any.
+                        _L.debug("Skipped file {}".format(member.name))
+                        continue
+
+                    tar.extract(member, expand_path)
+
+        return list_expanded_paths(expand_path)
+
+class SevenZipDecompressTask(DecompressionTask):
+    def decompress(self, source_paths, workdir, filenames, data_source=None):
+        ''' Extract 7z files into workdir with 7z command, return list of extracted paths.
+
+            Raises DecompressionError if 7z is missing or fails.
+        '''
+        expand_path = os.path.join(workdir, UNZIPPED_DIRNAME)
+        mkdirsp(expand_path)
+
+        for source_path in source_paths:
+            try:
+                check_call(('7z', 'x', '-y', '-o' + expand_path, source_path), stdout=DEVNULL)
+            except OSError as e:
+                raise DecompressionError('Could not run 7z for {}: {}'.format(source_path, e))
+            except CalledProcessError as e:
+                raise DecompressionError('7z failed for {} with status {}'.format(source_path, e.returncode))
+
+        return [path for path in list_expanded_paths(expand_path)
+                if not len(filenames) or is_in(os.path.relpath(path, expand_path), filenames)]
+
 def is_in(path, names):
     '''
     '''
@@ -222,13 +464,68 @@ def is_in(path, names):
 
     return False
 
+def select_zip_members(data_source, names, expand_path):
+    ''' Return chosen source name and names of zip members it needs, or None.
+
+        Picks the member find_source_path() would choose once extracted,
+        along with its sidecar files like a shapefile's .dbf and .shx,
+        or everything inside a chosen .gdb directory.
+    '''
+    if 'conform' not in data_source:
+        return None
+
+    member_paths = [os.path.join(expand_path, name) for name in names if not name.endswith('/')]
+
+    if not member_paths:
+        return None
+
+    source_path = find_source_path(data_source, member_paths)
+
+    if source_path is None:
+        return None
+
+    selected = os.path.relpath(source_path, expand_path)
+    selected_base = os.path.splitext(selected)[0].lower()
+    selected_dir = selected.lower() + '/'
+
+    return selected, [name for name in names
+                      if os.path.splitext(name)[0].lower() == selected_base
+                      or name.lower().startswith(selected_dir)]
+
+def is_virtual_zip_source(data_source, source_path, selected):
+    ''' Return true if OGR can read a selected zip member through /vsizip/.
+
+        Only OGR formats qualify; CSV and GeoJSON are read by Python. Names
+        needing normalize_ogr_filename_case() links are extracted instead.
+    '''
+    if data_source['conform'].get('format') not in ('shapefile', 'gdb', 'xml'):
+        return False
+
+    # find_source_path() trims GDB paths after the first ".gdb" it sees.
+    if '.gdb' in source_path.lower():
+        return False
+
+    _, ext = splitext(selected)
+    return ext == ext.lower()
+
+def zip_member_vsipath(source_path, name):
+    ''' Return a GDAL virtual path to a file or directory in a zip file.
+    '''
+    return '/vsizip/{}/{}'.format(os.path.abspath(source_path), name.rstrip('/'))
+
 class ZipDecompressTask(DecompressionTask):
-    def decompress(self, source_paths, workdir, filenames):
-        output_files = []
+    def decompress(self, source_paths, workdir, filenames, data_source=None):
+        ''' Extract zip files into workdir, return list of extracted paths.
+
+            With a data_source, only the members needed to conform it are
+            extracted if they can be found ahead of time. Shapefile, GDB and
+            GML members are not extracted at all, and returned as /vsizip/
+            paths for OGR to read in place.
+        '''
         expand_path = os.path.join(workdir, UNZIPPED_DIRNAME)
-        mkdirsp(expand_path)
 
-        # Extract contents of zip file into expand_path directory.
+        zip_members = []
+
         for source_path in source_paths:
             with ZipFile(source_path, 'r') as z:
                 for name in z.namelist():
@@ -237,19 +534,40 @@ class ZipDecompressTask(DecompressionTask):
                         _L.debug("Skipped file {}".format(name))
                         continue
 
-                    z.extract(name, expand_path)
+                    zip_members.append((source_path, name))
 
-        # Collect names of directories and files in expand_path directory.
-        for (dirpath, dirnames, filenames) in os.walk(expand_path):
-            for dirname in dirnames:
-                if os.path.splitext(dirname)[-1].lower() == '.gdb':
-                    output_files.append(os.path.join(dirpath, dirname))
-                    _L.debug("Expanded directory {}".format(output_files[-1]))
-            for filename in filenames:
-                output_files.append(os.path.join(dirpath, filename))
-                _L.debug("Expanded file {}".format(output_files[-1]))
+        if data_source is not None:
+            selection = select_zip_members(data_source, [name for (_, name) in zip_members], expand_path)
 
-        return output_files
+            if selection is not None:
+                selected, selected_names = selection[0], set(selection[1])
+                all_count = len(zip_members)
+                zip_members = [(path, name) for (path, name) in zip_members if name in selected_names]
+
+                if all(is_virtual_zip_source(data_source, path, selected) for (path, _) in zip_members):
+                    _L.info("Reading {} of {} files without extracting".format(len(zip_members), all_count))
+                    output_files = [zip_member_vsipath(path, name)
+                                    for (path, name) in zip_members if not name.endswith('/')]
+
+                    # List a chosen .gdb directory too, like os.walk() below.
+                    if splitext(selected)[1].lower() == '.gdb':
+                        output_files.insert(0, zip_member_vsipath(zip_members[0][0], selected))
+
+                    return output_files
+
+                _L.info("Extracting {} of {} files".format(len(zip_members), all_count))
+
+        mkdirsp(expand_path)
+
+        # Extract contents of zip file into expand_path directory.
+        for source_path in source_paths:
+            with ZipFile(source_path, 'r') as z:
+                for (member_path, name) in zip_members:
+                    if member_path == source_path:
+                        z.extract(name, expand_path)
+
+        # Collect names of directories and files in expand_path directory.
+        return list_expanded_paths(expand_path)
 
 class ExcerptDataTask(object):
     ''' Task for sampling three rows of data from datasource.
@@ -315,7 +633,7 @@ class ExcerptDataTask(object):
             return None, None
 
         data_path = known_paths[0]
-        _, data_ext = os.path.splitext(data_path.lower())
+        _, data_ext = source_splitext(data_path.lower())
 
         # Sample a few GeoJSON features to save on memory for large datasets.
         if data_ext in ('.geojson', '.json'):
@@ -370,7 +688,7 @@ class ExcerptDataTask(object):
 
         if format_string != 'csv' or 'file' not in conform:
             paths = [source_path for source_path in source_paths
-                     if os.path.splitext(source_path)[1].lower() in known_types]
+                     if source_splitext(source_path)[1].lower() in known_types]
 
             # If nothing was found or named but we expect a CSV, return first file.
             if not paths and format_string == 'csv' and 'file' not in conform:
@@ -403,7 +721,7 @@ class ExcerptDataTask(object):
     @staticmethod
     def _sample_geojson_file(data_path):
         # Sample a few GeoJSON features to save on memory for large datasets.
-        with open(data_path, 'r') as complete_layer:
+        with open_source_file(data_path, 'r') as complete_layer:
             temp_dir = os.path.dirname(data_path)
             _, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.json')
 
@@ -413,7 +731,7 @@ class ExcerptDataTask(object):
 
     @staticmethod
     def _excerpt_csv_file(data_path, encoding, csvsplit):
-        with open(data_path, 'r', encoding=encoding) as file:
+        with open_source_file(data_path, 'r', encoding=encoding) as file:
             input = csv.reader(file, delimiter=csvsplit)
             data_sample = [row for (row, _) in zip(input, range(6))]
 
@@ -465,6 +783,7 @@ def find_source_path(data_source, source_paths):
         conform = data_source["conform"]
     except KeyError:
         _L.warning('Source is missing a conform object')
+        util.report_source_problem(util.SourceProblem.missing_conform)
         raise
 
     format_string = conform.get('format')
@@ -498,7 +817,7 @@ def find_source_path(data_source, source_paths):
     elif format_string == "geojson" and protocol_string != "ESRI":
         candidates = []
         for fn in source_paths:
-            basename, ext = os.path.splitext(fn)
+            basename, ext = source_splitext(fn)
             if ext.lower() in (".json", ".geojson"):
                 candidates.append(fn)
         if len(candidates) == 0:
@@ -525,7 +844,7 @@ def find_source_path(data_source, source_paths):
             return None
         # See if a file has a CSV extension
         for fn in source_paths:
-            if os.path.splitext(fn)[1].lower() == '.csv':
+            if source_splitext(fn)[1].lower() == '.csv':
                 return fn
         # Nothing else worked so just return the first one.
         return source_paths[0]
@@ -571,13 +890,14 @@ def find_source_path(data_source, source_paths):
             return None
     else:
         _L.warning("Unknown source conform format %s", format_string)
+        util.report_source_problem(util.SourceProblem.unknown_conform_format)
         return None
 
 class ConvertToCsvTask(object):
     known_types = ('.shp', '.json', '.csv', '.kml', '.gdb')
 
-    def convert(self, source_config, source_paths, workdir):
-        "Convert a list of source_paths and write results in workdir"
+    def convert(self, source_config, source_paths, workdir, workers=1, compression=None, extract_to_file=False):
+        "Convert a list of source_paths and write results in workdir, optionally compressed"
         _L.debug("Converting to %s", workdir)
 
         # Create a subdirectory "converted" to hold results
@@ -588,11 +908,13 @@ class ConvertToCsvTask(object):
         # Find the source and convert it
         source_path = find_source_path(source_config.data_source, source_paths)
         if source_path is not None:
-            basename, ext = os.path.splitext(os.path.basename(source_path))
+            basename, ext = source_splitext(os.path.basename(source_path))
             dest_path = os.path.join(convert_path, basename + ".csv")
-            rc = conform_cli(source_config, source_path, dest_path)
+            if compression:
+                dest_path += util.output_compressions[compression]
+            rc = conform_cli(source_config, source_path, dest_path, extract_to_file, workers)
             if rc == 0:
-                with open(dest_path) as file:
+                with open_source_file(dest_path) as file:
                     addr_count = sum(1 for line in file) - 1
 
                 # Success! Return the path of the output CSV
@@ -631,6 +953,10 @@ def normalize_ogr_filename_case(source_path):
 
     normal_path = base + ext.lower()
 
+    if source_path.startswith('/vsi'):
+        # Files inside archives can't be linked, so use them as they are.
+        return normal_path if gdal.VSIStatL(normal_path) else source_path
+
     if os.path.exists(normal_path):
         # We appear to be on a case-insensitive filesystem.
         return normal_path
@@ -647,10 +973,31 @@ def normalize_ogr_filename_case(source_path):
 
     return normal_path
 
-# TODO rip out a bunch of this and replace with call to row_extract_and_reproject
+def write_source_rows(rows, dest_path):
+    ''' Write generated rows from one of the *_source_to_rows() functions to dest_path.
+
+        The first generated item is the list of field names for the CSV header.
+    '''
+    with open(dest_path, 'w', encoding='utf-8') as dest_fp:
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(dest_fp, fieldnames=row)
+                writer.writeheader()
+            else:
+                writer.writerow(row)
+
 def ogr_source_to_csv(source_config, source_path, dest_path):
     ''' Convert a single shapefile or GeoJSON in source_path and put it in dest_path
     '''
+    write_source_rows(ogr_source_to_rows(source_config, source_path), dest_path)
+
+# TODO rip out a bunch of this and replace with call to row_extract_and_reproject
+def ogr_source_to_rows(source_config, source_path):
+    ''' Generate rows from a single shapefile or GeoJSON in source_path.
+
+        Generates a list of field names first, then one dictionary per feature.
+    '''
     in_datasource = ogr.Open(source_path, 0)
     layer_id = source_config.data_source['conform'].get('layer', 0)
     if isinstance(layer_id, int):
@@ -705,52 +1052,60 @@ def ogr_source_to_csv(source_config, source_path, dest_path):
 
     coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
 
-    # Write a CSV file with one row per feature in the OGR source
-    with open(dest_path, 'w', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=out_fieldnames)
-        writer.writeheader()
-
-        in_feature = in_layer.GetNextFeature()
-        while in_feature:
-            row = dict()
-
-            for i in range(0, in_layer_defn.GetFieldCount()):
-                field_defn = in_layer_defn.GetFieldDefn(i)
-                field_value = in_feature.GetField(i)
-                if field_defn.type is ogr.OFTString:
-                    # Convert OGR's byte sequence strings to Python Unicode strings
-                    field_value = in_feature.GetFieldAsBinary(i).decode(shp_encoding)
-                row[field_defn.GetNameRef()] = field_value
-            geom = in_feature.GetGeometryRef()
-            if geom is not None:
-                geom.Transform(coordTransform)
-
-                if source_config.layer == "addresses":
-                    # For Addresses - Calculate the centroid on surface of the geometry and write it as X and Y columns
-                    try:
-                        centroid = geom.PointOnSurface()
-                    except RuntimeError as e:
-                        if 'Invalid number of points in LinearRing found' not in str(e):
-                            raise
-                        xmin, xmax, ymin, ymax = geom.GetEnvelope()
+    yield out_fieldnames
+
+    # Generate one row per feature in the OGR source
+    in_feature = in_layer.GetNextFeature()
+    while in_feature:
+        row = dict()
+
+        for i in range(0, in_layer_defn.GetFieldCount()):
+            field_defn = in_layer_defn.GetFieldDefn(i)
+            field_value = in_feature.GetField(i)
+            if field_defn.type is ogr.OFTString:
+                # Convert OGR's byte sequence strings to Python Unicode strings
+                field_value = in_feature.GetFieldAsBinary(i).decode(shp_encoding)
+            row[field_defn.GetNameRef()] = field_value
+        geom = in_feature.GetGeometryRef()
+        if geom is not None:
+            geom.Transform(coordTransform)
+
+            if source_config.layer == "addresses" and geom.GetGeometryType() == ogr.wkbPoint:
+                # A point is its own centroid
+                row[GEOM_FIELDNAME] = format_point_wkt(geom.GetX(), geom.GetY())
+            elif source_config.layer == "addresses":
+                # For Addresses - Calculate the centroid on surface of the geometry and write it as X and Y columns
+                try:
+                    centroid = geom.PointOnSurface()
+                except RuntimeError as e:
+                    if 'Invalid number of points in LinearRing found' not in str(e):
+                        raise
+                    xmin, xmax, ymin, ymax = geom.GetEnvelope()
 
-                        centroid = ogr.CreateGeometryFromWkt("POINT ({} {})".format(xmin/2 + xmax/2, ymin/2 + ymax/2))
+                    centroid = ogr.CreateGeometryFromWkt("POINT ({} {})".format(xmin/2 + xmax/2, ymin/2 + ymax/2))
 
-                    row[GEOM_FIELDNAME] = centroid.ExportToWkt()
-                else:
-                    row[GEOM_FIELDNAME] = geom.ExportToWkt()
+                row[GEOM_FIELDNAME] = centroid.ExportToWkt()
             else:
-                row[GEOM_FIELDNAME] = None
+                row[GEOM_FIELDNAME] = geom.ExportToWkt()
+        else:
+            row[GEOM_FIELDNAME] = None
 
-            writer.writerow(row)
+        yield row
 
-            in_feature.Destroy()
-            in_feature = in_layer.GetNextFeature()
+        in_feature.Destroy()
+        in_feature = in_layer.GetNextFeature()
 
     in_datasource.Destroy()
 
 def csv_source_to_csv(source_config, source_path, dest_path):
     "Convert a source CSV file to an intermediate form, coerced to UTF-8 and EPSG:4326"
+    write_source_rows(csv_source_to_rows(source_config, source_path), dest_path)
+
+def csv_source_to_rows(source_config, source_path):
+    ''' Generate rows from a source CSV file, reprojected to EPSG:4326.
+
+        Generates a list of field names first, then one dictionary per row.
+    '''
     _L.info("Converting source CSV %s", source_path)
 
     # Encoding processing tag
@@ -761,7 +1116,7 @@ def csv_source_to_csv(source_config, source_path, dest_path):
 
     # Extract the source CSV, applying conversions to deal with oddball CSV formats
     # Also convert encoding to utf-8 and reproject to EPSG:4326 in X and Y columns
-    with open(source_path, 'r', encoding=enc) as source_fp:
+    with open_source_file(source_path, 'r', encoding=enc) as source_fp:
         in_fieldnames = None   # in most cases, we let the csv module figure these out
 
         # headers processing tag
@@ -810,58 +1165,84 @@ def csv_source_to_csv(source_config, source_path, dest_path):
             out_fieldnames = [fn for fn in reader.fieldnames if fn not in old_latlon]
             out_fieldnames.append(GEOM_FIELDNAME)
 
-        # Write the extracted CSV file
-        with open(dest_path, 'w', encoding='utf-8') as dest_fp:
-            writer = csv.DictWriter(dest_fp, out_fieldnames)
-            writer.writeheader()
-            # For every row in the source CSV
-            row_number = 0
-            for source_row in reader:
-                row_number += 1
-                if len(source_row) != num_fields:
-                    _L.debug("Skipping row. Got %d columns, expected %d", len(source_row), num_fields)
-                    continue
-                try:
-                    out_row = row_extract_and_reproject(source_config, source_row)
-                except Exception as e:
-                    _L.error('Error in row {}: {}'.format(row_number, e))
-                    raise
-                else:
-                    writer.writerow(out_row)
+        yield out_fieldnames
+
+        # CSV sources in another SRS are reprojected a batch of rows at a time
+        reproject_batch = "srs" in source_config.data_source["conform"] and protocol_string != "ESRI"
+        out_rows = []
+
+        # For every row in the source CSV
+        row_number = 0
+        for source_row in reader:
+            row_number += 1
+            if len(source_row) != num_fields:
+                _L.debug("Skipping row. Got %d columns, expected %d", len(source_row), num_fields)
+                continue
+            try:
+                out_row = row_extract_and_reproject(source_config, source_row, not reproject_batch)
+            except Exception as e:
+                _L.error('Error in row {}: {}'.format(row_number, e))
+                raise
+
+            if not reproject_batch:
+                yield out_row
+                continue
+
+            out_rows.append(out_row)
+
+            if len(out_rows) >= REPROJECT_BATCH_SIZE:
+                yield from rows_reproject_batch(source_config, out_rows)
+                out_rows = []
+
+        if out_rows:
+            yield from rows_reproject_batch(source_config, out_rows)
 
 def geojson_source_to_csv(source_config, source_path, dest_path):
     '''
     '''
+    write_source_rows(geojson_source_to_rows(source_config, source_path), dest_path)
+
+def geojson_source_to_rows(source_config, source_path):
+    ''' Generate rows from a source GeoJSON file, streamed one feature at a time.
+
+        Generates a list of field names first, then one dictionary per feature.
+    '''
     # For every row in the source GeoJSON
-    with open(source_path) as file:
-        # Write the extracted CSV file
-        with open(dest_path, 'w', encoding='utf-8') as dest_fp:
-            writer = None
-            for (row_number, feature) in enumerate(stream_geojson(file)):
-                if writer is None:
-                    out_fieldnames = list(feature['properties'].keys())
-                    out_fieldnames.append(GEOM_FIELDNAME)
-                    writer = csv.DictWriter(dest_fp, out_fieldnames)
-                    writer.writeheader()
+    with open_source_file(source_path) as file:
+        out_fieldnames = None
+        for (row_number, feature) in enumerate(stream_geojson(file)):
+            if out_fieldnames is None:
+                out_fieldnames = list(feature['properties'].keys())
+                out_fieldnames.append(GEOM_FIELDNAME)
+                yield out_fieldnames
+
+            try:
+                row = feature['properties']
+                if feature['geometry'] is None:
+                    continue
 
-                try:
-                    row = feature['properties']
-                    if feature['geometry'] is None:
-                        continue
-                    geom = ogr.CreateGeometryFromJson(json.dumps(feature['geometry']))
-                    if not geom:
+                if source_config.layer == "addresses":
+                    # A point is its own centroid, and needs no OGR geometry
+                    point_xy = geojson_point_xy(feature['geometry'])
+                    if point_xy is not None:
+                        row.update({GEOM_FIELDNAME: format_point_wkt(*point_xy)})
+                        yield row
                         continue
 
-                    if source_config.layer == "addresses":
-                        # For Addresses - Calculate the centroid on surface of the geometry and write it as X and Y columns
-                        geom = geom.PointOnSurface()
+                geom = ogr.CreateGeometryFromJson(json.dumps(feature['geometry']))
+                if not geom:
+                    continue
 
-                except Exception as e:
-                    _L.error('Error in row {}: {}'.format(row_number, e))
-                    raise
-                else:
-                    row.update({GEOM_FIELDNAME: geom.ExportToWkt()})
-                    writer.writerow(row)
+                if source_config.layer == "addresses":
+                    # For Addresses - Calculate the centroid on surface of the geometry and write it as X and Y columns
+                    geom = geom.PointOnSurface()
+
+            except Exception as e:
+                _L.error('Error in row {}: {}'.format(row_number, e))
+                raise
+            else:
+                row.update({GEOM_FIELDNAME: geom.ExportToWkt()})
+                yield row
 
 _transform_cache = {}
 def _transform_to_4326(srs):
@@ -876,8 +1257,11 @@ def _transform_to_4326(srs):
         _transform_cache[srs] = osr.CoordinateTransformation(in_spatial_ref, out_spatial_ref)
     return _transform_cache[srs]
 
-def row_extract_and_reproject(source_config, source_row):
+def row_extract_and_reproject(source_config, source_row, reproject=True):
     ''' Find geometries in source CSV data and store it in ESPG:4326
+
+        With reproject=False the geometry is left in the source SRS, for
+        a later call to rows_reproject_batch() with a batch of rows.
     '''
     data_source = source_config.data_source
 
@@ -937,6 +1321,19 @@ def row_extract_and_reproject(source_config, source_row):
             out_row[GEOM_FIELDNAME] = None
             return out_row
 
+    if reproject:
+        source_geom = geometry_reproject_and_centroid(source_config, source_geom)
+
+    out_row[GEOM_FIELDNAME] = source_geom
+
+    # Add the reprojected data to the output CSV
+    return out_row
+
+def geometry_reproject_and_centroid(source_config, source_geom):
+    ''' Reproject a WKT geometry to EPSG:4326 if necessary, and find address centroids.
+    '''
+    data_source = source_config.data_source
+
     # Reproject the coordinates if necessary
     if "srs" in data_source["conform"]:
         try:
@@ -946,11 +1343,15 @@ def row_extract_and_reproject(source_config, source_row):
 
             source_geom = point.ExportToWkt()
         except (TypeError, ValueError) as e:
-            if not (source_x == "" or source_y == ""):
-                _L.debug("Could not reproject %s %s in SRS %s", source_x, source_y, srs)
+            _L.debug("Could not reproject %s in SRS %s", source_geom, srs)
 
     # For Addresses - Calculate the centroid on surface of the geometry and write it as X and Y columns
     if source_config.layer == "addresses":
+        match = point_wkt_pattern.match(source_geom or '')
+        if match:
+            # A point is its own centroid
+            return format_point_wkt(float(match.group(1)), float(match.group(2)))
+
         geom = ogr.CreateGeometryFromWkt(source_geom)
 
         try:
@@ -964,69 +1365,132 @@ def row_extract_and_reproject(source_config, source_row):
 
         source_geom = centroid.ExportToWkt()
 
-    out_row[GEOM_FIELDNAME] = source_geom
+    return source_geom
 
-    # Add the reprojected data to the output CSV
-    return out_row
+def rows_reproject_batch(source_config, out_rows):
+    ''' Reproject geometries in a list of rows from row_extract_and_reproject().
+
+        Plain points are transformed together with a single TransformPoints()
+        call, and anything else is handed to geometry_reproject_and_centroid().
+    '''
+    srs = source_config.data_source["conform"]["srs"]
+    indexes, points, transformed = [], [], []
+
+    for (index, out_row) in enumerate(out_rows):
+        match = point_wkt_pattern.match(out_row[GEOM_FIELDNAME] or '')
+        if match:
+            indexes.append(index)
+            points.append((float(match.group(1)), float(match.group(2))))
+
+    if points:
+        try:
+            transformed = _transform_to_4326(srs).TransformPoints(points)
+        except (RuntimeError, TypeError, ValueError):
+            _L.debug("Could not reproject a batch of %d points in SRS %s", len(points), srs)
+
+    reprojected = set()
+
+    for (index, (x, y, *_)) in zip(indexes, transformed):
+        if not (math.isfinite(x) and math.isfinite(y)):
+            continue
+
+        # Use OGR to write the WKT so coordinates are formatted as before.
+        # A point is its own centroid, so addresses need nothing more.
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        out_rows[index][GEOM_FIELDNAME] = point.ExportToWkt()
+        reprojected.add(index)
+
+    for (index, out_row) in enumerate(out_rows):
+        if index not in reprojected and out_row[GEOM_FIELDNAME] is not None:
+            out_row[GEOM_FIELDNAME] = geometry_reproject_and_centroid(source_config, out_row[GEOM_FIELDNAME])
+
+    return out_rows
 
 
 def row_function(sc, row, key, fxn):
-    function = fxn["function"]
-    if function == "join":
-        row = row_fxn_join(sc, row, key, fxn)
-    elif function == "regexp":
-        row = row_fxn_regexp(sc, row, key, fxn)
-    elif function == "format":
-        row = row_fxn_format(sc, row, key, fxn)
-    elif function == "prefixed_number":
-        row = row_fxn_prefixed_number(sc, row, key, fxn)
-    elif function == "postfixed_street":
-        row = row_fxn_postfixed_street(sc, row, key, fxn)
-    elif function == "postfixed_unit":
-        row = row_fxn_postfixed_unit(sc, row, key, fxn)
-    elif function == "remove_prefix":
-        row = row_fxn_remove_prefix(sc, row, key, fxn)
-    elif function == "remove_postfix":
-        row = row_fxn_remove_postfix(sc, row, key, fxn)
-    elif function == "chain":
-        row = row_fxn_chain(sc, row, key, fxn)
-    elif function == "first_non_empty":
-        row = row_fxn_first_non_empty(sc, row, key, fxn)
+    function = row_functions.get(fxn["function"])
+    if function is not None:
+        row = function(sc, row, key, fxn)
 
     return row
 
+class ConformPlan:
+    ''' Conform object compiled once per source and applied to each row.
 
+        Binds the row functions named in the conform object to their keys
+        and arguments, with regexps and format strings compiled, and works
+        out output field names ahead of time so that transform() does not
+        need to re-interpret the conform JSON. Compiled forms live only as
+        long as the plan.
+    '''
+    def __init__(self, source_config):
+        self.source_config = source_config
+        self.steps = []
 
-### Row-level conform code. Inputs and outputs are individual rows in a CSV file.
-### The input row may or may not be modified in place. The output row is always returned.
-def row_transform_and_convert(source_config, row):
-    "Apply the full conform transform and extract operations to a row"
+        c = source_config.data_source["conform"]
 
-    # Some conform specs have fields named with a case different from the source
-    row = row_smash_case(source_config.data_source, row)
+        "Attribute tags can utilize processing fxns"
+        for k, v in c.items():
+            if k.upper() in source_config.SCHEMA and type(v) is list:
+                "Lists are a concat shortcut to concat fields with spaces"
+                self.steps.append(partial(row_merge, source_config, key=k))
+            if k.upper() in source_config.SCHEMA and type(v) is dict:
+                "Dicts are custom processing functions"
+                if row_functions.get(v["function"]) is not None:
+                    self.steps.append(partial(self.bind_function(v), key=k))
 
-    c = source_config.data_source["conform"]
+        self.out_fields = conform_out_fields(source_config)
 
-    "Attribute tags can utilize processing fxns"
-    for k, v in c.items():
-        if k.upper() in source_config.SCHEMA and type(v) is list:
-            "Lists are a concat shortcut to concat fields with spaces"
-            row = row_merge(source_config, row, k)
-        if k.upper() in source_config.SCHEMA and type(v) is dict:
-            "Dicts are custom processing functions"
-            row = row_function(source_config, row, k, v)
+        # Make up a random fingerprint if none exists
+        self.fingerprint = source_config.data_source.get('fingerprint', str(uuid4()))
 
-    # Make up a random fingerprint if none exists
-    cache_fingerprint = source_config.data_source.get('fingerprint', str(uuid4()))
+    def bind_function(self, fxn):
+        ''' Return a row function for a conform function, to call with row and key.
+        '''
+        function = row_functions.get(fxn["function"])
 
-    row = row_convert_to_out(source_config, row)
+        if function is row_fxn_regexp:
+            compiled = compile_regexp_fxn(fxn.get("pattern", False), fxn.get('replace', False))
+            return partial(row_fxn_regexp, self.source_config, fxn=fxn, compiled=compiled)
 
-    if source_config.layer == "addresses":
-        row = row_canonicalize_unit_and_number(source_config.data_source, row)
-        row = row_round_lat_lon(source_config.data_source, row)
+        if function is row_fxn_format:
+            compiled = compile_format_string(fxn["format"])
+            return partial(row_fxn_format, self.source_config, fxn=fxn, compiled=compiled)
 
-    row = row_calculate_hash(cache_fingerprint, row)
-    return row
+        if function is row_fxn_chain:
+            functions = [self.bind_function(sub_fxn) for sub_fxn in fxn["functions"]]
+            return partial(row_fxn_chain, self.source_config, fxn=fxn, functions=functions)
+
+        return partial(row_function, self.source_config, fxn=fxn)
+
+    def transform(self, row):
+        "Apply the full conform transform and extract operations to a row"
+
+        # Some conform specs have fields named with a case different from the source
+        row = row_smash_case(self.source_config.data_source, row)
+
+        for step in self.steps:
+            row = step(row)
+
+        row = row_convert_to_out(self.source_config, row, self.out_fields)
+
+        if self.source_config.layer == "addresses":
+            row = row_canonicalize_unit_and_number(self.source_config.data_source, row)
+            row = row_round_lat_lon(self.source_config.data_source, row)
+
+        row = row_calculate_hash(self.fingerprint, row)
+        return row
+
+### Row-level conform code. Inputs and outputs are individual rows in a CSV file.
+### The input row may or may not be modified in place. The output row is always returned.
+def row_transform_and_convert(source_config, row):
+    ''' Apply the full conform transform and extract operations to a row.
+
+        Compiles the conform object for just this row; use ConformPlan
+        directly to transform many rows from the same source.
+    '''
+    return ConformPlan(source_config).transform(row)
 
 def fxn_smash_case(fxn):
     if "field" in fxn:
@@ -1087,12 +1551,15 @@ def row_fxn_join(sc, row, key, fxn):
         _L.debug("Failure to merge row %r %s", e, row)
     return row
 
-def row_fxn_regexp(sc, row, key, fxn):
+def compile_regexp_fxn(pattern, replace):
+    "Compile a regexp function pattern and replace string, see ConformPlan"
+    return re.compile(pattern), (convert_regexp_replace(replace) if replace else replace)
+
+def row_fxn_regexp(sc, row, key, fxn, compiled=None):
     "Split addresses like '123 Maple St' into '123' and 'Maple St'"
-    pattern = re.compile(fxn.get("pattern", False))
-    replace = fxn.get('replace', False)
+    pattern, replace = compiled or compile_regexp_fxn(fxn.get("pattern", False), fxn.get('replace', False))
     if replace:
-        match = re.sub(pattern, convert_regexp_replace(replace), row[fxn["field"]])
+        match = pattern.sub(replace, row[fxn["field"]])
         row["oa:{}".format(key)] = match;
     else:
         match = pattern.search(row[fxn["field"]])
@@ -1147,27 +1614,36 @@ def row_fxn_remove_postfix(sc, row, key, fxn):
 
     return row
 
-def row_fxn_format(sc, row, key, fxn):
-    "Format multiple fields using a user-specified format string"
-    format_var_pattern = re.compile('\$([0-9]+)')
+def compile_format_string(format_str):
+    ''' Parse a format function template, see ConformPlan.
+
+        Return a list of (preceding text, field index) tuples for each
+        $-variable in the format string, and the text after the last one.
+    '''
+    parts, idx = [], 0
+
+    for m in format_var_pattern.finditer(format_str):
+        start, end = m.span()
+        parts.append((format_str[idx:start], int(m.group(1))))
+        idx = end
+
+    return parts, format_str[idx:]
 
+def row_fxn_format(sc, row, key, fxn, compiled=None):
+    "Format multiple fields using a user-specified format string"
     fields = [(row[n] or u'').strip() for n in fxn["fields"]]
 
     parts = []
 
-    idx = 0
     num_fields_added = 0
 
-    format_str = fxn["format"]
-    for i, m in enumerate(format_var_pattern.finditer(format_str)):
-        field_idx = int(m.group(1))
-        start, end = m.span()
-
+    format_parts, format_tail = compiled or compile_format_string(fxn["format"])
+    for i, (preceding, field_idx) in enumerate(format_parts):
         if field_idx > 0 and field_idx - 1 < len(fields):
             field = fields[field_idx - 1]
 
-            if idx == 0 or (num_fields_added > 0 and field):
-                parts.append(format_str[idx:start])
+            if i == 0 or (num_fields_added > 0 and field):
+                parts.append(preceding)
 
             if field:
                 # if the value being added ends with '.0', remove it
@@ -1181,18 +1657,19 @@ def row_fxn_format(sc, row, key, fxn):
                 parts.append(field)
                 num_fields_added += 1
 
-        idx = end
-
     if num_fields_added > 0:
-        parts.append(format_str[idx:])
+        parts.append(format_tail)
         row["oa:{}".format(key)] = u''.join(parts)
     else:
         row["oa:{}".format(key)] = u''
 
     return row
 
-def row_fxn_chain(sc, row, key, fxn):
-    functions = fxn["functions"]
+def row_fxn_chain(sc, row, key, fxn, functions=None):
+    "Apply a list of functions in turn, optionally bound with ConformPlan.bind_function()"
+    if functions is None:
+        functions = [partial(row_function, sc, fxn=sub_fxn) for sub_fxn in fxn["functions"]]
+
     var = fxn.get("variable")
 
     original_key = key
@@ -1201,8 +1678,8 @@ def row_fxn_chain(sc, row, key, fxn):
         row['oa:' + var] = u''
         key = var
 
-    for func in functions:
-        row = row_function(sc, row, key, func)
+    for function in functions:
+        row = function(row, key=key)
 
         if row.get('oa:' + key):
             row[key] = row['oa:' + key]
@@ -1220,6 +1697,19 @@ def row_fxn_first_non_empty(sc, row, key, fxn):
 
     return row
 
+row_functions = {
+    "join": row_fxn_join,
+    "regexp": row_fxn_regexp,
+    "format": row_fxn_format,
+    "prefixed_number": row_fxn_prefixed_number,
+    "postfixed_street": row_fxn_postfixed_street,
+    "postfixed_unit": row_fxn_postfixed_unit,
+    "remove_prefix": row_fxn_remove_prefix,
+    "remove_postfix": row_fxn_remove_postfix,
+    "chain": row_fxn_chain,
+    "first_non_empty": row_fxn_first_non_empty,
+}
+
 def row_canonicalize_unit_and_number(sc, row):
     "Canonicalize address unit and number"
     row["UNIT"] = (row["UNIT"] or '').strip()
@@ -1239,6 +1729,17 @@ def _round_wgs84_to_7(n):
 def row_round_lat_lon(sc, row):
     "Round WGS84 coordinates to 1cm precision"
     if row.get('GEOM') is not None and 'POINT' in row['GEOM']:
+        match = point_wkt_pattern.match(row['GEOM'])
+        if match:
+            x = _round_wgs84_to_7(match.group(1))
+            y = _round_wgs84_to_7(match.group(2))
+
+            # Rounded plain decimals come out of OGR unchanged, except for
+            # negative zero. Let OGR decide how to write exponents.
+            if 'e' not in x and 'e' not in y:
+                row['GEOM'] = 'POINT ({} {})'.format('0' if x == '-0' else x, '0' if y == '-0' else y)
+                return row
+
         try:
             geom = ogr.CreateGeometryFromWkt(row['GEOM'])
             x = _round_wgs84_to_7(geom.GetX())
@@ -1261,23 +1762,38 @@ def row_calculate_hash(cache_fingerprint, row):
 
     return row
 
-def row_convert_to_out(source_config, row):
+def conform_out_fields(source_config):
+    ''' Return a list of output field names with their lowercase oa: and conform names.
+    '''
+    out_fields = []
+
+    for field in source_config.SCHEMA:
+        cfield = source_config.data_source['conform'].get(field.lower())
+        if hasattr(cfield, 'lower'):
+            cfield = cfield.lower()
+        out_fields.append((field, 'oa:{}'.format(field.lower()), cfield))
+
+    return out_fields
+
+def row_convert_to_out(source_config, row, out_fields=None):
     "Convert a row from the source schema to OpenAddresses output schema"
 
+    if out_fields is None:
+        out_fields = conform_out_fields(source_config)
+
     output = {
         "GEOM": row.get(GEOM_FIELDNAME.lower(), None),
     }
 
-    for field in source_config.SCHEMA:
-        if row.get('oa:{}'.format(field.lower())) is not None:
+    for (field, oa_field, cfield) in out_fields:
+        if row.get(oa_field) is not None:
             # If there is an OA prefix, it is not a native field and was compiled
             # via an attrib funciton or concatentation
-            output[field] = row.get('oa:{}'.format(field.lower()))
+            output[field] = row.get(oa_field)
         else:
             # Get a native field as specified in the conform object
-            cfield = source_config.data_source['conform'].get(field.lower())
             if cfield:
-                output[field] = row.get(cfield.lower())
+                output[field] = row.get(cfield)
             else:
                 output[field] = ''
 
@@ -1293,50 +1809,160 @@ def extract_to_source_csv(source_config, source_path, extract_path):
     The extracted file will be in UTF-8 and will have X and Y columns corresponding
     to longitude and latitude in EPSG:4326.
     """
+    write_source_rows(extract_to_source_rows(source_config, source_path), extract_path)
+
+def extract_to_source_rows(source_config, source_path):
+    """Extract arbitrary downloaded sources to a stream of rows in the source schema.
+    source_config: description of the source, containing the conform object
+
+    Generates a list of field names first, then one dictionary per row with
+    string values exactly as they would be read back from an extracted CSV file.
+    """
     format_string = source_config.data_source["conform"]['format']
     protocol_string = source_config.data_source['protocol']
 
     if format_string in ("shapefile", "xml", "gdb"):
         ogr_source_path = normalize_ogr_filename_case(source_path)
-        ogr_source_to_csv(source_config, ogr_source_path, extract_path)
+        rows = ogr_source_to_rows(source_config, ogr_source_path)
     elif format_string == "csv":
-        csv_source_to_csv(source_config, source_path, extract_path)
+        rows = csv_source_to_rows(source_config, source_path)
     elif format_string == "geojson":
         # GeoJSON sources have some awkward legacy with ESRI, see issue #34
         if protocol_string == "ESRI":
             _L.info("ESRI GeoJSON source found; treating it as CSV")
-            csv_source_to_csv(source_config, source_path, extract_path)
+            rows = csv_source_to_rows(source_config, source_path)
         else:
             _L.info("Non-ESRI GeoJSON source found; converting as a stream.")
             geojson_source_path = normalize_ogr_filename_case(source_path)
-            geojson_source_to_csv(source_config, geojson_source_path, extract_path)
+            rows = geojson_source_to_rows(source_config, geojson_source_path)
     else:
         raise Exception("Unsupported source format %s" % format_string)
 
-def transform_to_out_csv(source_config, extract_path, dest_path):
+    return stringify_source_rows(rows)
+
+def stringify_source_rows(rows):
+    ''' Convert generated source rows to the strings csv.DictReader would return.
+
+        Matches a round trip through csv.DictWriter and csv.DictReader, so that
+        streamed rows and rows read from an extracted CSV file are identical.
+    '''
+    fieldnames = None
+
+    for row in rows:
+        if fieldnames is None:
+            fieldnames = row
+            yield fieldnames
+            continue
+
+        wrong_fields = row.keys() - fieldnames
+        if wrong_fields:
+            raise ValueError("dict contains fields not in fieldnames: "
+                             + ", ".join([repr(x) for x in wrong_fields]))
+
+        out_row = dict()
+        for name in fieldnames:
+            value = row.get(name)
+            if value is None:
+                value = ''
+            elif type(value) is not str:
+                value = str(value)
+            if '\r' in value:
+                # Universal newlines in a text-mode CSV reader
+                value = value.replace('\r\n', '\n').replace('\r', '\n')
+            out_row[name] = value
+
+        yield out_row
+
+def transform_to_out_csv(source_config, extract_path, dest_path, workers=1):
     ''' Transform an extracted source CSV to the OpenAddresses output CSV by applying conform rules.
 
         source_config: description of the source, containing the conform object
         extract_path: extracted CSV file to process
-        dest_path: path for output file in OpenAddress CSV
+        dest_path: path for output file in OpenAddress CSV, compressed if named like .csv.gz
+        workers: number of processes to transform rows with
     '''
-    # Convert all field names in the conform spec to lower case
-    source_config.data_source = conform_smash_case(source_config.data_source)
-
     # Read through the extract CSV
     with open(extract_path, 'r', encoding='utf-8') as extract_fp:
         reader = csv.DictReader(extract_fp)
-        # Write to the destination CSV
-        with open(dest_path, 'w', encoding='utf-8') as dest_fp:
-            writer = csv.DictWriter(dest_fp, ['GEOM', 'HASH', *source_config.SCHEMA])
-            writer.writeheader()
+        transform_rows_to_out_csv(source_config, reader, dest_path, workers)
+
+def transform_rows_to_out_csv(source_config, extract_rows, dest_path, workers=1):
+    ''' Transform extracted source rows to the OpenAddresses output CSV by applying conform rules.
+
+        source_config: description of the source, containing the conform object
+        extract_rows: iterable of extracted row dictionaries to process
+        dest_path: path for output file in OpenAddress CSV, compressed if named like .csv.gz
+        workers: number of processes to transform rows with
+    '''
+    # Convert all field names in the conform spec to lower case. Streamed
+    # rows are still being extracted with the original, so work on a copy.
+    source_config = copy.copy(source_config)
+    source_config.data_source = conform_smash_case(source_config.data_source)
+
+    conform_plan = ConformPlan(source_config)
+    out_fieldnames = ['GEOM', 'HASH', *source_config.SCHEMA]
+
+    # Write to the destination CSV, compressed if its name says so
+    with util.open_output_file(dest_path, 'w', encoding='utf-8') as dest_fp:
+        writer = csv.DictWriter(dest_fp, out_fieldnames)
+        writer.writeheader()
+
+        if workers > 1:
+            _L.info("Transforming rows with %d worker processes", workers)
+            for out_chunk in transform_rows_in_parallel(conform_plan, out_fieldnames, extract_rows, workers):
+                dest_fp.write(out_chunk)
+        else:
             # For every row in the extract
-            for extract_row in reader:
-                out_row = row_transform_and_convert(source_config, extract_row)
+            for extract_row in extract_rows:
+                out_row = conform_plan.transform(extract_row)
                 writer.writerow(out_row)
 
-def conform_cli(source_config, source_path, dest_path):
-    "Command line entry point for conforming a downloaded source to an output CSV."
+_worker_conform_plan = None
+
+def _init_conform_worker(conform_plan):
+    "Hold on to a conform plan for the life of a worker process"
+    global _worker_conform_plan
+    _worker_conform_plan = conform_plan
+
+def _transform_rows_chunk(out_fieldnames, extract_rows):
+    "Transform a chunk of extracted rows in a worker process, return CSV text"
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, out_fieldnames)
+
+    for extract_row in extract_rows:
+        writer.writerow(_worker_conform_plan.transform(extract_row))
+
+    return buffer.getvalue()
+
+def transform_rows_in_parallel(conform_plan, out_fieldnames, extract_rows, workers, chunk_size=CONFORM_CHUNK_SIZE):
+    ''' Transform extracted rows in a pool of worker processes.
+
+        Generates output CSV text for each chunk of chunk_size rows, in
+        the original row order. The whole plan is sent to each worker so
+        that a made-up fingerprint and row hashes match the serial path.
+    '''
+    extract_rows = iter(extract_rows)
+    pending = deque()
+
+    with ProcessPoolExecutor(workers, initializer=_init_conform_worker, initargs=(conform_plan, )) as executor:
+        for chunk in iter(lambda: list(islice(extract_rows, chunk_size)), []):
+            pending.append(executor.submit(_transform_rows_chunk, out_fieldnames, chunk))
+
+            # Limit how many chunks are held in memory at once.
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def conform_cli(source_config, source_path, dest_path, extract_to_file=False, workers=1):
+    ''' Command line entry point for conforming a downloaded source to an output CSV.
+
+        Source rows are streamed straight into the conform transform. Set
+        extract_to_file to write them to an intermediate extracted CSV
+        first instead, which can be handy for debugging. Set workers to
+        transform rows in more than one process.
+    '''
     # TODO: this tool only works if the source creates a single output
 
     if "conform" not in source_config.data_source:
@@ -1348,6 +1974,12 @@ def conform_cli(source_config, source_path, dest_path):
         _L.warning("Skipping file with unknown conform: %s", source_path)
         return 1
 
+    if not extract_to_file:
+        extract_rows = extract_to_source_rows(source_config, source_path)
+        next(extract_rows, None) # skip the field names
+        transform_rows_to_out_csv(source_config, extract_rows, dest_path, workers)
+        return 0
+
     # Create a temporary filename for the intermediate extracted source CSV
     fd, extract_path = tempfile.mkstemp(prefix='openaddr-extracted-', suffix='.csv')
     os.close(fd)
@@ -1355,7 +1987,7 @@ def conform_cli(source_config, source_path, dest_path):
 
     try:
         extract_to_source_csv(source_config, source_path, extract_path)
-        transform_to_out_csv(source_config, extract_path, dest_path)
+        transform_to_out_csv(source_config, extract_path, dest_path, workers)
     finally:
         os.remove(extract_path)
 
@@ -1472,9 +2104,11 @@ def check_source_tests(source_config):
         # There is nothing to be done here.
         return None, None
 
+    conform_plan = ConformPlan(source_config)
+
     for (index, test) in enumerate(acceptance_tests):
         input = row_smash_case(source_config.data_source, test['inputs'])
-        output = row_smash_case(source_config.data_source, row_transform_and_convert(source_config, input))
+        output = row_smash_case(source_config.data_source, conform_plan.transform(input))
         actual = {k: v for (k, v) in output.items() if k in test['expected']}
         expected = row_smash_case(source_config.data_source, test['expected'])
 
@@ -14,6 +14,8 @@ import requests, uritemplate, mapbox_vector_tile
 
 from osgeo import osr, ogr
 
+from .util import source_splitext, open_source_file
+
 try:
     import cairo
 except ImportError:
@@ -94,7 +96,8 @@ def get_local_filename(filename_or_url):
     '''
     '''
     parsed = urlparse(filename_or_url)
-    suffix = os.path.splitext(parsed.path)[1]
+    base, _ = source_splitext(parsed.path)
+    suffix = parsed.path[len(base):]
 
     if parsed.scheme in ('', 'file'):
         return filename_or_url
@@ -114,12 +117,12 @@ def get_local_filename(filename_or_url):
     return filename
 
 def iterate_file_lonlats(filename):
-    ''' Stream (lon, lat) coordinates from an input .csv or .zip file.
+    ''' Stream (lon, lat) coordinates from an input .csv, .csv.gz, or .zip file.
     '''
-    suffix = os.path.splitext(filename)[1].lower()
+    suffix = source_splitext(filename)[1].lower()
 
     if suffix == '.csv':
-        open_file = open(filename, 'r')
+        open_file = open_source_file(filename, 'r')
     elif suffix == '.zip':
         open_file = open(filename, 'rb')
 
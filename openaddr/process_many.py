@@ -0,0 +1,216 @@
+from __future__ import absolute_import, division, print_function
+import logging; _L = logging.getLogger('openaddr.process_many')
+
+from argparse import ArgumentParser
+from collections import deque
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+import signal, time, csv, sys, os
+
+from . import util
+from .cache import DownloadCache
+from .conform import ConformStore
+from .process_one import process, process_all
+
+class SourceTimedOut(Exception):
+    ''' Raised in a source process when it runs past its timeout.
+
+        Subclasses Exception so process_one.process() records it in the
+        source log and writes state like any other processing error.
+    '''
+    pass
+
+def raise_source_timed_out(signum, frame):
+    raise SourceTimedOut('Source took too long to process')
+
+def process_source(conn, source, destination, all_layers, layer, layersource, do_preview, kwargs):
+    ''' Process one source file in a child process, send list of state paths to conn.
+    '''
+    signal.signal(signal.SIGTERM, raise_source_timed_out)
+
+    try:
+        if all_layers:
+            state_paths = process_all(source, destination, do_preview, **kwargs)
+        else:
+            state_paths = [process(source, destination, layer, layersource, do_preview, **kwargs)]
+    except Exception:
+        _L.error('Could not process {}'.format(source), exc_info=True)
+        state_paths = None
+
+    conn.send(state_paths)
+    conn.close()
+
+def process_many(sources, destination, do_preview, concurrency=1, timeout=None, all_layers=True,
+                 layer='', layersource='', grace_period=60, **kwargs):
+    ''' Process many source files, return list of (source, state paths) in order.
+
+        Each source runs in its own process, forked so imports are shared,
+        with no more than concurrency at once. Sources still running after
+        timeout seconds are asked to stop, then killed after grace_period
+        seconds more. State paths are None for sources that failed outright.
+
+        Other keyword arguments are passed to process_one.process().
+    '''
+    pending, running = deque(enumerate(sources)), dict()
+    results = [(source, None) for source in sources]
+
+    while pending or running:
+        while pending and len(running) < concurrency:
+            index, source = pending.popleft()
+            recv_conn, send_conn = Pipe(False)
+            args = send_conn, source, destination, all_layers, layer, layersource, do_preview, kwargs
+            proc = Process(target=process_source, args=args)
+            proc.start()
+            send_conn.close()
+
+            _L.info('Processing {} in process {}'.format(source, proc.pid))
+            running[proc] = index, recv_conn, time.time(), False
+
+        wait([proc.sentinel for proc in running], timeout=1)
+
+        for (proc, (index, recv_conn, started, stopping)) in list(running.items()):
+            elapsed = time.time() - started
+
+            try:
+                if recv_conn.poll():
+                    results[index] = results[index][0], recv_conn.recv()
+            except EOFError:
+                # Result was already received, or process ended without one.
+                pass
+
+            if not proc.is_alive():
+                proc.join()
+                recv_conn.close()
+                del running[proc]
+                _L.info('Finished {} in {:.0f} seconds'.format(results[index][0], elapsed))
+
+            elif timeout and elapsed > timeout + grace_period:
+                _L.error('Killing {} after {:.0f} seconds'.format(results[index][0], elapsed))
+                kill_process_tree(proc.pid)
+
+            elif timeout and elapsed > timeout and not stopping:
+                _L.warning('Stopping {} after {:.0f} seconds'.format(results[index][0], elapsed))
+                running[proc] = index, recv_conn, started, True
+                proc.terminate()
+
+    return results
+
+def kill_process_tree(pid):
+    ''' Kill a process and all its child processes, like conform workers.
+    '''
+    for child_pid in util.get_pidlist(pid):
+        try:
+            os.kill(child_pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def read_sources_list(path):
+    ''' Read a list of source file names, one per line.
+    '''
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+parser = ArgumentParser(description='Run many source files locally, prints output paths.')
+
+parser.add_argument('destination', help='Required output directory name.')
+parser.add_argument('sources', help='Source file names.', nargs='*')
+
+parser.add_argument('-s', '--sources-list', help='Optional file with one source file name per line.',
+                    dest='sources_list', default=None)
+
+parser.add_argument('-c', '--concurrency', help='Number of sources to process at once.',
+                    type=int, dest='concurrency', default=1)
+
+parser.add_argument('-t', '--timeout', help='Seconds to let each source run before stopping it.',
+                    type=int, dest='timeout', default=None)
+
+parser.add_argument('-ln', '--layer', help='Layer name to process in V2 sources, instead of all layers.',
+                    dest='layer', default='')
+parser.add_argument('-ls', '--layersource', help='Source within a given layer to pull from.',
+                    dest='layersource', default='')
+
+parser.add_argument('--render-preview', help='Render a map preview',
+                    action='store_const', dest='render_preview',
+                    const=True, default=False)
+
+parser.add_argument('--mapbox-key', dest='mapbox_key',
+                    help='Mapbox API Key. See: https://mapbox.com/')
+
+parser.add_argument('-w', '--workers', help='Number of processes to conform each source with.',
+                    type=int, dest='workers', default=1)
+
+parser.add_argument('--conform-store', help='Optional directory of previous conform results to reuse.',
+                    dest='conform_store', default=None)
+
+parser.add_argument('--conform-store-size', help='Most megabytes to keep in the conform store.',
+                    type=int, dest='conform_store_size', default=None)
+
+parser.add_argument('--fingerprint-hash', help='Hash for new source data fingerprints. Default md5.',
+                    dest='fingerprint_hash', choices=('md5', 'blake2b'), default=None)
+
+parser.add_argument('--download-cache', help='Optional directory of downloads to share between sources.',
+                    dest='download_cache', default=None)
+
+parser.add_argument('--download-cache-size', help='Most megabytes to keep in the download cache.',
+                    type=int, dest='download_cache_size', default=None)
+
+parser.add_argument('--output-compression', help='Optional compression for processed output CSV.',
+                    dest='output_compression', choices=sorted(util.output_compressions), default=None)
+
+parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
+                    action='store_const', dest='loglevel',
+                    const=logging.DEBUG, default=logging.INFO)
+
+parser.add_argument('-q', '--quiet', help='Turn off most logging',
+                    action='store_const', dest='loglevel',
+                    const=logging.WARNING, default=logging.INFO)
+
+def main():
+    '''
+    '''
+    args = parser.parse_args()
+
+    # Source logs are written by process_one, this is for the batch itself.
+    openaddr_logger = logging.getLogger('openaddr')
+    openaddr_logger.setLevel(logging.DEBUG)
+
+    handler = logging.StreamHandler()
+    handler.setLevel(args.loglevel)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)07s: %(message)s'))
+    openaddr_logger.addHandler(handler)
+
+    # Allow CSV files with very long fields
+    csv.field_size_limit(sys.maxsize)
+
+    sources = list(args.sources)
+
+    if args.sources_list:
+        sources.extend(read_sources_list(args.sources_list))
+
+    if args.download_cache:
+        max_size = None if args.download_cache_size is None else args.download_cache_size * 1024**2
+        download_cache = DownloadCache(args.download_cache, max_size)
+    else:
+        download_cache = None
+
+    if args.conform_store:
+        max_size = None if args.conform_store_size is None else args.conform_store_size * 1024**2
+        conform_store = ConformStore(args.conform_store, max_size)
+    else:
+        conform_store = None
+
+    results = process_many(sources, args.destination, args.render_preview,
+                           concurrency=args.concurrency, timeout=args.timeout,
+                           all_layers=not args.layer, layer=args.layer, layersource=args.layersource,
+                           mapbox_key=args.mapbox_key, workers=args.workers,
+                           conform_store=conform_store, fingerprint_hash=args.fingerprint_hash,
+                           download_cache=download_cache, output_compression=args.output_compression)
+
+    for (source, state_paths) in results:
+        for state_path in (state_paths or []):
+            print(state_path)
+
+    return 0 if all(state_paths for (_, state_paths) in results) else 1
+
+if __name__ == '__main__':
+    exit(main())
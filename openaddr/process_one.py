@@ -6,36 +6,33 @@ from os.path import join, basename, dirname, exists, splitext, relpath
 from shutil import copy, move, rmtree
 from argparse import ArgumentParser
 from os import mkdir, rmdir, close, chmod
-from _thread import get_ident
-import tempfile, json, csv, sys, enum
+from concurrent.futures import ProcessPoolExecutor
+import tempfile, json, csv, sys
 import threading
+import contextvars
 
 from . import util, cache, conform, preview, slippymap, CacheResult, ConformResult, __version__, SourceConfig
-from .cache import DownloadError
-from .conform import check_source_tests
+from .util import SourceProblem, source_splitext, link_or_copy
+from .cache import DownloadError, DownloadCache
+from .conform import check_source_tests, ConformStore
 
 from esridump.errors import EsriDownloadError
 
 class SourceSaysSkip(RuntimeError): pass
 class SourceTestsFailed(RuntimeError): pass
 
-@enum.unique
-class SourceProblem (enum.Enum):
-    ''' Possible problems encountered in a source.
-    '''
-    skip_source = 'Source says to skip'
-    missing_conform = 'Source is missing a conform object'
-    unknown_conform_format = 'Unknown source conform format'
-    unknown_conform_protocol = 'Unknown source conform protocol'
-    download_source_failed = 'Could not download source data'
-    conform_source_failed = 'Could not conform source data'
-    no_coverage = 'Missing or incomplete coverage'
-    no_esri_token = 'Missing required ESRI token'
-    test_failed = 'An acceptance test failed'
-    no_addresses_found = 'Found no addresses in source data'
-
-    # Old tag naming; replaced with "format" or "protocol"
-    unknown_conform_type = 'Unknown source conform type'
+# Most important problems first, see find_source_problem().
+SOURCE_PROBLEM_ORDER = (
+    SourceProblem.test_failed,
+    SourceProblem.missing_conform,
+    SourceProblem.unknown_conform_protocol,
+    SourceProblem.unknown_conform_format,
+    SourceProblem.unknown_conform_type,
+    SourceProblem.no_addresses_found,
+    SourceProblem.download_source_failed,
+    SourceProblem.conform_source_failed,
+    SourceProblem.no_esri_token,
+    )
 
 def boolstr(value):
     '''
@@ -51,27 +48,37 @@ def boolstr(value):
 
     raise ValueError(repr(value))
 
-def process(source, destination, layer, layersource, do_preview, mapbox_key=None, extras=dict()):
+def process(source, destination, layer, layersource, do_preview, mapbox_key=None, extras=dict(), workers=1, conform_store=None, fingerprint_hash=None, download_cache=None, output_compression=None, layersource_statedir=False, extract_to_file=False):
     ''' Process a single source and destination, return path to JSON state file.
 
-        Creates a new directory and files under destination.
+        Creates a new directory and files under destination, in
+        <source>/<layer>/ or with layersource_statedir in
+        <source>/<layer>/<layersource name>/ so layersources don't collide.
     '''
-    # The main processing thread holds wait_lock until it is done.
-    # The logging thread periodically writes data in the background,
-    # then exits once the main thread releases the lock.
-    wait_lock = threading.Lock()
-    proc_wait = threading.Thread(target=util.log_process_usage, args=(wait_lock, ))
-
     temp_dir = tempfile.mkdtemp(prefix='process_one-', dir=destination)
     temp_src = join(temp_dir, basename(source))
     copy(source, temp_src)
 
     state_path = False
-    data_source = dict(name='')
+    data_source_name = ''
 
+    # Route log messages from this context to this source's log only,
+    # so concurrent calls to process() keep their logs apart.
     log_handler = get_log_handler(temp_dir)
+    log_context_token = util.current_log_handler.set(log_handler)
     logging.getLogger('openaddr').addHandler(log_handler)
 
+    # Problems are reported as they happen, see util.report_source_problem().
+    source_problems = list()
+    problems_context_token = util.current_source_problems.set(source_problems)
+
+    # The main processing thread holds wait_lock until it is done.
+    # The logging thread periodically writes data in the background,
+    # then exits once the main thread releases the lock.
+    wait_lock = threading.Lock()
+    proc_wait = threading.Thread(target=contextvars.copy_context().run,
+                                 args=(util.log_process_usage, wait_lock))
+
     with wait_lock:
         proc_wait.start()
         cache_result, conform_result = CacheResult.empty(), ConformResult.empty()
@@ -126,14 +133,19 @@ def process(source, destination, layer, layersource, do_preview, mapbox_key=None
                     _L.warning('name attribute is required on each data source')
                     raise ValueError('name attribute is required on each data source')
 
+                data_source_name = source_config.data_source['name']
+
                 # Cache source data.
                 try:
-                    cache_result = cache(source_config, temp_dir, extras)
+                    cache_result = cache(source_config, temp_dir, extras, fingerprint_hash, download_cache)
                 except EsriDownloadError as e:
                     _L.warning('Could not download ESRI source data: {}'.format(e))
+                    if 'Token Required' in str(e):
+                        util.report_source_problem(SourceProblem.no_esri_token)
                     raise
                 except DownloadError as e:
                     _L.warning('Could not download source data')
+                    util.report_source_problem(SourceProblem.download_source_failed)
                     raise
 
                 if not cache_result.cache:
@@ -142,7 +154,7 @@ def process(source, destination, layer, layersource, do_preview, mapbox_key=None
                     _L.info(u'Cached data in {}'.format(cache_result.cache))
 
                     # Conform cached source data.
-                    conform_result = conform(source_config, temp_dir, cache_result.todict())
+                    conform_result = conform(source_config, temp_dir, cache_result.todict(), workers, conform_store, output_compression, extract_to_file)
 
                     if not conform_result.path:
                         _L.warning('Nothing processed')
@@ -166,6 +178,7 @@ def process(source, destination, layer, layersource, do_preview, mapbox_key=None
 
         except SourceTestsFailed as e:
             _L.warning('A source test failed in process_one.process(): %s', str(e))
+            util.report_source_problem(SourceProblem.test_failed)
             tests_passed = False
 
         except Exception:
@@ -174,17 +187,76 @@ def process(source, destination, layer, layersource, do_preview, mapbox_key=None
         finally:
             # Make sure this gets done no matter what
             logging.getLogger('openaddr').removeHandler(log_handler)
+            util.current_log_handler.reset(log_context_token)
+            util.current_source_problems.reset(problems_context_token)
+
+        state_name = data_source_name if layersource_statedir else ''
 
-        state_path = write_state(temp_src, layer, data_source['name'], skipped_source, destination, log_handler,
+        state_path = write_state(temp_src, layer, state_name, skipped_source, destination, log_handler,
             tests_passed, cache_result, conform_result, preview_path, slippymap_path,
-            temp_dir)
+            temp_dir, source_problems)
 
         log_handler.close()
         rmtree(temp_dir)
 
-    # TODO Return List of state paths
     return state_path
 
+def process_all(source, destination, do_preview, mapbox_key=None, extras=dict(), workers=1, conform_store=None, fingerprint_hash=None, download_cache=None, output_compression=None, extract_to_file=False, concurrency=1):
+    ''' Process every layer and layersource of a source, return list of paths to JSON state files.
+
+        Layers share downloaded data through download_cache, or a temporary
+        one if none is given. With concurrency above one, layers are
+        processed at once in separate processes, and layers with the same
+        data URL wait for one download, see DownloadCache.lock(). State for each layersource
+        is written to <source>/<layer>/<layersource name>/ under destination.
+    '''
+    with open(source) as file:
+        layer_sources = list_layer_sources(json.load(file))
+
+    temp_cache_dir = None
+
+    if download_cache is None:
+        temp_cache_dir = tempfile.mkdtemp(prefix='downloads-', dir=destination)
+        download_cache = DownloadCache(temp_cache_dir)
+
+    kwargs = dict(mapbox_key=mapbox_key, extras=extras, workers=workers, conform_store=conform_store,
+                  fingerprint_hash=fingerprint_hash, download_cache=download_cache,
+                  output_compression=output_compression, extract_to_file=extract_to_file,
+                  layersource_statedir=True)
+
+    try:
+        if concurrency > 1 and len(layer_sources) > 1:
+            with ProcessPoolExecutor(max_workers=min(concurrency, len(layer_sources))) as executor:
+                futures = [executor.submit(process, source, destination, layer, layersource, do_preview, **kwargs)
+                           for (layer, layersource) in layer_sources]
+                return [future.result() for future in futures]
+        else:
+            return [process(source, destination, layer, layersource, do_preview, **kwargs)
+                    for (layer, layersource) in layer_sources]
+    finally:
+        if temp_cache_dir:
+            rmtree(temp_cache_dir)
+
+def list_layer_sources(source):
+    ''' Return a list of (layer, layersource) names in a source.
+
+        Layers that process() doesn't support and unnamed layersources are skipped.
+    '''
+    if source.get('schema', None) == None and source.get('layers', None) == None:
+        return [('addresses', 'primary')]
+
+    layer_sources = []
+
+    for layer in ('addresses', 'parcels', 'buildings'):
+        for data_source in source['layers'].get(layer, None) or []:
+            if data_source.get('name', None) == None:
+                _L.warning('Skipping unnamed data source in \'{}\' layer'.format(layer))
+                continue
+
+            layer_sources.append((layer, data_source['name']))
+
+    return layer_sources
+
 def upgrade_source_schema(schema):
     ''' Temporary Shim to convert a V1 Schema source (layerless) to a V2 schema file (layers)
     '''
@@ -219,15 +291,18 @@ def render_slippymap(csv_filename, temp_dir):
     else:
         return mbtiles_filename
 
-class LogFilterCurrentThread:
-    ''' Logging filter object to match only record in the current thread.
+class LogFilterCurrentContext:
+    ''' Logging filter object to match only records for the given handler.
+
+        process() sets util.current_log_handler for its own context, which
+        is inherited by forked processes and passed on to threads it starts
+        with util.submit_in_context().
     '''
-    def __init__(self):
-        # Seems to work as unique ID with multiprocessing.Process() as well as threading.Thread()
-        self.thread_id = get_ident()
+    def __init__(self, handler):
+        self.handler = handler
 
     def filter(self, record):
-        return record.thread == self.thread_id
+        return util.current_log_handler.get() is self.handler
 
 def get_log_handler(directory):
     ''' Create a new file handler and return it.
@@ -240,41 +315,17 @@ def get_log_handler(directory):
     handler.setFormatter(logging.Formatter(u'%(asctime)s %(levelname)08s: %(message)s'))
     handler.setLevel(logging.DEBUG)
 
-    # # Limit log messages to the current thread
-    # handler.addFilter(LogFilterCurrentThread())
+    # Limit log messages to the current source
+    handler.addFilter(LogFilterCurrentContext(handler))
 
     return handler
 
-def find_source_problem(log_contents, source):
-    print(log_contents)
-    '''
+def find_source_problem(source_problems, source):
+    ''' Return the most important of the reported problems with a source.
     '''
-    if 'WARNING: A source test failed' in log_contents:
-        return SourceProblem.test_failed
-
-    if 'WARNING: Source is missing a conform object' in log_contents:
-        return SourceProblem.missing_conform
-
-    if 'WARNING: Unknown source conform protocol' in log_contents:
-        return SourceProblem.unknown_conform_protocol
-
-    if 'WARNING: Unknown source conform format' in log_contents:
-        return SourceProblem.unknown_conform_format
-
-    if 'WARNING: Unknown source conform type' in log_contents:
-        return SourceProblem.unknown_conform_type
-
-    if 'WARNING: Found no addresses in source data' in log_contents:
-        return SourceProblem.no_addresses_found
-
-    if 'WARNING: Could not download source data' in log_contents:
-        return SourceProblem.download_source_failed
-
-    if 'WARNING: Error doing conform; skipping' in log_contents:
-        return SourceProblem.conform_source_failed
-
-    if 'WARNING: Could not download ESRI source data: Could not retrieve layer metadata: Token Required' in log_contents:
-        return SourceProblem.no_esri_token
+    for source_problem in SOURCE_PROBLEM_ORDER:
+        if source_problem in source_problems:
+            return source_problem
 
     if 'coverage' in source:
         coverage = source.get('coverage')
@@ -289,7 +340,7 @@ def find_source_problem(log_contents, source):
 
 def write_state(source, layer, data_source_name, skipped, destination, log_handler, tests_passed,
                 cache_result, conform_result, preview_path, slippymap_path,
-                temp_dir):
+                temp_dir, source_problems=()):
     '''
     '''
     source_id, _ = splitext(basename(source))
@@ -310,7 +361,7 @@ def write_state(source, layer, data_source_name, skipped, destination, log_handl
         scheme, _, cache_path1, _, _, _ = urlparse(cache_result.cache)
         if scheme in ('file', ''):
             cache_path2 = join(statedir, 'cache{1}'.format(*splitext(cache_path1)))
-            copy(cache_path1, cache_path2)
+            link_or_copy(cache_path1, cache_path2)
             state_cache = relpath(cache_path2, statedir)
         else:
             state_cache = cache_result.cache
@@ -319,8 +370,9 @@ def write_state(source, layer, data_source_name, skipped, destination, log_handl
 
     if conform_result.path:
         _, _, processed_path1, _, _, _ = urlparse(conform_result.path)
-        processed_path2 = join(statedir, 'out{1}'.format(*splitext(processed_path1)))
-        copy(processed_path1, processed_path2)
+        processed_base, _ = source_splitext(processed_path1)
+        processed_path2 = join(statedir, 'out' + processed_path1[len(processed_base):])
+        link_or_copy(processed_path1, processed_path2)
 
     # Write the sample data to a sample.json file
     if conform_result.sample:
@@ -330,28 +382,26 @@ def write_state(source, layer, data_source_name, skipped, destination, log_handl
 
     if preview_path:
         preview_path2 = join(statedir, 'preview.png')
-        copy(preview_path, preview_path2)
+        link_or_copy(preview_path, preview_path2)
 
     if slippymap_path:
         slippymap_path2 = join(statedir, 'slippymap.mbtiles')
-        copy(slippymap_path, slippymap_path2)
+        link_or_copy(slippymap_path, slippymap_path2)
 
     log_handler.flush()
     output_path = join(statedir, 'output.txt')
-    copy(log_handler.stream.name, output_path)
+    link_or_copy(log_handler.stream.name, output_path)
 
     if skipped:
         source_problem = SourceProblem.skip_source
     else:
-        with open(output_path) as file:
-            log_content = file.read()
         if exists(source):
             with open(source) as file:
                 source_data = json.load(file)
         else:
             source_data = {}
 
-        source_problem = find_source_problem(log_content, source_data)
+        source_problem = find_source_problem(source_problems, source_data)
 
     state = [
         ('source', basename(source)),
@@ -364,6 +414,8 @@ def write_state(source, layer, data_source_name, skipped, destination, log_handl
         ('address count', conform_result.address_count),
         ('version', cache_result.version),
         ('fingerprint', cache_result.fingerprint),
+        ('etag', cache_result.etag),
+        ('last modified', cache_result.last_modified),
         ('cache time', cache_result.elapsed and str(cache_result.elapsed)),
         ('processed', conform_result.path and relpath(processed_path2, statedir)),
         ('process time', conform_result.elapsed and str(conform_result.elapsed)),
@@ -399,6 +451,12 @@ parser.add_argument('-ln', '--layer', help='Layer name to process in V2 sources'
 parser.add_argument('-ls', '--layersource', help='Source within a given layer to pull from',
                     dest='layersource', default='')
 
+parser.add_argument('--all-layers', help='Process every layer and layersource, printing each output path. State for each goes in a subdirectory named for its layersource.',
+                    action='store_const', dest='all_layers', const=True, default=False)
+
+parser.add_argument('-c', '--concurrency', help='Number of layers to process at once with --all-layers.',
+                    type=int, dest='concurrency', default=1)
+
 parser.add_argument('--render-preview', help='Render a map preview',
                     action='store_const', dest='render_preview',
                     const=True, default=False)
@@ -410,6 +468,30 @@ parser.add_argument('--skip-preview', help="Don't render a map preview",
 parser.add_argument('--mapbox-key', dest='mapbox_key',
                     help='Mapbox API Key. See: https://mapbox.com/')
 
+parser.add_argument('-w', '--workers', help='Number of processes to conform source data with.',
+                    type=int, dest='workers', default=1)
+
+parser.add_argument('--conform-store', help='Optional directory of previous conform results to reuse.',
+                    dest='conform_store', default=None)
+
+parser.add_argument('--conform-store-size', help='Most megabytes to keep in the conform store.',
+                    type=int, dest='conform_store_size', default=None)
+
+parser.add_argument('--fingerprint-hash', help='Hash for new source data fingerprints. Default md5.',
+                    dest='fingerprint_hash', choices=('md5', 'blake2b'), default=None)
+
+parser.add_argument('--download-cache', help='Optional directory of downloads to share between runs.',
+                    dest='download_cache', default=None)
+
+parser.add_argument('--download-cache-size', help='Most megabytes to keep in the download cache.',
+                    type=int, dest='download_cache_size', default=None)
+
+parser.add_argument('--output-compression', help='Optional compression for processed output CSV.',
+                    dest='output_compression', choices=sorted(util.output_compressions), default=None)
+
+parser.add_argument('--extract-to-file', help='Extract source rows to an intermediate CSV before conforming them, for debugging.',
+                    action='store_const', dest='extract_to_file', const=True, default=False)
+
 parser.add_argument('-l', '--logfile', help='Optional log file name.')
 
 parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
@@ -446,13 +528,33 @@ def main():
     # Allow CSV files with very long fields
     csv.field_size_limit(sys.maxsize)
 
+    if args.download_cache:
+        max_size = None if args.download_cache_size is None else args.download_cache_size * 1024**2
+        download_cache = DownloadCache(args.download_cache, max_size)
+    else:
+        download_cache = None
+
+    if args.conform_store:
+        max_size = None if args.conform_store_size is None else args.conform_store_size * 1024**2
+        conform_store = ConformStore(args.conform_store, max_size)
+    else:
+        conform_store = None
+
+    kwargs = dict(mapbox_key=args.mapbox_key, workers=args.workers, conform_store=conform_store,
+                  fingerprint_hash=args.fingerprint_hash, download_cache=download_cache,
+                  output_compression=args.output_compression, extract_to_file=args.extract_to_file)
+
     try:
-        processed_path = process(args.source, args.destination, args.layer, args.layersource, args.render_preview, mapbox_key=args.mapbox_key)
+        if args.all_layers:
+            processed_paths = process_all(args.source, args.destination, args.render_preview, concurrency=args.concurrency, **kwargs)
+        else:
+            processed_paths = [process(args.source, args.destination, args.layer, args.layersource, args.render_preview, **kwargs)]
     except Exception as e:
         _L.error(e, exc_info=True)
         return 1
     else:
-        print(processed_path)
+        for processed_path in processed_paths:
+            print(processed_path)
         return 0
 
 if __name__ == '__main__':
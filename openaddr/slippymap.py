@@ -10,6 +10,8 @@ from urllib.parse import urlparse
 import os, subprocess, json
 import requests
 
+from .util import source_splitext, open_source_file
+
 def generate(mbtiles_filename, *filenames_or_urls):
     '''
     '''
@@ -33,7 +35,8 @@ def get_local_filename(filename_or_url):
     '''
     '''
     parsed = urlparse(filename_or_url)
-    suffix = os.path.splitext(parsed.path)[1]
+    base, _ = source_splitext(parsed.path)
+    suffix = parsed.path[len(base):]
 
     if parsed.scheme in ('', 'file'):
         return filename_or_url
@@ -53,12 +56,12 @@ def get_local_filename(filename_or_url):
     return filename
 
 def iterate_file_features(filename):
-    ''' Stream GeoJSON features from an input .csv or .zip file.
+    ''' Stream GeoJSON features from an input .csv, .csv.gz, or .zip file.
     '''
-    suffix = os.path.splitext(filename)[1].lower()
+    suffix = source_splitext(filename)[1].lower()
 
     if suffix == '.csv':
-        open_file = open(filename, 'r')
+        open_file = open_source_file(filename, 'r')
     elif suffix == '.zip':
         open_file = open(filename, 'rb')
 
@@ -23,11 +23,13 @@ import sys
 import os
 import csv
 import logging
+import gzip
+import time
 from os import close, environ, mkdir, remove
 from io import BytesIO
 from csv import DictReader
 from itertools import cycle
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from datetime import datetime, timedelta
 from mimetypes import guess_type
 from urllib.parse import urlparse, parse_qs
@@ -35,7 +37,8 @@ from os.path import dirname, join, basename, exists, splitext
 from contextlib import contextmanager
 from subprocess import Popen, PIPE
 from unicodedata import normalize
-from threading import Lock
+from threading import Lock, Thread
+from concurrent.futures import ThreadPoolExecutor
 
 if sys.platform != 'win32':
     from fcntl import lockf, LOCK_EX, LOCK_UN
@@ -46,11 +49,11 @@ from requests import get
 from httmock import response, HTTMock
 import mock
 
-from .. import cache, conform, process_one
+from .. import cache, conform, process_one, process_many, util
 from ..util import package_output
 from ..cache import CacheResult
 from ..conform import ConformResult
-from ..process_one import find_source_problem, SourceProblem
+from ..process_one import find_source_problem, SourceProblem, list_layer_sources, get_log_handler
 
 def touch_first_arg_file(path, *args, **kwargs):
     ''' Write a short dummy file for the first argument.
@@ -300,7 +303,7 @@ class TestOA (unittest.TestCase):
 
         raise NotImplementedError(url.geturl())
 
-    def response_content_ftp(self, url):
+    def response_content_ftp(self, url, headers={}, passive=True):
         ''' Fake FTP responses for use with mock.patch in tests.
         '''
         scheme, host, path, _, _, _ = urlparse(url)
@@ -618,6 +621,81 @@ class TestOA (unittest.TestCase):
         with open(join(dirname(state_path), state['processed'])) as file:
             self.assertTrue('555,CARSON ST' in file.read())
 
+    def test_single_car_conform_store(self):
+        ''' Test process_one.process reuses a stored conform of unchanged data.
+        '''
+        source = join(self.src_dir, 'us-ca-carson.json')
+        store_dir = join(self.testdir, 'conform-store')
+
+        with HTTMock(self.response_content):
+            state_path = process_one.process(source, self.testdir, "addresses", "default", False, conform_store=store_dir)
+
+        with open(state_path) as file:
+            state1 = dict(zip(*json.load(file)))
+
+        with open(join(dirname(state_path), state1['processed'])) as file:
+            processed1 = file.read()
+
+        with HTTMock(self.response_content), \
+             mock.patch('openaddr.ConvertToCsvTask.convert') as convert:
+            convert.side_effect = Exception('Should not have conformed')
+            state_path = process_one.process(source, self.testdir, "addresses", "default", False, conform_store=store_dir)
+
+        self.assertEqual(convert.mock_calls, [])
+
+        with open(state_path) as file:
+            state2 = dict(zip(*json.load(file)))
+
+        self.assertEqual(state2['fingerprint'], state1['fingerprint'])
+        self.assertEqual(state2['address count'], state1['address count'])
+        self.assertEqual(state2['geometry type'], 'Point')
+        self.assertIsNotNone(state2['sample'])
+
+        with open(join(dirname(state_path), state2['processed'])) as file:
+            self.assertEqual(file.read(), processed1)
+
+    def test_all_layers_car(self):
+        ''' Test process_one.process_all shares one download between layersources.
+        '''
+        with open(join(self.src_dir, 'us-ca-carson.json')) as file:
+            source_data = json.load(file)
+
+        layer_copy = dict(source_data['layers']['addresses'][0], name='copy')
+        source_data['layers']['addresses'].append(layer_copy)
+
+        source = join(self.testdir, 'us-ca-carson.json')
+        with open(source, 'w') as file:
+            json.dump(source_data, file)
+
+        requested = []
+
+        def response_content(url, request):
+            requested.append(url.geturl())
+            return self.response_content(url, request)
+
+        with HTTMock(response_content):
+            state_path = process_one.process(join(self.src_dir, 'us-ca-carson.json'), self.testdir, "addresses", "default", False)
+            single_requests, requested[:] = len(requested), []
+
+            state_paths = process_one.process_all(source, self.testdir, False)
+
+        self.assertEqual(len(requested), single_requests, 'Should have downloaded once')
+        self.assertEqual(len(state_paths), 2)
+
+        # Only process_all() adds a layersource directory to the state path.
+        self.assertEqual(dirname(state_path), join(self.testdir, 'us-ca-carson', 'addresses'))
+        self.assertEqual(sorted(map(dirname, state_paths)), [join(self.testdir, 'us-ca-carson', 'addresses', 'copy'),
+                                                             join(self.testdir, 'us-ca-carson', 'addresses', 'default')])
+
+        states = []
+        for state_path in state_paths:
+            with open(state_path) as file:
+                states.append(dict(zip(*json.load(file))))
+
+        self.assertEqual(states[0]['fingerprint'], states[1]['fingerprint'])
+        self.assertEqual(states[0]['address count'], states[1]['address count'])
+        self.assertFalse([name for name in os.listdir(self.testdir) if name.startswith('downloads-')])
+
     def test_single_car_old_cached(self):
         ''' Test complete process_one.process on Carson sample data.
         '''
@@ -1781,6 +1859,10 @@ class TestState (unittest.TestCase):
         self.assertEqual(state1['attribution name'], 'Example')
         self.assertEqual(state1['tests passed'], True)
 
+        # Outputs on the same file system are linked rather than copied.
+        processed_path2 = join(dirname(path1), state1['processed'])
+        self.assertTrue(os.path.samefile(processed_path, processed_path2))
+
         #
         # Tweak a few values, try process_one.write_state() again.
         #
@@ -1796,22 +1878,109 @@ class TestState (unittest.TestCase):
         self.assertEqual(state2['skipped'], True)
         self.assertEqual(state2['attribution required'], 'false')
 
+        #
+        # Write state over an existing one with copies of the outputs.
+        #
+        with mock.patch('openaddr.util.link') as link:
+            link.side_effect = OSError('Invalid cross-device link')
+            path3 = process_one.write_state(**args)
+
+        self.assertEqual(path3, path2)
+        processed_path3 = join(dirname(path3), state2['processed'])
+        self.assertTrue(exists(processed_path3))
+        self.assertFalse(os.path.samefile(processed_path, processed_path3))
+
+    def test_list_layer_sources(self):
+        '''
+        '''
+        self.assertEqual(list_layer_sources({'data': 'http://example.com'}), [('addresses', 'primary')])
+
+        source = {'schema': 2, 'layers': {
+            'buildings': [{'name': 'city'}],
+            'addresses': [{'name': 'city'}, {'name': 'county'}, {'data': 'http://example.com'}],
+            'roads': [{'name': 'city'}],
+            }}
+
+        self.assertEqual(list_layer_sources(source),
+                         [('addresses', 'city'), ('addresses', 'county'), ('buildings', 'city')])
+
+    def test_log_handler_isolation(self):
+        '''
+        '''
+        openaddr_logger = logging.getLogger('openaddr')
+        handlers = [get_log_handler(self.output_dir) for i in range(2)]
+
+        def log_source(handler, name):
+            util.current_log_handler.set(handler)
+            with ThreadPoolExecutor(2) as executor:
+                for i in range(10):
+                    util.submit_in_context(executor, openaddr_logger.warning, 'From %s', name)
+                    time.sleep(.001)
+
+        openaddr_logger.warning('From nobody')
+
+        try:
+            for handler in handlers:
+                openaddr_logger.addHandler(handler)
+
+            threads = [Thread(target=log_source, args=(handler, name))
+                       for (handler, name) in zip(handlers, ('one', 'two'))]
+
+            for thread in threads:
+                thread.start()
+
+            openaddr_logger.warning('From nobody')
+
+            for thread in threads:
+                thread.join()
+        finally:
+            for handler in handlers:
+                openaddr_logger.removeHandler(handler)
+                handler.close()
+
+        for (handler, name) in zip(handlers, ('one', 'two')):
+            with open(handler.baseFilename) as file:
+                lines = file.read().splitlines()
+            self.assertEqual(len(lines), 10)
+            self.assertTrue(all(line.endswith('WARNING: From ' + name) for line in lines))
+
     def test_find_source_problem(self):
         '''
         '''
-        self.assertIsNone({'source problem': find_source_problem('', {'coverage': {'US Census': None}})}["source problem"])
-        self.assertIsNone({'source problem': find_source_problem('', {'coverage': {'US Census': None}})}["source problem"])
-        self.assertIsNone({'source problem': find_source_problem('', {'coverage': {'ISO 3166': None}})}["source problem"])
+        self.assertIsNone(find_source_problem([], {'coverage': {'US Census': None}}))
+        self.assertIsNone(find_source_problem([], {'coverage': {'ISO 3166': None}}))
+        self.assertIs(find_source_problem([], {}), SourceProblem.no_coverage)
+
+        for source_problem in (SourceProblem.no_esri_token, SourceProblem.conform_source_failed,
+                               SourceProblem.download_source_failed, SourceProblem.unknown_conform_protocol,
+                               SourceProblem.unknown_conform_format, SourceProblem.unknown_conform_type,
+                               SourceProblem.test_failed, SourceProblem.no_addresses_found):
+            self.assertIs(find_source_problem([source_problem], {}), source_problem)
+
+        # More important problems win over others reported along the way.
+        source_problems = [SourceProblem.conform_source_failed, SourceProblem.missing_conform]
+        self.assertIs(find_source_problem(source_problems, {}), SourceProblem.missing_conform)
+
+    def test_report_source_problem(self):
+        '''
+        '''
+        source_problems = list()
+        util.report_source_problem(SourceProblem.test_failed)
+
+        def report_source_problems():
+            util.current_source_problems.set(source_problems)
+
+            with ThreadPoolExecutor(2) as executor:
+                util.submit_in_context(executor, util.report_source_problem, SourceProblem.no_coverage).result()
 
-        self.assertIs({'source problem': find_source_problem('', {})}["source problem"], SourceProblem.no_coverage)
-        self.assertIs({'source problem': find_source_problem('WARNING: Could not download ESRI source data: Could not retrieve layer metadata: Token Required', {})}["source problem"], SourceProblem.no_esri_token)
-        self.assertIs({'source problem': find_source_problem('WARNING: Error doing conform; skipping', {})}["source problem"], SourceProblem.conform_source_failed)
-        self.assertIs({'source problem': find_source_problem('WARNING: Could not download source data', {})}["source problem"], SourceProblem.download_source_failed)
-        self.assertIs({'source problem': find_source_problem('WARNING: Unknown source conform protocol', {})}["source problem"], SourceProblem.unknown_conform_protocol)
-        self.assertIs({'source problem': find_source_problem('WARNING: Unknown source conform format', {})}["source problem"], SourceProblem.unknown_conform_format)
-        self.assertIs({'source problem': find_source_problem('WARNING: Unknown source conform type', {})}["source problem"], SourceProblem.unknown_conform_type)
-        self.assertIs({'source problem': find_source_problem('WARNING: A source test failed', {})}["source problem"], SourceProblem.test_failed)
-        self.assertIs({'source problem': find_source_problem('WARNING: Found no addresses in source data', {})}["source problem"], SourceProblem.no_addresses_found)
+            util.report_source_problem(SourceProblem.missing_conform)
+
+        thread = Thread(target=report_source_problems)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(source_problems, [SourceProblem.no_coverage, SourceProblem.missing_conform])
+        self.assertIsNone(util.current_source_problems.get())
 
 class TestPackage (unittest.TestCase):
 
@@ -1870,6 +2039,71 @@ class TestPackage (unittest.TestCase):
 
         self.assertEqual(call3[0], 'close')
 
+    def test_package_output_csv_gz(self):
+        '''
+        '''
+        handle, processed_gz = tempfile.mkstemp(prefix='stuff-', suffix='.csv.gz')
+        close(handle)
+
+        with gzip.open(processed_gz, 'wt') as file:
+            file.write('LON,LAT\n-122.2,37.8\n')
+
+        try:
+            zip_path = package_output('us-ca-carson', processed_gz, 'http://ci.carson.ca.us/', 'Public domain')
+
+            # Packaged the same as uncompressed output.
+            with ZipFile(zip_path) as zip_file:
+                self.assertEqual(zip_file.namelist(), ['README.txt', 'us-ca-carson.vrt', 'us-ca-carson.csv'])
+                self.assertEqual(zip_file.read('us-ca-carson.csv'), b'LON,LAT\n-122.2,37.8\n')
+
+            remove(zip_path)
+            zip_path = package_output('us-ca-carson', processed_gz, 'http://ci.carson.ca.us/', 'Public domain',
+                                      keep_compressed=True)
+
+            with ZipFile(zip_path) as zip_file:
+                self.assertEqual(zip_file.namelist(), ['README.txt', 'us-ca-carson.csv.gz'])
+                self.assertEqual(zip_file.getinfo('us-ca-carson.csv.gz').compress_type, ZIP_STORED)
+
+                with open(processed_gz, 'rb') as file:
+                    self.assertEqual(zip_file.read('us-ca-carson.csv.gz'), file.read())
+        finally:
+            remove(processed_gz)
+            remove(zip_path)
+
+class TestProcessMany (unittest.TestCase):
+
+    def test_process_many(self):
+        '''
+        '''
+        def fake_process_all(source, destination, do_preview, **kwargs):
+            if source == 'slow.json':
+                try:
+                    time.sleep(60)
+                except process_many.SourceTimedOut:
+                    return [join(destination, 'slow', 'state.txt')]
+            elif source == 'broken.json':
+                raise ValueError('Bad source')
+            return [join(destination, splitext(source)[0], 'state.txt')]
+
+        with mock.patch('openaddr.process_many.process_all') as process_all:
+            process_all.side_effect = fake_process_all
+            results = process_many.process_many(['fast.json', 'slow.json', 'broken.json'],
+                                                '/tmp/out', False, concurrency=2, timeout=1)
+
+        self.assertEqual(results, [('fast.json', ['/tmp/out/fast/state.txt']),
+                                   ('slow.json', ['/tmp/out/slow/state.txt']),
+                                   ('broken.json', None)])
+
+    def test_process_many_layer(self):
+        '''
+        '''
+        with mock.patch('openaddr.process_many.process') as process:
+            process.return_value = '/tmp/out/state.txt'
+            results = process_many.process_many(['foo.json'], '/tmp/out', False,
+                                                all_layers=False, layer='addresses', layersource='city')
+
+        self.assertEqual(results, [('foo.json', ['/tmp/out/state.txt'])])
+
 @contextmanager
 def locked_open(filename):
     ''' Open and lock a file, for use with threads and processes.
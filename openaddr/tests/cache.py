@@ -1,19 +1,31 @@
 from __future__ import absolute_import, division, print_function
 
-from .. import SourceConfig
+from .. import SourceConfig, cache
 from urllib.parse import urlparse, parse_qs
+from io import BytesIO, StringIO
+from hashlib import md5, blake2b
+from importlib import import_module
+from functools import partial
 from os.path import join, dirname
 
+import os
+import re
+import csv
 import shutil
 import mimetypes
+import threading
+import time
+import requests
 
 from mock import patch
 from esridump.errors import EsriDownloadError
 import unittest
 import httmock
 import tempfile
+from shapely.geometry import shape
 
-from ..cache import guess_url_file_extension, EsriRestDownloadTask
+from ..conform import GEOM_FIELDNAME
+from ..cache import guess_url_file_extension, EsriRestDownloadTask, geojson_geometry_wkt, EsriFeatureWriter, URLDownloadTask, DownloadError, compare_cache_details, get_content_mimetype, DownloadCache
 
 class TestCacheExtensionGuessing (unittest.TestCase):
 
@@ -57,6 +69,348 @@ class TestCacheExtensionGuessing (unittest.TestCase):
             assert guess_url_file_extension('http://dcatlas.dcgis.dc.gov/catalog/download.asp?downloadID=2182&downloadTYPE=ESRI') == '.zip'
             assert guess_url_file_extension('http://data.northcowichan.ca/DataBrowser/DownloadCsv?container=mncowichan&entitySet=PropertyReport&filter=NOFILTER') == '.csv', guess_url_file_extension('http://data.northcowichan.ca/DataBrowser/DownloadCsv?container=mncowichan&entitySet=PropertyReport&filter=NOFILTER')
 
+    def test_content_mimetypes(self):
+        with open(join(dirname(__file__), 'data', 'us-ca-oakland-excerpt.zip'), 'rb') as file:
+            self.assertEqual(get_content_mimetype(file.read(99)), 'application/zip')
+
+        self.assertEqual(get_content_mimetype(b'\x1f\x8b\x08\x00'), 'application/gzip')
+        self.assertEqual(get_content_mimetype(b'\x00\x00\x27\x0a\x00\x00'), 'application/x-esri-shape')
+        self.assertEqual(get_content_mimetype(b'%PDF-1.4\n'), 'application/pdf')
+        self.assertEqual(get_content_mimetype(b'\xef\xbb\xbf{"type": "FeatureCollection"'), 'application/json')
+        self.assertEqual(get_content_mimetype(b'NUMBER,STREET\n1,MAIN ST\n'), 'text/csv')
+        self.assertEqual(get_content_mimetype(b'Hello, world'[:5]), 'text/plain')
+        self.assertEqual(get_content_mimetype(b'<?xml version="1.0"?>\n<gml:FeatureCollection>'), 'application/gml+xml')
+        self.assertEqual(get_content_mimetype(b'<?xml version="1.0"?>\n<kml>'), 'text/xml')
+        self.assertEqual(get_content_mimetype(b'\n<!DOCTYPE html>\n<html><body>Error'), 'text/html')
+        self.assertEqual(get_content_mimetype(b'\x00\x01\x02\x03'), 'application/octet-stream')
+
+class TestCacheURLDownload (unittest.TestCase):
+
+    def setUp(self):
+        ''' Prepare a clean temporary directory, and work there.
+        '''
+        self.workdir = tempfile.mkdtemp(prefix='testCache-')
+        self.barrier = threading.Barrier(2, timeout=5)
+        self.requested = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def response_content(self, url, request):
+        ''' Fake HTTP responses that only return when both files are requested.
+        '''
+        _, host, path, _, _, _ = urlparse(url.geturl())
+        self.requested.append(path)
+
+        if (host, path) == ('example.com', '/missing.csv'):
+            return httmock.response(404, b'Nope')
+
+        # Raises BrokenBarrierError if the two files are fetched serially.
+        self.barrier.wait()
+        return httmock.response(200, path.encode('utf8') * 99, headers={'Content-Type': 'text/csv'})
+
+    def test_concurrent_download(self):
+        task = URLDownloadTask(None, chunk_size=64)
+        source_urls = ['http://example.com/a.csv', 'http://example.com/b.csv', 'http://example.com/a.csv']
+
+        with httmock.HTTMock(self.response_content):
+            paths = task.download(source_urls, self.workdir, None)
+
+        self.assertEqual(paths, [join(self.workdir, 'http', 'a.csv'),
+                                 join(self.workdir, 'http', 'b.csv'),
+                                 join(self.workdir, 'http', 'a.csv')])
+        self.assertEqual(sorted(self.requested), ['/a.csv', '/b.csv'])
+
+        for path, expected in zip(paths, (b'/a.csv', b'/b.csv')):
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), expected * 99)
+
+    def test_download_sniffed_extension(self):
+        task = URLDownloadTask('us-ca-oakland', chunk_size=64)
+
+        def response_content(url, request):
+            self.requested.append(url.geturl())
+            return httmock.response(200, b'PK\x03\x04' + b'FAKE'*99, headers={'Content-Type': 'application/octet-stream'})
+
+        with httmock.HTTMock(response_content):
+            paths = task.download(['http://example.com/download.asp?id=1'], self.workdir, None)
+
+        # Extension comes from the one and only request for the data.
+        self.assertEqual(len(self.requested), 1)
+        self.assertEqual(os.path.splitext(paths[0])[1], '.zip')
+
+        with open(paths[0], 'rb') as file:
+            self.assertEqual(file.read(), b'PK\x03\x04' + b'FAKE'*99)
+
+    def test_download_error(self):
+        task = URLDownloadTask(None)
+
+        with httmock.HTTMock(self.response_content):
+            with self.assertRaises(DownloadError):
+                task.download(['http://example.com/missing.csv'], self.workdir, None)
+
+class FlakyRaw (BytesIO):
+    ''' Raw response body that fails after a number of bytes.
+    '''
+    def __init__(self, content, fail_after):
+        BytesIO.__init__(self, content)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise requests.exceptions.ConnectionError('Connection reset')
+        return BytesIO.read(self, min(size, self.fail_after - self.tell()))
+
+class TestCacheResumeDownload (unittest.TestCase):
+
+    def setUp(self):
+        ''' Prepare a clean temporary directory, and work there.
+        '''
+        self.workdir = tempfile.mkdtemp(prefix='testCache-')
+        self.content = bytes(range(256)) * 4
+        self.etag, self.next_etag = '"v1"', '"v1"'
+        self.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def response_content(self, url, request):
+        ''' Fake HTTP responses that break halfway through the first time.
+        '''
+        self.requests.append(request)
+        range_header, if_range = request.headers.get('Range'), request.headers.get('If-Range')
+
+        if len(self.requests) == 1:
+            response = httmock.response(200, b'', headers={'ETag': self.etag}, request=request, stream=True)
+            response._content, response._content_consumed = False, False
+            response.raw = FlakyRaw(self.content, 300)
+            self.etag = self.next_etag
+            return response
+
+        if range_header and if_range == self.etag:
+            offset = int(range_header[len('bytes='):-1])
+            content_range = 'bytes {}-{}/{}'.format(offset, len(self.content) - 1, len(self.content))
+            return httmock.response(206, self.content[offset:], request=request, stream=True,
+                                    headers={'ETag': self.etag, 'Content-Range': content_range})
+
+        return httmock.response(200, self.content, headers={'ETag': self.etag}, request=request, stream=True)
+
+    def test_resume_download(self):
+        task = URLDownloadTask(None, chunk_size=64)
+        task.BACKOFF = 0
+
+        with httmock.HTTMock(self.response_content):
+            paths = task.download(['http://example.com/a.csv'], self.workdir, None)
+
+        with open(paths[0], 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].headers['Range'], 'bytes=300-')
+        self.assertEqual(self.requests[1].headers['If-Range'], '"v1"')
+        self.assertEqual(task.fingerprints[paths[0]], md5(self.content).hexdigest())
+
+    def test_restart_changed_download(self):
+        task = URLDownloadTask(None, chunk_size=64)
+        task.BACKOFF = 0
+
+        # Source data changes after the first interrupted request.
+        self.next_etag = '"v2"'
+
+        with httmock.HTTMock(self.response_content):
+            paths = task.download(['http://example.com/a.csv'], self.workdir, None)
+
+        with open(paths[0], 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].headers['If-Range'], '"v1"')
+        self.assertFalse(os.path.exists(paths[0] + '.part'))
+        self.assertEqual(task.fingerprints[paths[0]], md5(self.content).hexdigest())
+
+    def test_blake2b_fingerprint(self):
+        task = URLDownloadTask(None, chunk_size=64, fingerprint_hash='blake2b')
+        task.BACKOFF = 0
+
+        with httmock.HTTMock(self.response_content):
+            paths = task.download(['http://example.com/a.csv'], self.workdir, None)
+
+        self.assertEqual(task.fingerprints[paths[0]], blake2b(self.content, digest_size=16).hexdigest())
+
+        # Downloaded fingerprints are used as given.
+        data_cache, fingerprint = compare_cache_details(paths[0], join(self.workdir, 'cached'), {}, 'abc')
+        self.assertEqual(fingerprint, 'abc')
+
+class TestCacheRevalidation (unittest.TestCase):
+
+    def setUp(self):
+        ''' Prepare a clean temporary directory, and work there.
+        '''
+        self.workdir = tempfile.mkdtemp(prefix='testCache-')
+        self.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def response_content(self, url, request):
+        ''' Fake HTTP responses that honor If-None-Match.
+        '''
+        self.requests.append(request)
+
+        if request.headers.get('If-None-Match') == '"v1"':
+            return httmock.response(304, b'', request=request)
+
+        return httmock.response(200, b'NUMBER,STREET\n1,MAIN ST\n', request=request,
+                                headers={'ETag': '"v1"', 'Last-Modified': 'Sat, 01 Jan 2000 00:00:00 GMT',
+                                         'Content-Type': 'text/csv'})
+
+    def source_config(self, **data):
+        data_source = dict(name='default', protocol='http', data='http://example.com/a.csv', **data)
+        return SourceConfig(dict(layers=dict(addresses=[data_source])), 'addresses', 'default')
+
+    def test_first_download(self):
+        with httmock.HTTMock(self.response_content):
+            result = cache(self.source_config(), self.workdir, dict())
+
+        self.assertIsNone(self.requests[0].headers.get('If-None-Match'))
+        self.assertEqual(result.etag, '"v1"')
+        self.assertEqual(result.last_modified, 'Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(result.fingerprint, md5(b'NUMBER,STREET\n1,MAIN ST\n').hexdigest())
+        self.assertEqual(result.todict()['etag'], '"v1"')
+        self.assertTrue(result.cache.startswith('file://'))
+
+    def test_not_modified(self):
+        source_config = self.source_config(cache='http://example.com/cache.csv', fingerprint='ff9900',
+                                           version='20000101', etag='"v1"',
+                                           last_modified='Sat, 01 Jan 2000 00:00:00 GMT')
+
+        with httmock.HTTMock(self.response_content):
+            result = cache(source_config, self.workdir, dict())
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.requests[0].headers['If-None-Match'], '"v1"')
+        self.assertEqual(self.requests[0].headers['If-Modified-Since'], 'Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(result.cache, 'http://example.com/cache.csv')
+        self.assertEqual(result.fingerprint, 'ff9900')
+        self.assertEqual(result.version, '20000101')
+        self.assertEqual(result.etag, '"v1"')
+
+    def test_no_previous_cache(self):
+        source_config = self.source_config(fingerprint='ff9900', etag='"v1"')
+
+        with httmock.HTTMock(self.response_content):
+            result = cache(source_config, self.workdir, dict())
+
+        self.assertIsNone(self.requests[0].headers.get('If-None-Match'))
+        self.assertTrue(result.cache.startswith('file://'))
+
+    def test_shared_download_cache(self):
+        download_cache = DownloadCache(join(self.workdir, 'downloads'))
+        os.mkdir(join(self.workdir, 'one'))
+        os.mkdir(join(self.workdir, 'two'))
+
+        with httmock.HTTMock(self.response_content):
+            result1 = cache(self.source_config(), join(self.workdir, 'one'), dict(), download_cache=download_cache)
+            result2 = cache(self.source_config(), join(self.workdir, 'two'), dict(), download_cache=download_cache)
+
+        # A fresh cached download needs no request at all.
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(result2.fingerprint, result1.fingerprint)
+        self.assertEqual(result2.etag, '"v1"')
+
+        with open(urlparse(result2.cache).path, 'rb') as file:
+            self.assertEqual(file.read(), b'NUMBER,STREET\n1,MAIN ST\n')
+
+    def test_concurrent_download_cache(self):
+        download_cache = DownloadCache(join(self.workdir, 'downloads'))
+        results = dict()
+
+        def slow_response_content(url, request):
+            # Overlap the two downloads.
+            time.sleep(.2)
+            return self.response_content(url, request)
+
+        def run_cache(name):
+            os.mkdir(join(self.workdir, name))
+            results[name] = cache(self.source_config(), join(self.workdir, name), dict(), download_cache=download_cache)
+
+        with httmock.HTTMock(slow_response_content):
+            threads = [threading.Thread(target=run_cache, args=(name, )) for name in ('one', 'two')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # The second download waits for the first, then uses the cache.
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(results['one'].fingerprint, results['two'].fingerprint)
+
+    def test_revalidated_download_cache(self):
+        download_cache = DownloadCache(join(self.workdir, 'downloads'), max_age=0)
+        os.mkdir(join(self.workdir, 'one'))
+        os.mkdir(join(self.workdir, 'two'))
+
+        with httmock.HTTMock(self.response_content):
+            cache(self.source_config(), join(self.workdir, 'one'), dict(), download_cache=download_cache)
+            result = cache(self.source_config(), join(self.workdir, 'two'), dict(), download_cache=download_cache)
+
+        # A stale cached download is used after a 304 response.
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1].headers['If-None-Match'], '"v1"')
+        self.assertEqual(result.fingerprint, md5(b'NUMBER,STREET\n1,MAIN ST\n').hexdigest())
+        self.assertTrue(result.cache.startswith('file://'))
+
+    def test_download_cache_eviction(self):
+        download_cache = DownloadCache(join(self.workdir, 'downloads'), max_size=25)
+        keys = [download_cache.key('http://example.com/{}.csv'.format(name)) for name in 'abc']
+
+        for (index, key) in enumerate(keys):
+            path = join(self.workdir, '{}.csv'.format(index))
+            with open(path, 'w') as file:
+                file.write('x' * 10)
+
+            download_cache.put(key, path)
+            os.utime(join(self.workdir, 'downloads', key, 'download.json'), (index, index))
+
+            if index == 1:
+                # Using the first entry makes the second one least-recently used.
+                self.assertIsNotNone(download_cache.get(keys[0]))
+
+        self.assertIsNotNone(download_cache.get(keys[0]))
+        self.assertIsNone(download_cache.get(keys[1]))
+        self.assertIsNotNone(download_cache.get(keys[2]))
+
+class FakeEsriDumper:
+    ''' EsriDumper stand-in for a layer of point features with the given object IDs.
+
+        Each requested where clause is added to wheres, and where clauses
+        listed in failures fail once. Use with functools.partial().
+    '''
+    def __init__(self, url, oids, wheres, failures=None, num_format='{}', extra_query_args=None, **kwargs):
+        self.oids = oids
+        self.wheres = wheres
+        self.failures = failures if failures is not None else []
+        self.num_format = num_format
+        self.where = (extra_query_args or {}).get('where')
+
+    def get_metadata(self):
+        return {'fields': [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}, {'name': 'num'}],
+                'supportsStatistics': True, 'maxRecordCount': 2}
+
+    def get_feature_count(self):
+        return len(self.oids)
+
+    def __iter__(self):
+        self.wheres.append(self.where)
+        if self.where in self.failures:
+            self.failures.remove(self.where)
+            raise EsriDownloadError('Could not retrieve this chunk of objects')
+        low, high = map(int, re.match(r'^OBJECTID > (\d+) AND OBJECTID <= (\d+)$', self.where).groups())
+        for oid in self.oids:
+            if low < oid <= high:
+                yield {'type': 'Feature', 'properties': {'OBJECTID': oid, 'num': self.num_format.format(oid * 10)},
+                       'geometry': {'type': 'Point', 'coordinates': [oid, oid]}}
+
 class TestCacheEsriDownload (unittest.TestCase):
 
     def setUp(self):
@@ -114,6 +468,177 @@ class TestCacheEsriDownload (unittest.TestCase):
                     # This is the expected exception at this point
                     self.assertEqual(e.message, "Could not find object ID field name for deduplication")
 
+    def test_download_oid_ranges(self):
+        """ ESRI Caching Downloads Object ID Ranges In Parallel And In Order """
+        wheres = []
+        fake_dumper = partial(FakeEsriDumper, oids=range(1, 10), wheres=wheres)
+
+        task = EsriRestDownloadTask('us-fl-palmbeach')
+        task.RANGE_PAGES = 1
+
+        # openaddr.cache is shadowed by the openaddr.cache() function.
+        with patch.object(import_module('openaddr.cache'), 'EsriDumper', fake_dumper), \
+             patch.object(task, 'get_oid_min_max') as min_max_patch:
+            min_max_patch.return_value = (1, 9)
+            paths = task.download(['http://example.com/'], self.workdir, SourceConfig(dict({
+                "schema": 2,
+                "layers": {
+                    "addresses": [{
+                        "name": "default",
+                        "conform": {"number": "num"}
+                    }]
+                }
+            }), "addresses", "default"))
+
+        self.assertEqual(sorted(wheres), ['OBJECTID > 0 AND OBJECTID <= 2', 'OBJECTID > 2 AND OBJECTID <= 4',
+            'OBJECTID > 4 AND OBJECTID <= 6', 'OBJECTID > 6 AND OBJECTID <= 8', 'OBJECTID > 8 AND OBJECTID <= 9'])
+
+        with open(paths[0]) as file:
+            rows = list(csv.DictReader(file))
+
+        self.assertEqual([row['NUM'] for row in rows], [str(oid * 10) for oid in range(1, 10)])
+        self.assertEqual(rows[0][GEOM_FIELDNAME], 'POINT (1 1)')
+
+    def test_download_resumes_oid_ranges(self):
+        """ ESRI Caching Resumes From The Last Completed Object ID Range """
+        wheres, failures = [], ['OBJECTID > 4 AND OBJECTID <= 6']
+        fake_dumper = partial(FakeEsriDumper, oids=range(1, 10), wheres=wheres, failures=failures)
+
+        source_config = SourceConfig(dict({
+            "schema": 2,
+            "layers": {
+                "addresses": [{
+                    "name": "default",
+                    "conform": {"number": "num"}
+                }]
+            }
+        }), "addresses", "default")
+
+        task = EsriRestDownloadTask('us-fl-palmbeach', max_workers=2)
+        task.RANGE_PAGES, task.RETRIES = 1, 0
+
+        with patch.object(import_module('openaddr.cache'), 'EsriDumper', fake_dumper), \
+             patch.object(task, 'get_oid_min_max') as min_max_patch:
+            min_max_patch.return_value = (1, 9)
+
+            with self.assertRaises(EsriDownloadError):
+                task.download(['http://example.com/'], self.workdir, source_config)
+
+            # Ranges up to the failure are kept for the next try.
+            min_max_patch.side_effect = AssertionError('Should have resumed')
+            del wheres[:]
+            paths = task.download(['http://example.com/'], self.workdir, source_config)
+
+        self.assertNotIn('OBJECTID > 0 AND OBJECTID <= 2', wheres)
+        self.assertNotIn('OBJECTID > 2 AND OBJECTID <= 4', wheres)
+        self.assertIn('OBJECTID > 4 AND OBJECTID <= 6', wheres)
+        self.assertFalse(os.path.exists(paths[0] + '.checkpoint'))
+
+        with open(paths[0]) as file:
+            rows = list(csv.DictReader(file))
+
+        self.assertEqual([row['NUM'] for row in rows], [str(oid * 10) for oid in range(1, 10)])
+
+        with open(paths[0], 'rb') as file:
+            self.assertEqual(task.fingerprints[paths[0]], md5(file.read()).hexdigest())
+
+    def test_cache_resumes_oid_ranges(self):
+        """ ESRI Caching Resumes A Download Cache Partial In A Later Run """
+        wheres, failures = [], ['OBJECTID > 4 AND OBJECTID <= 6']
+
+        # Multi-byte characters make text and byte offsets differ.
+        fake_dumper = partial(FakeEsriDumper, oids=range(1, 10), wheres=wheres, failures=failures,
+                              num_format='{}\u00bd')
+
+        def source_config():
+            return SourceConfig(dict({
+                "schema": 2,
+                "layers": {
+                    "addresses": [{
+                        "name": "default",
+                        "protocol": "ESRI",
+                        "data": "http://example.com/",
+                        "conform": {"number": "num"}
+                    }]
+                }
+            }), "addresses", "default")
+
+        download_cache = DownloadCache(join(self.workdir, 'downloads'))
+        cache_module = import_module('openaddr.cache')
+
+        with patch.object(cache_module, 'EsriDumper', fake_dumper), \
+             patch.object(EsriRestDownloadTask, 'RANGE_PAGES', 1), \
+             patch.object(EsriRestDownloadTask, 'RETRIES', 0), \
+             patch.object(EsriRestDownloadTask, 'get_oid_min_max') as min_max_patch:
+            min_max_patch.return_value = (1, 9)
+
+            with self.assertRaises(EsriDownloadError):
+                cache(source_config(), self.workdir, dict(), download_cache=download_cache)
+
+            # Each run gets a new work directory, ranges are kept in the download cache.
+            min_max_patch.side_effect = AssertionError('Should have resumed')
+            del wheres[:]
+            result = cache(source_config(), self.workdir, dict(), download_cache=download_cache)
+
+        self.assertNotIn('OBJECTID > 0 AND OBJECTID <= 2', wheres)
+        self.assertNotIn('OBJECTID > 2 AND OBJECTID <= 4', wheres)
+        self.assertIn('OBJECTID > 4 AND OBJECTID <= 6', wheres)
+
+        with open(urlparse(result.cache).path, encoding='utf-8') as file:
+            rows = list(csv.DictReader(file))
+
+        self.assertEqual([row['NUM'] for row in rows], ['{}\u00bd'.format(oid * 10) for oid in range(1, 10)])
+
+        with open(urlparse(result.cache).path, 'rb') as file:
+            self.assertEqual(result.fingerprint, md5(file.read()).hexdigest())
+
+    def test_geojson_geometry_wkt(self):
+        """ ESRI Caching Formats Simple Geometries Without Shapely """
+        self.assertEqual(geojson_geometry_wkt({'type': 'Point', 'coordinates': [-122.2592497, 37.8]}), 'POINT (-122.2592497 37.8)')
+        self.assertEqual(geojson_geometry_wkt({'type': 'Point', 'coordinates': [1, 2.0]}), 'POINT (1 2)')
+        self.assertEqual(geojson_geometry_wkt({'type': 'Point', 'coordinates': [1e-05, 1e+16]}), 'POINT (1e-05 1e+16)')
+        self.assertEqual(geojson_geometry_wkt({'type': 'MultiPoint', 'coordinates': [[1, 2], [3, 4]]}), 'MULTIPOINT (1 2, 3 4)')
+        self.assertEqual(geojson_geometry_wkt({'type': 'LineString', 'coordinates': [[1, 2], [3, 4]]}), 'LINESTRING (1 2, 3 4)')
+        self.assertEqual(geojson_geometry_wkt({'type': 'MultiLineString', 'coordinates': [[[1, 2], [3, 4]], [[5, 6], [7, 8]]]}),
+                         'MULTILINESTRING ((1 2, 3 4), (5 6, 7 8))')
+        self.assertEqual(geojson_geometry_wkt({'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}),
+                         'POLYGON ((0 0, 1 0, 1 1, 0 0))')
+        self.assertEqual(geojson_geometry_wkt({'type': 'MultiPolygon', 'coordinates': [[[[0, 0], [1, 0], [1, 1], [0, 0]]], [[[2, 2], [3, 2], [3, 3], [2, 2]]]]}),
+                         'MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), ((2 2, 3 2, 3 3, 2 2)))')
+
+        with self.assertRaises(TypeError):
+            geojson_geometry_wkt({'type': 'Point', 'coordinates': [float('nan'), 1]})
+
+        with self.assertRaises(TypeError):
+            geojson_geometry_wkt({'type': 'Polygon', 'coordinates': [[[0, 0], [1, float('nan')], [1, 1], [0, 0]]]})
+
+    def test_geojson_geometry_wkt_precision(self):
+        """ ESRI Caching Formats Full-Precision Coordinates Like Shapely """
+        for coordinates in ([0.1 + 0.2, -(0.1 + 0.2)], [0.12345678901234568, 0.7999999999999999],
+                            [0.6000000000000001, 0.1 + 0.7]):
+            geometry = {'type': 'Point', 'coordinates': coordinates}
+            self.assertEqual(geojson_geometry_wkt(geometry), shape(geometry).wkt)
+
+        # Newer GEOS keeps 17 digits here, but pinned Shapely writes 16.
+        self.assertEqual(geojson_geometry_wkt({'type': 'Point', 'coordinates': [-122.25924970000001, 37.80000000000001]}),
+                         'POINT (-122.2592497 37.80000000000001)')
+        self.assertEqual(geojson_geometry_wkt({'type': 'Point', 'coordinates': [123456789.12345679, 10 ** 17]}),
+                         'POINT (123456789.1234568 1e+17)')
+
+    def test_esri_feature_writer(self):
+        """ ESRI Caching Writes Features In A Fixed Column Order """
+        file = StringIO()
+        writer = EsriFeatureWriter(file, ['NUM', 'STREET', GEOM_FIELDNAME], {'fields': [{'name': 'num'}, {'name': 'Street'}]})
+        writer.writerow({'properties': {'Street': 'Main St', 'num': 12, 'other': 'x'},
+                         'geometry': {'type': 'Point', 'coordinates': [1.5, 2]}})
+        writer.writerow({'properties': {'num': None, 'Extra': 'y'},
+                         'geometry': {'type': 'Point', 'coordinates': [3, 4]}})
+
+        with self.assertRaises(TypeError):
+            writer.writerow({'properties': {'num': 1}, 'geometry': None})
+
+        self.assertEqual(file.getvalue(), 'NUM,STREET,OA:GEOM\r\n12,Main St,POINT (1.5 2)\r\n,,POINT (3 4)\r\n')
+
     def test_field_names_to_request(self):
         '''
         '''
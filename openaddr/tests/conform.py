@@ -7,12 +7,24 @@ import copy
 import json
 import csv
 import re
+import io
 
 import unittest
 import tempfile
 import shutil
+import gzip
+import lzma
+import tarfile
+import time
+import errno
+
+from zipfile import ZipFile
+from subprocess import CalledProcessError
+from importlib import import_module
+from mock import patch
 
 from .. import SourceConfig
+from ..process_one import parser as process_one_parser
 
 from ..conform import (
     GEOM_FIELDNAME,
@@ -26,9 +38,18 @@ from ..conform import (
     row_canonicalize_unit_and_number, conform_smash_case, conform_cli,
     convert_regexp_replace, conform_license,
     conform_attribution, conform_sharealike, normalize_ogr_filename_case,
-    is_in, geojson_source_to_csv, check_source_tests
+    is_in, geojson_source_to_csv, check_source_tests, ConformPlan,
+    format_point_wkt, geojson_point_xy, ConformStore, ZipDecompressTask,
+    DecompressionTask, GuessDecompressTask, StreamDecompressTask, TarDecompressTask,
+    SevenZipDecompressTask, DecompressionError, ConvertToCsvTask,
+    compile_format_string, transform_rows_in_parallel, open_source_file
     )
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 class TestConformTransforms (unittest.TestCase):
     "Test low level data transform functions"
 
@@ -446,6 +467,104 @@ class TestConformTransforms (unittest.TestCase):
             'HASH': '9574c16dfc3cc7b1'
         }, r)
 
+    def test_conform_plan(self):
+        d = SourceConfig(dict({
+            "schema": 2,
+            "layers": {
+                "addresses": [{
+                    "name": "default",
+                    "conform": {
+                        "number": {
+                            "function": "regexp",
+                            "field": "s",
+                            "pattern": "^(\\S+)"
+                        },
+                        "street": {
+                            "function": "regexp",
+                            "field": "s",
+                            "pattern": "^(?:\\S+ )(.*)"
+                        },
+                        "city": ["c1", "c2"],
+                        "postcode": "p"
+                    },
+                    "fingerprint": "0000"
+                }]
+            }
+        }), "addresses", "default")
+
+        plan = ConformPlan(d)
+        self.assertEqual(3, len(plan.steps))
+
+        for row in ({ "s": "123 MAPLE ST", "c1": "A", "c2": "B", "p": "94612", GEOM_FIELDNAME: "POINT(-119.2 39.3)" },
+                    { "s": "9 OAK AVE", "c1": "C", "c2": "D", "p": "", GEOM_FIELDNAME: "POINT(-119.3 39.4)" }):
+            self.assertEqual(row_transform_and_convert(d, dict(row)), plan.transform(dict(row)))
+
+        r = plan.transform({ "s": "123 MAPLE ST", "c1": "A", "c2": "B", "p": "94612", GEOM_FIELDNAME: "POINT(-119.2 39.3)" })
+        self.assertEqual(("123", "MAPLE ST", "A B", "94612"), (r["NUMBER"], r["STREET"], r["CITY"], r["POSTCODE"]))
+
+    def test_transform_rows_in_parallel(self):
+        c = SourceConfig(dict({
+            "schema": 2,
+            "layers": {
+                "parcels": [{
+                    "name": "default",
+                    "conform": {
+                        "pid": { "function": "regexp", "field": "s", "pattern": "^(\\S+)" }
+                    }
+                }]
+            }
+        }), "parcels", "default")
+
+        plan, fieldnames = ConformPlan(c), ['GEOM', 'HASH', 'PID']
+        rows = [{ "s": "{} MAPLE ST".format(i), GEOM_FIELDNAME: "POINT ({} 1)".format(i) } for i in range(23)]
+
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames)
+        for row in rows:
+            writer.writerow(plan.transform(dict(row)))
+
+        chunks = list(transform_rows_in_parallel(plan, fieldnames, iter(rows), 3, chunk_size=2))
+        self.assertEqual(12, len(chunks))
+        self.assertEqual(buffer.getvalue(), ''.join(chunks))
+
+    def test_conform_plan_compiles_once(self):
+        c = SourceConfig(dict({
+            "schema": 2,
+            "layers": {
+                "addresses": [{
+                    "name": "default",
+                    "conform": {
+                        "number": { "function": "regexp", "field": "s", "pattern": "^([0-9]+)" },
+                        "street": { "function": "chain", "functions": [
+                            { "function": "format", "fields": ["s", "t"], "format": "$1 $2" },
+                            { "function": "regexp", "field": "street", "pattern": "^[0-9]+ (.+)$" }
+                        ]}
+                    },
+                    "fingerprint": "0000"
+                }]
+            }
+        }), "addresses", "default")
+
+        conform_module = import_module('openaddr.conform')
+        rows = [{ "s": "{} MAPLE".format(i), "t": "ST", GEOM_FIELDNAME: "POINT (1 1)" } for i in range(3)]
+
+        with patch.object(conform_module, 'compile_regexp_fxn', wraps=conform_module.compile_regexp_fxn) as regexp_patch, \
+             patch.object(conform_module, 'compile_format_string', wraps=conform_module.compile_format_string) as format_patch:
+            plan = ConformPlan(c)
+            results = [plan.transform(dict(row)) for row in rows]
+
+        # Compiled forms belong to the plan, once per conform function.
+        self.assertEqual(regexp_patch.call_count, 2)
+        self.assertEqual(format_patch.call_count, 1)
+
+        self.assertEqual([(r["NUMBER"], r["STREET"]) for r in results], [(str(i), "MAPLE ST") for i in range(3)])
+        self.assertEqual(results, [row_transform_and_convert(c, dict(row)) for row in rows])
+
+    def test_compile_format_string(self):
+        self.assertEqual(([("", 1), ("-", 2), ("-", 3)], ""), compile_format_string("$1-$2-$3"))
+        self.assertEqual(([("foo ", 1), ("", 2), ("-", 3)], " bar"), compile_format_string("foo $1$2-$3 bar"))
+        self.assertEqual(([], "no variables"), compile_format_string("no variables"))
+
     def test_row_canonicalize_unit_and_number(self):
         r = row_canonicalize_unit_and_number({}, {"NUMBER": "324 ", "STREET": " OAK DR.", "UNIT": "1"})
         self.assertEqual("324", r["NUMBER"])
@@ -497,6 +616,19 @@ class TestConformTransforms (unittest.TestCase):
             r = row_round_lat_lon({}, {"GEOM": "POINT ({} {})".format(a, a)})
             self.assertEqual("POINT ({} {})".format(e, e), r["GEOM"])
 
+    def test_format_point_wkt(self):
+        self.assertEqual("POINT (-122.3 39.1)", format_point_wkt(-122.3, 39.1))
+        self.assertEqual("POINT (-122.2592497 37.8026126)", format_point_wkt(-122.25924970000001, 37.8026126))
+        self.assertEqual("POINT (0 180)", format_point_wkt(-0.0, 180))
+
+    def test_geojson_point_xy(self):
+        self.assertEqual([-122.3, 39.1], geojson_point_xy({"type": "Point", "coordinates": [-122.3, 39.1]}))
+        self.assertEqual([-122, 39], geojson_point_xy({"type": "Point", "coordinates": [-122, 39]}))
+        self.assertIsNone(geojson_point_xy({"type": "Point", "coordinates": [-122.3, 39.1, 10.0]}))
+        self.assertIsNone(geojson_point_xy({"type": "Point", "coordinates": [float('nan'), 39.1]}))
+        self.assertIsNone(geojson_point_xy({"type": "Point", "coordinates": ["-122.3", "39.1"]}))
+        self.assertIsNone(geojson_point_xy({"type": "MultiPoint", "coordinates": [[-122.3, 39.1]]}))
+
     def test_row_extract_and_reproject(self):
         # CSV lat/lon column names
         d = SourceConfig(dict({
@@ -1855,6 +1987,89 @@ class TestConformCli (unittest.TestCase):
             self.assertEqual(rows[0]['NUMBER'], '5115')
             self.assertEqual(rows[0]['STREET'], 'FRUITED PLAINS LN')
 
+    def test_extract_to_file_matches_stream(self):
+        "Streamed and file-extracted conforms should write identical output"
+        for (source_name, ext) in (('lake-man', 'shp'), ('lake-man-split2', 'csv'), ('lake-man-3740', 'csv')):
+            with open(os.path.join(self.conforms_dir, "%s.json" % source_name)) as file:
+                source = json.load(file)
+
+            outputs = []
+
+            for extract_to_file in (False, True):
+                source_config = SourceConfig(copy.deepcopy(source), "addresses", "default")
+                source_config.data_source['fingerprint'] = '0123456789abcdef'
+                source_path = os.path.join(self.conforms_dir, "%s.%s" % (source_name, ext))
+                dest_path = os.path.join(self.testdir, '%s-%s.csv' % (source_name, extract_to_file))
+
+                rc = conform_cli(source_config, source_path, dest_path, extract_to_file=extract_to_file)
+                self.assertEqual(0, rc)
+
+                with open(dest_path, 'rb') as fp:
+                    outputs.append(fp.read())
+
+            self.assertEqual(outputs[0], outputs[1], source_name)
+
+    def test_convert_extract_to_file(self):
+        "ConvertToCsvTask passes the extract-to-file debugging option on to conform_cli"
+        with open(os.path.join(self.conforms_dir, "lake-man-split2.json")) as file:
+            source_config = SourceConfig(json.load(file), "addresses", "default")
+
+        source_path = os.path.join(self.conforms_dir, "lake-man-split2.csv")
+        conform_module = import_module('openaddr.conform')
+
+        for extract_to_file in (False, True):
+            with patch.object(conform_module, 'conform_cli') as conform_cli_patch:
+                conform_cli_patch.return_value = 1
+                ConvertToCsvTask().convert(source_config, [source_path], self.testdir, extract_to_file=extract_to_file)
+
+            self.assertEqual(conform_cli_patch.call_args[0][3], extract_to_file)
+
+        args = process_one_parser.parse_args(['source.json', 'destination', '--extract-to-file'])
+        self.assertTrue(args.extract_to_file)
+
+    def test_compressed_output_matches_plain(self):
+        "Conforms to a .csv.gz path should write the same output, compressed"
+        with open(os.path.join(self.conforms_dir, "lake-man-split2.json")) as file:
+            source = json.load(file)
+
+        outputs = []
+
+        for dest_name in ('lake-man.csv', 'lake-man.csv.gz'):
+            source_config = SourceConfig(copy.deepcopy(source), "addresses", "default")
+            source_config.data_source['fingerprint'] = '0123456789abcdef'
+            source_path = os.path.join(self.conforms_dir, "lake-man-split2.csv")
+            dest_path = os.path.join(self.testdir, dest_name)
+
+            self.assertEqual(0, conform_cli(source_config, source_path, dest_path))
+
+            with open_source_file(dest_path, 'rb') as fp:
+                outputs.append(fp.read())
+
+        with open(dest_path, 'rb') as fp:
+            self.assertEqual(fp.read(2), b'\x1f\x8b', 'Should be gzipped')
+
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_workers_match_serial(self):
+        "Conforms in several worker processes should write identical output"
+        with open(os.path.join(self.conforms_dir, "lake-man.json")) as file:
+            source = json.load(file)
+
+        outputs = []
+
+        for workers in (1, 2):
+            source_config = SourceConfig(copy.deepcopy(source), "addresses", "default")
+            source_config.data_source['fingerprint'] = '0123456789abcdef'
+            source_path = os.path.join(self.conforms_dir, "lake-man.shp")
+            dest_path = os.path.join(self.testdir, 'lake-man-{}.csv'.format(workers))
+
+            self.assertEqual(0, conform_cli(source_config, source_path, dest_path, workers=workers))
+
+            with open(dest_path, 'rb') as fp:
+                outputs.append(fp.read())
+
+        self.assertEqual(outputs[0], outputs[1])
+
 
 class TestConformMisc(unittest.TestCase):
 
@@ -2067,6 +2282,195 @@ class TestConformMisc(unittest.TestCase):
         self.assertTrue(is_in('foo/Bar', ['foo/bar']), 'Should match a directory path case-insensitively')
         self.assertTrue(is_in('foo/Bar/baz', ['foo/bar']), 'Should match a directory path case-insensitively')
 
+    def test_zip_decompress_selected(self):
+        zip_path = os.path.join(self.testdir, 'layers.zip')
+        with ZipFile(zip_path, 'w') as z:
+            for name in ('readme.txt', 'layers/roads.shp', 'layers/roads.dbf', 'layers/addresses.shp',
+                         'layers/addresses.dbf', 'layers/addresses.shx', 'layers/addresses.prj'):
+                z.writestr(name, 'yo')
+
+        data_source = {'conform': {'format': 'shapefile', 'file': 'addresses.shp'}}
+        workdir = os.path.join(self.testdir, 'selected')
+        paths = ZipDecompressTask().decompress([zip_path], workdir, [], data_source)
+
+        # Shapefiles are read in place by OGR.
+        vsi_path = '/vsizip/{}/layers/'.format(os.path.abspath(zip_path))
+        self.assertEqual(sorted(paths), [vsi_path + 'addresses.dbf', vsi_path + 'addresses.prj',
+                                         vsi_path + 'addresses.shp', vsi_path + 'addresses.shx'])
+        self.assertFalse(os.path.exists(os.path.join(workdir, 'unzipped')))
+
+        # Mixed-case names are extracted so they can be linked to lowercase.
+        with ZipFile(zip_path, 'a') as z:
+            z.writestr('layers/parcels.SHP', 'yo')
+            z.writestr('layers/parcels.dbf', 'yo')
+
+        data_source = {'conform': {'format': 'shapefile', 'file': 'parcels.SHP'}}
+        workdir = os.path.join(self.testdir, 'mixed-case')
+        paths = ZipDecompressTask().decompress([zip_path], workdir, [], data_source)
+
+        self.assertEqual(sorted(os.path.relpath(path, workdir) for path in paths),
+                         ['unzipped/layers/parcels.SHP', 'unzipped/layers/parcels.dbf'])
+
+        # Ambiguous sources fall back to extracting everything.
+        data_source = {'conform': {'format': 'shapefile'}}
+        workdir = os.path.join(self.testdir, 'ambiguous')
+        paths = ZipDecompressTask().decompress([zip_path], workdir, [], data_source)
+        self.assertEqual(len(paths), 9)
+
+    def test_zip_decompress_selected_gdb(self):
+        zip_path = os.path.join(os.path.dirname(__file__), 'data', 'lake-man-gdb-othername.zip')
+
+        with ZipFile(zip_path) as z:
+            member_count = len([name for name in z.namelist() if not name.endswith('/')])
+
+        data_source = {'conform': {'format': 'gdb'}}
+        paths = ZipDecompressTask().decompress([zip_path], self.testdir, [], data_source)
+
+        self.assertEqual(paths[0], '/vsizip/{}/lake-man-gdb.gdb'.format(os.path.abspath(zip_path)))
+        self.assertEqual(len(paths), member_count + 1)
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'unzipped')))
+
+    def test_decompression_task_from_format_string(self):
+        self.assertIs(type(DecompressionTask.from_format_string(None)), GuessDecompressTask)
+        self.assertIs(type(DecompressionTask.from_format_string('ZIP')), ZipDecompressTask)
+        self.assertIs(type(DecompressionTask.from_format_string('tar.gz')), TarDecompressTask)
+        self.assertEqual(DecompressionTask.from_format_string('gzip').ext, '.gz')
+        self.assertEqual(DecompressionTask.from_format_string('bz2').ext, '.bz2')
+        self.assertEqual(DecompressionTask.from_format_string('xz').ext, '.xz')
+
+        with self.assertRaises(KeyError):
+            DecompressionTask.from_format_string('rar')
+
+    @unittest.skipUnless(zstandard, 'zstandard is not installed')
+    def test_zstd_decompress(self):
+        self.assertEqual(DecompressionTask.from_format_string('zstd').ext, '.zst')
+
+        zst_path = os.path.join(self.testdir, 'addresses.gml.zst')
+
+        with zstandard.open(zst_path, 'wb') as output:
+            output.write(b'<gml/>')
+
+        data_source = {'conform': {'format': 'xml'}}
+        paths = GuessDecompressTask().decompress([zst_path], self.testdir, [], data_source)
+
+        self.assertEqual(paths, [os.path.join(self.testdir, 'unzipped', 'addresses.gml')])
+
+        with open(paths[0], 'rb') as file:
+            self.assertEqual(file.read(), b'<gml/>')
+
+    def test_stream_decompress(self):
+        geojson_path = os.path.join(os.path.dirname(__file__), 'data/us-pa-bucks.geojson')
+        gzip_path = os.path.join(self.testdir, 'us-pa-bucks-1234abcd.gz')
+
+        with open(geojson_path, 'rb') as input, gzip.open(gzip_path, 'wb') as output:
+            shutil.copyfileobj(input, output)
+
+        # GeoJSON stays compressed, with its extension restored for find_source_path().
+        data_source = {'conform': {'format': 'geojson'}, 'protocol': 'http'}
+        paths = GuessDecompressTask().decompress([gzip_path], self.testdir, [], data_source)
+
+        self.assertEqual(paths, [os.path.join(self.testdir, 'unzipped', 'us-pa-bucks-1234abcd.geojson.gz')])
+        self.assertEqual(find_source_path(data_source, paths), paths[0])
+
+        c = SourceConfig(dict({
+            "schema": 2,
+            "layers": {
+                "addresses": [{
+                    "name": "default",
+                    "conform": { "format": "geojson" }
+                }]
+            }
+        }), "addresses", "default")
+
+        csv_path = os.path.join(self.testdir, 'us-pa-bucks.csv')
+        geojson_source_to_csv(c, paths[0], csv_path)
+
+        with open(csv_path, encoding='utf8') as file:
+            row = next(csv.DictReader(file))
+            self.assertEqual(row[GEOM_FIELDNAME], 'POINT (-74.9833483425103 40.05498715)')
+            self.assertEqual(row['PARCEL_NUM'], '02-022-003')
+
+        # GML is read by OGR, so it's decompressed to disk.
+        xz_path = os.path.join(self.testdir, 'addresses.gml.xz')
+
+        with lzma.open(xz_path, 'wb') as output:
+            output.write(b'<gml/>')
+
+        workdir = os.path.join(self.testdir, 'gml')
+        data_source = {'conform': {'format': 'xml'}}
+        paths = StreamDecompressTask('.xz').decompress([xz_path], workdir, [], data_source)
+
+        self.assertEqual(paths, [os.path.join(workdir, 'unzipped', 'addresses.gml')])
+
+        with open(paths[0], 'rb') as file:
+            self.assertEqual(file.read(), b'<gml/>')
+
+    def test_tar_decompress(self):
+        tar_path = os.path.join(self.testdir, 'layers.tar.bz2')
+
+        with tarfile.open(tar_path, 'w:bz2') as tar:
+            for name in ('readme.txt', 'layers/addresses.csv', '../evil.csv'):
+                info = tarfile.TarInfo(name)
+                info.size = 2
+                tar.addfile(info, io.BytesIO(b'yo'))
+
+        paths = GuessDecompressTask().decompress([tar_path], self.testdir, [], None)
+
+        self.assertEqual(sorted(os.path.relpath(path, self.testdir) for path in paths),
+                         ['unzipped/layers/addresses.csv', 'unzipped/readme.txt'])
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'evil.csv')))
+
+        workdir = os.path.join(self.testdir, 'named')
+        paths = TarDecompressTask().decompress([tar_path], workdir, ['layers/addresses.csv'], None)
+        self.assertEqual(paths, [os.path.join(workdir, 'unzipped', 'layers', 'addresses.csv')])
+
+    def test_stream_decompress_across_filesystems(self):
+        gzip_path = os.path.join(self.testdir, 'addresses.csv.gz')
+
+        with gzip.open(gzip_path, 'wb') as output:
+            output.write(b'NUMBER,STREET\n1,MAIN ST\n')
+
+        # Downloads cached on another file system can't be linked.
+        with patch('openaddr.util.link') as link_patch:
+            link_patch.side_effect = OSError(errno.EXDEV, 'Invalid cross-device link')
+            data_source = {'conform': {'format': 'csv'}, 'protocol': 'http'}
+            paths = StreamDecompressTask('.gz').decompress([gzip_path], self.testdir, [], data_source)
+
+        self.assertEqual(paths, [os.path.join(self.testdir, 'unzipped', 'addresses.csv.gz')])
+
+        with open(paths[0], 'rb') as file, open(gzip_path, 'rb') as original:
+            self.assertEqual(file.read(), original.read())
+
+    def test_seven_zip_decompress(self):
+        seven_zip_path = os.path.join(self.testdir, 'layers.7z')
+
+        def fake_7z(args, **kwargs):
+            expand_path = args[3][len('-o'):]
+            os.makedirs(os.path.join(expand_path, 'layers'))
+            for name in ('readme.txt', 'layers/addresses.csv'):
+                with open(os.path.join(expand_path, name), 'w') as file:
+                    file.write('yo')
+
+        # openaddr.conform is shadowed by the openaddr.conform() function.
+        conform_module = import_module('openaddr.conform')
+
+        with patch.object(conform_module, 'check_call') as check_call_patch:
+            check_call_patch.side_effect = fake_7z
+            paths = SevenZipDecompressTask().decompress([seven_zip_path], self.testdir, ['layers/addresses.csv'], None)
+
+        self.assertEqual(paths, [os.path.join(self.testdir, 'unzipped', 'layers', 'addresses.csv')])
+        self.assertEqual(check_call_patch.call_args[0][0][:3], ('7z', 'x', '-y'))
+
+        with patch.object(conform_module, 'check_call') as check_call_patch:
+            check_call_patch.side_effect = FileNotFoundError(2, 'No such file or directory', '7z')
+            with self.assertRaises(DecompressionError):
+                SevenZipDecompressTask().decompress([seven_zip_path], self.testdir, [], None)
+
+        with patch.object(conform_module, 'check_call') as check_call_patch:
+            check_call_patch.side_effect = CalledProcessError(2, '7z')
+            with self.assertRaises(DecompressionError):
+                SevenZipDecompressTask().decompress([seven_zip_path], self.testdir, [], None)
+
     def test_geojson_source_to_csv(self):
         '''
         '''
@@ -2214,6 +2618,19 @@ class TestConformCsv(unittest.TestCase):
         self.assertEqual(r[0], u'n,s,{GEOM_FIELDNAME}'.format(**globals()))
         self.assertEqual(r[1], u'3203,SE WOODSTOCK BLVD,POINT (45.4815543938511 -122.630842186651)')
 
+    def test_srs_batch(self):
+        "Rows are reprojected in batches, and blank or odd coordinates should survive"
+        c = {"conform": {"lon": "x", "lat": "y", "srs": "EPSG:2913", "number": "n", "street": "s", "format": "csv"}, 'protocol': 'test'}
+        d = (u'n,s,X,Y'.encode('ascii'),
+             u'3203,SE WOODSTOCK BLVD,7655634.924,668868.414'.encode('ascii'),
+             u'3204,SE WOODSTOCK BLVD,,'.encode('ascii'),
+             u'3205,SE WOODSTOCK BLVD,"7655634,924","668868,414"'.encode('ascii'))
+        r = self._convert(c, d)
+        self.assertEqual(r[0], u'n,s,{GEOM_FIELDNAME}'.format(**globals()))
+        self.assertEqual(r[1], u'3203,SE WOODSTOCK BLVD,POINT (45.4815543938511 -122.630842186651)')
+        self.assertEqual(r[2], u'3204,SE WOODSTOCK BLVD,')
+        self.assertEqual(r[3], u'3205,SE WOODSTOCK BLVD,POINT (45.4815543938511 -122.630842186651)')
+
     def test_too_many_columns(self):
         "Check that we don't barf on input with too many columns in some rows"
         c = { "conform": { "format": "csv", "lat": "LATITUDE", "lon": "LONGITUDE" }, 'protocol': 'test' }
@@ -2249,6 +2666,91 @@ class TestConformCsv(unittest.TestCase):
         self.assertEqual(self._ascii_header_out, r[0])
         self.assertEqual(self._ascii_row_out, r[1])
 
+class TestConformStore (unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix='openaddr-TestConformStore-')
+        self.store = ConformStore(os.path.join(self.testdir, 'store'))
+        self.source_config = SourceConfig(dict({
+            "schema": 2,
+            "layers": {
+                "addresses": [{
+                    "name": "default",
+                    "conform": {"format": "csv", "lon": "x", "lat": "y"},
+                    "protocol": "http"
+                }]
+            }
+        }), "addresses", "default")
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_key(self):
+        key = self.store.key(self.source_config, 'abc', '1.0.0')
+        self.assertEqual(key, self.store.key(self.source_config, 'abc', '1.0.0'))
+        self.assertNotEqual(key, self.store.key(self.source_config, 'abd', '1.0.0'))
+        self.assertNotEqual(key, self.store.key(self.source_config, 'abc', '1.0.1'))
+        self.assertNotEqual(key, self.store.key(self.source_config, 'abc', '1.0.0', 'gzip'))
+
+        self.source_config.data_source['conform']['lon'] = 'X'
+        self.assertNotEqual(key, self.store.key(self.source_config, 'abc', '1.0.0'))
+
+    def test_get_and_put(self):
+        key = self.store.key(self.source_config, 'abc', '1.0.0')
+        self.assertIsNone(self.store.get(key))
+
+        out_path = os.path.join(self.testdir, 'out.csv')
+        with open(out_path, 'w') as file:
+            file.write('NUMBER,STREET\n1,MAIN ST\n')
+
+        self.store.put(key, out_path, [['NUMBER', 'STREET'], ['1', 'MAIN ST']], 'Point', 1)
+        path, sample, geometry_type, address_count = self.store.get(key)
+
+        with open(path) as file:
+            self.assertEqual(file.read(), 'NUMBER,STREET\n1,MAIN ST\n')
+
+        self.assertEqual(sample, [['NUMBER', 'STREET'], ['1', 'MAIN ST']])
+        self.assertEqual(geometry_type, 'Point')
+        self.assertEqual(address_count, 1)
+
+        # A second result for the same key leaves the first one in place.
+        self.store.put(key, out_path, [], 'Polygon', 2)
+        self.assertEqual(self.store.get(key)[2:], ('Point', 1))
+        self.assertEqual(os.listdir(self.store.dirname), [key])
+
+    def test_put_links_result(self):
+        key = self.store.key(self.source_config, 'abc', '1.0.0')
+
+        out_path = os.path.join(self.testdir, 'out.csv')
+        with open(out_path, 'w') as file:
+            file.write('NUMBER,STREET\n1,MAIN ST\n')
+
+        self.store.put(key, out_path, [], 'Point', 1)
+        self.assertTrue(os.path.samefile(out_path, self.store.get(key)[0]))
+
+    def test_eviction(self):
+        out_path = os.path.join(self.testdir, 'out.csv')
+        keys = [self.store.key(self.source_config, fingerprint, '1.0.0') for fingerprint in 'abc']
+
+        for (key, offset) in zip(keys, (-30, -20, -10)):
+            with open(out_path, 'w') as file:
+                file.write('NUMBER,STREET\n' + '1,MAIN ST\n' * 2)
+            self.store.put(key, out_path, [], 'Point', 2)
+            os.remove(out_path)
+
+            # Back-date each result so they are used in a known order.
+            result_path = os.path.join(self.store.dirname, key, 'conform.json')
+            os.utime(result_path, (time.time() + offset, time.time() + offset))
+
+        # Using the oldest result keeps it around, the next-oldest goes instead.
+        self.assertIsNotNone(self.store.get(keys[0]))
+        self.store.max_size = 70
+        self.store.evict()
+
+        self.assertIsNotNone(self.store.get(keys[0]))
+        self.assertIsNone(self.store.get(keys[1]))
+        self.assertIsNotNone(self.store.get(keys[2]))
+
 class TestConformLicense (unittest.TestCase):
 
     def test_license_string(self):
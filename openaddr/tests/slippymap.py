@@ -4,6 +4,7 @@ import os
 import unittest
 import tempfile
 import mock
+import gzip
 
 from os.path import join, dirname
 from zipfile import ZipFile
@@ -65,3 +66,28 @@ class TestSlippyMap (unittest.TestCase):
             os.remove(mbtiles_filename)
             os.remove(csv_filename)
             os.rmdir(temp_dir)
+
+    def test_render_csv_gz(self):
+        '''
+        '''
+        zip_filename = join(dirname(__file__), 'outputs', 'portland_metro.zip')
+        handle, mbtiles_filename = tempfile.mkstemp(prefix='render-', suffix='.mbtiles')
+        os.close(handle)
+
+        try:
+            temp_dir = tempfile.mkdtemp(prefix='test_render_csv_gz-')
+            zipfile = ZipFile(zip_filename)
+
+            with gzip.open(join(temp_dir, 'portland.csv.gz'), 'wb') as file:
+                file.write(zipfile.read('portland_metro/us/or/portland_metro.csv'))
+                csv_filename = file.name
+
+            with mock.patch('subprocess.Popen') as Popen:
+                slippymap.generate(mbtiles_filename, csv_filename)
+
+            self.assertEqual(len(Popen.return_value.stdin.write.mock_calls), 2 * 767)
+            self.assertEqual(len(Popen.return_value.stdin.close.mock_calls), 1)
+        finally:
+            os.remove(mbtiles_filename)
+            os.remove(csv_filename)
+            os.rmdir(temp_dir)
@@ -6,7 +6,7 @@ from os.path import dirname, join
 from datetime import datetime
 from shlex import quote
 
-import unittest, tempfile, json, io
+import unittest, tempfile, json, io, ftplib, os
 from mimetypes import guess_type
 from urllib.parse import urlparse, parse_qs
 from httmock import HTTMock, response
@@ -56,26 +56,56 @@ class TestUtilities (unittest.TestCase):
             with patch('ftplib.FTP') as FTP:
                 if zip_path is None:
                     zip_bytes = None
+                    FTP.return_value.transfercmd.side_effect = ftplib.error_perm('550 No such file')
                 else:
                     with open(zip_path, 'rb') as zip_file:
                         zip_bytes = zip_file.read()
+                    FTP.return_value.transfercmd.return_value.makefile.return_value = io.BytesIO(zip_bytes)
 
-                cb_file = io.BytesIO()
-                FTP.return_value.retrbinary.side_effect = lambda cmd, cb: cb_file.write(zip_bytes)
+                FTP.return_value.size.return_value = len(zip_bytes or b'')
+                FTP.return_value.sendcmd.return_value = '213 20200102030405'
 
-                with patch('openaddr.util.build_request_ftp_file_callback') as build_request_ftp_file_callback:
-                    build_request_ftp_file_callback.return_value = cb_file, None
-                    resp = util.request_ftp_file(ftp_url)
+                resp = util.request_ftp_file(ftp_url)
 
-                FTP.assert_called_once_with(parsed.hostname)
+                FTP.assert_called_once_with(parsed.hostname, timeout=util.FTP_TIMEOUT)
                 FTP.return_value.login.assert_called_once_with(parsed.username, parsed.password)
-                FTP.return_value.retrbinary.assert_called_once_with('RETR {}'.format(parsed.path), None)
+                FTP.return_value.set_pasv.assert_called_once_with(True)
+                FTP.return_value.transfercmd.assert_called_once_with('RETR {}'.format(parsed.path), rest=None)
 
                 if zip_bytes is None:
                     self.assertEqual(resp.status_code, 400, 'Nothing to return means failure')
                 else:
                     self.assertEqual(resp.status_code, 200)
-                    self.assertEqual(resp.content, zip_bytes, 'Expected number of bytes')
+                    self.assertEqual(resp.headers['Last-Modified'], 'Thu, 02 Jan 2020 03:04:05 GMT')
+                    self.assertEqual(b''.join(resp.iter_content(1024)), zip_bytes, 'Expected number of bytes')
+
+    def test_request_ftp_file_resume(self):
+        '''
+        '''
+        ftp_url, content = 'ftp://ftp.skra.is/skra/STADFANG.dsv.zip', bytes(range(256))
+
+        for (if_range, status_code, offset) in [('Thu, 02 Jan 2020 03:04:05 GMT', 206, 100),
+                                                ('Wed, 01 Jan 2020 00:00:00 GMT', 200, 0)]:
+            with patch('ftplib.FTP') as FTP:
+                FTP.return_value.size.return_value = len(content)
+                FTP.return_value.sendcmd.return_value = '213 20200102030405'
+                FTP.return_value.transfercmd.side_effect = lambda cmd, rest: Mock(makefile=lambda mode: io.BytesIO(content[rest or 0:]))
+
+                headers = {'Range': 'bytes=100-', 'If-Range': if_range}
+                resp = util.request_ftp_file(ftp_url, headers, passive=False)
+
+                FTP.return_value.set_pasv.assert_called_once_with(False)
+                FTP.return_value.transfercmd.assert_called_once_with('RETR /skra/STADFANG.dsv.zip', rest=(offset or None))
+
+                self.assertEqual(resp.status_code, status_code)
+                self.assertEqual(resp.headers['Content-Length'], str(len(content) - offset))
+                self.assertEqual(b''.join(resp.iter_content(64)), content[offset:])
+
+                if offset:
+                    self.assertEqual(resp.headers['Content-Range'], 'bytes 100-255/256')
+
+                resp.close()
+                FTP.return_value.quit.assert_called_once_with()
 
     def test_s3_key_url(self):
         '''
@@ -104,6 +134,50 @@ class TestUtilities (unittest.TestCase):
         key6.name, key6.bucket.name = u'/kéy6', 'bucket6'
         self.assertEqual(util.s3_key_url(key6), u'https://s3.amazonaws.com/bucket6/kéy6')
 
+    def test_get_pidlist_vanished(self):
+        '''
+        '''
+        # Process 999999999 exits between listing /proc and reading its status.
+        paths = ['/proc/{}/status'.format(util.getpid()), '/proc/999999999/status']
+
+        with patch('glob.glob') as glob:
+            glob.return_value = paths
+            pidlist = util.get_pidlist(util.getpid())
+
+        self.assertEqual(pidlist, {util.getpid()})
+
+    def test_file_store(self):
+        '''
+        '''
+        class Store (util.FileStore):
+            RESERVED_PREFIXES = ('partial-', )
+
+        dirname = tempfile.mkdtemp(prefix='openaddr-TestFileStore-')
+
+        try:
+            store = Store(join(dirname, 'store'), max_size=15)
+            os.makedirs(join(store.dirname, 'partial-abc'))
+
+            for (index, key) in enumerate(('a', 'b')):
+                path = join(dirname, '{}.txt'.format(key))
+                with open(path, 'w') as file:
+                    file.write('x' * 10)
+
+                store.put_entry(key, path, index=index)
+                os.utime(join(store.dirname, key, store.ENTRY_FILENAME), (index, index))
+
+            # A second put keeps the first entry, unless it replaces it.
+            store.put_entry('b', path, index=2)
+            self.assertEqual(store.get_entry('b')['index'], 1)
+            store.put_entry('b', path, replace=True, index=2)
+            self.assertEqual(store.get_entry('b')['index'], 2)
+
+            # Least-recently-used entries are evicted, reserved directories are not.
+            self.assertIsNone(store.get_entry('a'))
+            self.assertEqual(sorted(os.listdir(store.dirname)), ['b', 'partial-abc'])
+        finally:
+            rmtree(dirname)
+
     def test_log_current_usage(self):
         '''
         '''
@@ -2,25 +2,256 @@ import logging; _L = logging.getLogger('openaddr.util')
 
 from urllib.parse import urlparse, parse_qsl, urljoin
 from datetime import datetime, timedelta, date
-from os.path import join, basename, splitext, dirname, exists
+from os.path import join, basename, splitext, dirname, exists, lexists
 from operator import attrgetter
-from tempfile import mkstemp
-from os import close, getpid
+from tempfile import mkstemp, mkdtemp
+from os import close, getpid, link, remove
+import os
 import glob
 import collections
+import contextvars
+import enum
 import ftplib
-import httmock
+import requests
 import io
 import zipfile
+import shutil
+import gzip
+import bz2
+import lzma
 import time
+import json
 import re
 
+try:
+    import zstandard
+except ImportError:
+    # Optional, for zstd-compressed output
+    zstandard = None
+
 RESOURCE_LOG_INTERVAL = timedelta(seconds=30)
 RESOURCE_LOG_FORMAT = 'Resource usage: {{ user: {user:.0f}%, system: {system:.0f}%, ' \
     'memory: {memory:.0f}MB, read: {read:.0f}KB, written: {written:.0f}KB, ' \
     'sent: {sent:.0f}KB, received: {received:.0f}KB, period: {period:.0f}sec, ' \
     'procs: {procs:.0f} }}'
 
+# Log handler for the source being processed in the current context,
+# see process_one.LogFilterCurrentContext.
+current_log_handler = contextvars.ContextVar('current_log_handler', default=None)
+
+@enum.unique
+class SourceProblem (enum.Enum):
+    ''' Possible problems encountered in a source.
+    '''
+    skip_source = 'Source says to skip'
+    missing_conform = 'Source is missing a conform object'
+    unknown_conform_format = 'Unknown source conform format'
+    unknown_conform_protocol = 'Unknown source conform protocol'
+    download_source_failed = 'Could not download source data'
+    conform_source_failed = 'Could not conform source data'
+    no_coverage = 'Missing or incomplete coverage'
+    no_esri_token = 'Missing required ESRI token'
+    test_failed = 'An acceptance test failed'
+    no_addresses_found = 'Found no addresses in source data'
+
+    # Old tag naming; replaced with "format" or "protocol"
+    unknown_conform_type = 'Unknown source conform type'
+
+# Problems reported for the source being processed in the current context,
+# see process_one.process().
+current_source_problems = contextvars.ContextVar('current_source_problems', default=None)
+
+def report_source_problem(problem):
+    ''' Note a SourceProblem with the source being processed, if there is one.
+    '''
+    source_problems = current_source_problems.get()
+
+    if source_problems is not None:
+        source_problems.append(problem)
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    ''' Submit a callable to an executor, to run in a copy of the current context.
+
+        New threads start with an empty context, which would otherwise
+        keep their log messages out of the log of the current source.
+    '''
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# Single-file compression that Python can read as a stream, by filename extension.
+stream_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+# Compression for output CSV files, by name, see open_output_file().
+output_compressions = {'gzip': '.gz'}
+
+if zstandard is not None:
+    stream_openers['.zst'] = zstandard.open
+    output_compressions['zstd'] = '.zst'
+
+def source_splitext(path):
+    ''' Like os.path.splitext(), but look past compression like ".csv.gz".
+    '''
+    base, ext = splitext(path)
+
+    if ext.lower() in stream_openers:
+        return splitext(base)
+
+    return base, ext
+
+def open_source_file(path, mode='r', **kwargs):
+    ''' Open a source file for reading, decompressing it on the fly if needed.
+    '''
+    _, ext = splitext(path)
+    opener = stream_openers.get(ext.lower())
+
+    if opener is None:
+        return open(path, mode, **kwargs)
+
+    return opener(path, mode if 'b' in mode else mode + 't', **kwargs)
+
+def open_output_file(path, mode='w', **kwargs):
+    ''' Open an output file for writing, compressing it on the fly if needed.
+    '''
+    _, ext = splitext(path)
+    opener = stream_openers.get(ext.lower())
+
+    if opener is None:
+        return open(path, mode, **kwargs)
+
+    if opener is gzip.open:
+        # Level 9 is much slower for little gain, use zlib's default.
+        kwargs.setdefault('compresslevel', 6)
+
+    return opener(path, mode if 'b' in mode else mode + 't', **kwargs)
+
+def link_or_copy(src_path, dest_path):
+    ''' Hard link a file to a new path, or copy it across file systems.
+
+        An existing file at dest_path is replaced rather than written
+        through, since it might itself be linked to some other file.
+    '''
+    if lexists(dest_path):
+        remove(dest_path)
+
+    try:
+        link(src_path, dest_path)
+    except OSError:
+        shutil.copy(src_path, dest_path)
+
+def write_json_file(path, data):
+    ''' Write JSON data to a file atomically.
+    '''
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+
+    os.replace(path + '.tmp', path)
+
+class FileStore:
+    ''' On-disk store of one file per key, evicted least-recently-used first.
+
+        Each entry is a directory named for its key, holding the file and
+        a JSON file of details named ENTRY_FILENAME. Entries appear whole
+        or not at all, so concurrent processes never see a partial one.
+        Used by cache.DownloadCache and conform.ConformStore.
+    '''
+    MAX_SIZE = 10 * 1024**3
+    ENTRY_FILENAME = 'entry.json'
+
+    # Prefix of entries still being stored, and of other directories
+    # in the store that are never evicted.
+    TEMP_PREFIX = 'store-'
+    RESERVED_PREFIXES = ()
+
+    def __init__(self, dirname, max_size=None):
+        self.dirname = dirname
+        self.max_size = self.MAX_SIZE if max_size is None else max_size
+
+    def get_entry(self, key):
+        ''' Return a stored details dictionary with a file path, or None.
+
+            Marks the entry as recently used.
+        '''
+        entry_path = join(self.dirname, key, self.ENTRY_FILENAME)
+
+        try:
+            with open(entry_path) as file:
+                entry = json.load(file)
+            os.utime(entry_path)
+        except (IOError, OSError, ValueError):
+            return None
+
+        entry['path'] = join(self.dirname, key, entry['filename'])
+
+        if not exists(entry['path']):
+            return None
+
+        return entry
+
+    def write_entry(self, key, entry):
+        ''' Replace the stored details of an entry.
+        '''
+        entry = dict(entry)
+        entry.pop('path', None)
+        write_json_file(join(self.dirname, key, self.ENTRY_FILENAME), entry)
+
+    def put_entry(self, key, path, replace=False, **details):
+        ''' Store a file and details under a key, then evict old entries.
+
+            An existing entry for the key is kept unless replace is true.
+        '''
+        os.makedirs(self.dirname, exist_ok=True)
+        workdir = mkdtemp(prefix=self.TEMP_PREFIX, dir=self.dirname)
+        keydir = join(self.dirname, key)
+
+        try:
+            filename = basename(path)
+            link_or_copy(path, join(workdir, filename))
+
+            write_json_file(join(workdir, self.ENTRY_FILENAME),
+                            dict(details, filename=filename, size=os.path.getsize(path)))
+
+            if replace and exists(keydir):
+                shutil.rmtree(keydir, ignore_errors=True)
+
+            os.rename(workdir, keydir)
+        except OSError:
+            # Another process may have stored the same key first.
+            _L.debug('Could not store {} in {}'.format(key, self.dirname), exc_info=True)
+        finally:
+            if exists(workdir):
+                shutil.rmtree(workdir)
+
+        self.evict()
+
+    def evict(self):
+        ''' Remove least-recently-used entries until the store fits in max_size.
+        '''
+        entries, total_size = [], 0
+        skipped_prefixes = (self.TEMP_PREFIX, ) + tuple(self.RESERVED_PREFIXES)
+
+        for key in os.listdir(self.dirname):
+            if key.startswith(skipped_prefixes):
+                continue
+
+            entry_path = join(self.dirname, key, self.ENTRY_FILENAME)
+
+            try:
+                with open(entry_path) as file:
+                    entry = json.load(file)
+                size = entry.get('size') or os.path.getsize(join(self.dirname, key, entry['filename']))
+                entries.append((os.path.getmtime(entry_path), size, key))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+
+            total_size += size
+
+        for (_, size, key) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            _L.debug('Evicting {} from {}'.format(key, self.dirname))
+            shutil.rmtree(join(self.dirname, key), ignore_errors=True)
+            total_size -= size
+
 def get_version():
     ''' Prevent circular imports.
     '''
@@ -42,10 +273,17 @@ def prepare_db_kwargs(dsn):
 
     return kwargs
 
-def package_output(source, processed_path, website, license):
+def package_output(source, processed_path, website, license, keep_compressed=False):
     ''' Write a zip archive to temp dir with processed data and optional .vrt.
+
+        Compressed data like out.csv.gz is decompressed into the archive,
+        so it looks the same as uncompressed data. With keep_compressed,
+        it's stored as-is under its compressed name instead, without a .vrt.
     '''
-    _, ext = splitext(processed_path)
+    _, ext = source_splitext(processed_path)
+    _, compressed_ext = splitext(processed_path)
+    is_compressed = compressed_ext.lower() in stream_openers
+    keep_compressed = keep_compressed and is_compressed
     handle, zip_path = mkstemp(prefix='util-package_output-', suffix='.zip')
     close(handle)
 
@@ -56,7 +294,7 @@ def package_output(source, processed_path, website, license):
         content = file.read().format(website=website, license=license, date=date.today())
         zip_file.writestr('README.txt', content.encode('utf8'))
 
-    if ext == '.csv':
+    if ext == '.csv' and not keep_compressed:
         # Add virtual format to make CSV readable by QGIS, OGR, etc.
         # More information: http://www.gdal.org/drv_vrt.html
         template = join(dirname(__file__), 'templates', 'conform-result.vrt')
@@ -64,37 +302,133 @@ def package_output(source, processed_path, website, license):
             content = file.read().format(source=basename(source))
             zip_file.writestr(source + '.vrt', content.encode('utf8'))
 
-    zip_file.write(processed_path, source + ext)
+    if keep_compressed:
+        # Already-compressed data is stored as-is, deflating it again gains nothing.
+        zip_file.write(processed_path, source + ext + compressed_ext, compress_type=zipfile.ZIP_STORED)
+    elif is_compressed:
+        with open_source_file(processed_path, 'rb') as input, \
+             zip_file.open(source + ext, 'w', force_zip64=True) as output:
+            shutil.copyfileobj(input, output, 1024**2)
+    else:
+        zip_file.write(processed_path, source + ext)
+
     zip_file.close()
 
     return zip_path
 
-def build_request_ftp_file_callback():
+# FTP timeout in seconds, like cache._http_timeout
+FTP_TIMEOUT = 180
+
+class FTPStream(object):
+    ''' Readable stream of one FTP file transfer, for use as a response raw.
+
+        Errors reading from the data connection are raised as requests
+        exceptions, like they would be for an HTTP response.
     '''
+    def __init__(self, ftp, conn):
+        self.ftp = ftp
+        self.conn = conn
+        self.file = conn.makefile('rb')
+
+    def read(self, amt=None):
+        try:
+            return self.file.read(amt)
+        except (OSError, EOFError) as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        self.file.close()
+        self.conn.close()
+
+        try:
+            self.ftp.voidresp()
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+    # Called by requests.Response.close() once all content is read.
+    release_conn = close
+
+def build_ftp_response(url, status_code, raw=None, headers={}):
+    ''' Return a requests.Response streaming from raw, or empty.
     '''
-    file = io.BytesIO()
-    callback = lambda bytes: file.write(bytes)
-    return file, callback
+    response = requests.Response()
+    response.url, response.status_code = url, status_code
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers.update(headers)
+    response.raw = raw or io.BytesIO(b'')
+
+    return response
 
-def request_ftp_file(url):
+def get_ftp_last_modified(ftp, path):
+    ''' Return HTTP-style Last-Modified date of an FTP file, or None.
     '''
+    try:
+        reply = ftp.sendcmd('MDTM {}'.format(path))
+        modified = datetime.strptime(reply.split()[1][:14], '%Y%m%d%H%M%S')
+    except (ftplib.error_reply, ftplib.error_perm, IndexError, ValueError):
+        return None
+
+    return modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+def request_ftp_file(url, headers={}, passive=True):
+    ''' Stream a file from FTP as a requests.Response, like an HTTP GET.
+
+        An HTTP Range header resumes from a byte offset with FTP REST,
+        unless an If-Range header no longer matches the file date.
     '''
     _L.info('Getting {} via FTP'.format(url))
     parsed = urlparse(url)
+    ftp = None
 
     try:
-        ftp = ftplib.FTP(parsed.hostname)
+        ftp = ftplib.FTP(parsed.hostname, timeout=FTP_TIMEOUT)
         ftp.login(parsed.username, parsed.password)
+        ftp.set_pasv(passive)
+        ftp.voidcmd('TYPE I')
+
+        last_modified = get_ftp_last_modified(ftp, parsed.path)
+
+        try:
+            size = ftp.size(parsed.path)
+        except ftplib.error_perm:
+            size = None
+
+        range_match = re.match(r'^bytes=(\d+)-$', headers.get('Range', ''))
+        if_range = headers.get('If-Range')
+
+        if range_match and (if_range is None or if_range == last_modified):
+            offset = int(range_match.group(1))
+        else:
+            offset = 0
 
-        file, callback = build_request_ftp_file_callback()
-        ftp.retrbinary('RETR {}'.format(parsed.path), callback)
-        file.seek(0)
-    except Exception as e:
+        conn = ftp.transfercmd('RETR {}'.format(parsed.path), rest=(offset or None))
+    except ftplib.all_errors as e:
         _L.warning('Got an error from {}: {}'.format(parsed.hostname, e))
-        return httmock.response(400, b'', headers={'Content-Type': 'application/octet-stream'})
 
-    # Using mock response because HTTP responses are expected downstream
-    return httmock.response(200, file.read(), headers={'Content-Type': 'application/octet-stream'})
+        if ftp is not None:
+            ftp.close()
+
+        # Permanent errors like a missing file are not worth retrying.
+        return build_ftp_response(url, 400 if isinstance(e, ftplib.error_perm) else 503)
+
+    response_headers = dict()
+
+    if last_modified:
+        response_headers['Last-Modified'] = last_modified
+
+    if size is not None:
+        response_headers['Content-Length'] = str(size - offset)
+
+    if offset and size is not None:
+        response_headers['Content-Range'] = 'bytes {}-{}/{}'.format(offset, size - 1, size)
+    elif offset:
+        response_headers['Content-Range'] = 'bytes {}-/*'.format(offset)
+
+    return build_ftp_response(url, 206 if offset else 200, FTPStream(ftp, conn), response_headers)
 
 def s3_key_url(key):
     '''
@@ -106,6 +440,8 @@ def s3_key_url(key):
 
 def get_pidlist(start_pid):
     ''' Return a set of recursively-found child PIDs of the given start PID.
+
+        Processes that exit while /proc is being read are skipped.
     '''
     children = collections.defaultdict(set)
 
@@ -113,12 +449,18 @@ def get_pidlist(start_pid):
         _, _, pid, _ = path.split('/', 3)
         if pid in ('thread-self', 'self'):
             continue
-        with open(path) as file:
-            for line in file:
-                if line.startswith('PPid:\t'):
-                    ppid = line[6:].strip()
-                    break
-            children[int(ppid)].add(int(pid))
+        try:
+            with open(path) as file:
+                for line in file:
+                    if line.startswith('PPid:\t'):
+                        ppid = line[6:].strip()
+                        break
+                else:
+                    continue
+        except OSError:
+            # Process has already exited.
+            continue
+        children[int(ppid)].add(int(pid))
 
     parents, pids = [start_pid], set()
 
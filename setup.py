@@ -16,6 +16,7 @@ setup(
         console_scripts = [
             'openaddr-preview-source = openaddr.preview:main',
             'openaddr-process-one = openaddr.process_one:main',
+            'openaddr-process-many = openaddr.process_many:main',
         ]
     ),
     package_data = {
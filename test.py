@@ -13,10 +13,10 @@ import unittest
 import sys, os
 import logging
 
-from openaddr.tests import TestOA, TestState, TestPackage
+from openaddr.tests import TestOA, TestState, TestPackage, TestProcessMany
 from openaddr.tests.sample import TestSample
-from openaddr.tests.cache import TestCacheExtensionGuessing, TestCacheEsriDownload
-from openaddr.tests.conform import TestConformCli, TestConformTransforms, TestConformMisc, TestConformCsv, TestConformLicense, TestConformTests
+from openaddr.tests.cache import TestCacheExtensionGuessing, TestCacheURLDownload, TestCacheResumeDownload, TestCacheRevalidation, TestCacheEsriDownload
+from openaddr.tests.conform import TestConformCli, TestConformTransforms, TestConformMisc, TestConformCsv, TestConformLicense, TestConformTests, TestConformStore
 from openaddr.tests.preview import TestPreview
 from openaddr.tests.slippymap import TestSlippyMap
 from openaddr.tests.util import TestUtilities